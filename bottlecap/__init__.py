@@ -1,2 +1,24 @@
-from bottlecap.plugin import BottleCap
-from bottlecap.views import View
+import importlib
+
+# names are imported on first access, so that importing one submodule,
+# or the CLI, does not load the whole framework
+_lazy = {
+    'BottleCap': 'bottlecap.plugin',
+    'View': 'bottlecap.views',
+}
+
+__all__ = list(_lazy)
+
+
+def __getattr__(name):
+    module = _lazy.get(name)
+    if module is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(
+            __name__, name))
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
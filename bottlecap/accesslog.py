@@ -0,0 +1,240 @@
+"""
+Buffered structured access log for BottleCap
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+
+from collections import deque
+from time import monotonic_ns
+from bottle import request, HTTPResponse
+
+from bottlecap.hooks import HookPlugin, RouteHooks
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['AccessLogWriter', 'AccessLogPlugin']
+
+
+class AccessLogWriter:
+    """
+    Writes access log records as JSON lines, from a background thread
+
+    Request threads append records to a ring buffer, which does not
+    take any locks. The writer thread flushes the buffer in batches,
+    every `flush_interval` seconds or once `batch_size` records are
+    waiting. When the buffer is full, `drop_policy` decides whether the
+    `newest` record, or the `oldest` buffered record, is discarded.
+    Drops are counted approximately, as counters are not locked.
+
+    :attr output: Path to append to, or writable text stream
+    """
+
+    DROP_POLICIES = ('newest', 'oldest')
+
+    def __init__(self, output=None, capacity:int=10000, batch_size:int=500,
+                 flush_interval:float=1.0, drop_policy:str='newest',
+                 name:str='bottlecap-accesslog'):
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError('Invalid drop policy: {!r}'.format(drop_policy))
+        self.output = output if output is not None else sys.stderr
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.drop_policy = drop_policy
+        self.name = name
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid = None
+        self.thread = None
+        self.closed = False
+        self.stream = None
+        self.reset()
+
+    def reset(self):
+        maxlen = self.capacity if self.drop_policy == 'oldest' else None
+        self.buffer = deque(maxlen=maxlen)
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        """Start writer thread, if not already running in this process"""
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                # threads and buffer state do not survive a fork
+                self.reset()
+            self.pid = os.getpid()
+            self.closed = False
+            self.thread = threading.Thread(target=self.worker, daemon=True,
+                                           name=self.name)
+            self.thread.start()
+            atexit.register(self.shutdown)
+
+    def write(self, record):
+        """
+        Buffer record for writing, never blocks
+
+        :returns: False if the record was dropped
+        """
+        if self.pid != os.getpid():
+            self.start()
+        buffer = self.buffer
+        size = len(buffer)
+        if size >= self.capacity:
+            self.dropped += 1
+            if self.drop_policy == 'newest':
+                return False
+        buffer.append(record)
+        if size + 1 == self.batch_size:
+            self.wakeup.set()
+        return True
+
+    def open(self):
+        if self.stream is None:
+            if isinstance(self.output, str):
+                self.stream = open(self.output, 'a', encoding='utf-8')
+            else:
+                self.stream = self.output
+        return self.stream
+
+    def flush(self):
+        """Write all buffered records"""
+        buffer = self.buffer
+        while buffer:
+            lines = []
+            try:
+                for x in range(self.batch_size):
+                    lines.append(json.dumps(buffer.popleft(), default=str))
+            except IndexError:
+                pass
+            if not lines:
+                break
+            try:
+                stream = self.open()
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+            except Exception:
+                logger.exception('Failed to write access log')
+                self.dropped += len(lines)
+            else:
+                self.written += len(lines)
+
+    def worker(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def shutdown(self, timeout:float=None):
+        """
+        Flush remaining records and stop writer thread
+
+        :returns: True if writer finished within timeout
+        """
+        if self.pid != os.getpid() or self.closed:
+            return True
+        self.closed = True
+        atexit.unregister(self.shutdown)
+        self.wakeup.set()
+        self.thread.join(timeout)
+        self.flush()
+        if self.stream is not None and isinstance(self.output, str):
+            self.stream.close()
+            self.stream = None
+        return not self.thread.is_alive()
+
+    def stats(self):
+        return dict(depth=len(self.buffer), written=self.written,
+                    dropped=self.dropped)
+
+
+def body_size(body):
+    """
+    Returns size of rendered body in bytes, if known
+
+    >>> body_size('caf\\u00e9'), body_size(b'abc'), body_size(iter([]))
+    (5, 3, None)
+    """
+    if isinstance(body, bytes):
+        return len(body)
+    if isinstance(body, str):
+        return len(body) if body.isascii() else len(body.encode('utf-8'))
+    return None
+
+
+class AccessLogPlugin(HookPlugin):
+    """
+    Records one structured access log record per request
+
+    Records contain route name, CBV class, negotiated renderer and
+    parser, user guid, status, response bytes, duration and, when
+    `TimingPlugin` is installed, phase timings in milliseconds.
+
+    Installed by `BottleCap(access_log=...)` directly after the route
+    compiler, so that status and size are taken from the rendered
+    response or error.
+    """
+
+    name = 'accesslog'
+
+    def __init__(self, writer:AccessLogWriter):
+        self.writer = writer
+
+    def setup(self, app):
+        app.access_log = self.writer
+
+    def close(self):
+        self.writer.shutdown()
+
+    def prepare(self, route):
+        route_name = route.name or route.rule
+        view_class = getattr(route.callback, 'view_class', None)
+        view = view_class and '{}.{}'.format(view_class.__module__,
+                                             view_class.__qualname__)
+        write = self.writer.write
+
+        def before():
+            request.environ['bottlecap.accesslog'] = monotonic_ns()
+
+        def record(status, body):
+            environ = request.environ
+            nctx = getattr(request, 'nctx', None)
+            renderer = getattr(nctx, 'renderer', None)
+            parser = getattr(nctx, 'parser', None)
+            user = getattr(request, 'user', None)
+            timings = environ.get('bottlecap.timings')
+            write(dict(
+                time=time.time(),
+                method=environ.get('REQUEST_METHOD'),
+                path=environ.get('PATH_INFO'),
+                route=route_name,
+                view=view,
+                renderer=renderer and renderer.__name__,
+                parser=parser and parser.__name__,
+                user=user and str(user.guid),
+                status=status,
+                bytes=body_size(body),
+                duration_ms=(monotonic_ns() - environ['bottlecap.accesslog']) / 1e6,
+                timings=timings and { k: v / 1e6 for k, v in timings.items() }))
+
+        def after(resp):
+            if isinstance(resp, HTTPResponse):
+                record(resp.status_code, resp.body)
+            else:
+                record(200, resp)
+            return resp
+
+        def error(exc):
+            if isinstance(exc, HTTPResponse):
+                record(exc.status_code, exc.body)
+            else:
+                record(500, None)
+
+        return RouteHooks(before=before, after=after, error=error)
@@ -0,0 +1,187 @@
+"""
+API key authentication for BottleCap
+
+Keys have the form `<key id>.<secret>` and are presented in a request
+header. Only SHA-256 digests of keys are held, keys are random with
+enough entropy that a slow password hash is not needed, so each
+request costs one digest and a dict lookup rather than a signature
+verification.
+"""
+
+import hmac
+import logging
+import hashlib
+import secrets
+
+from time import monotonic
+from uuid import UUID
+from bottle import request
+
+from bottlecap import exceptions as ex
+from bottlecap.auth import User, RoleCheckPlugin, auth_hooks
+from bottlecap.hooks import HookPlugin
+from bottlecap.sources import JSONFileSource, SourceIndex
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ApiKeyAuthPlugin', 'ApiKeyIndex', 'ApiKeyFile', 'generate_key',
+           'hash_key']
+
+
+def hash_key(key):
+    """
+    Returns hash of key as stored in `ApiKeyIndex`
+
+    >>> hash_key('k1.secret')
+    'sha256:d7ea54df65825afbba94225fb8a174c42f89bf2161f8b958a6bf9b4f3da6a1ac'
+    """
+    return 'sha256:' + hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def parse_hash(key_hash):
+    scheme, _, digest = key_hash.partition(':')
+    if scheme != 'sha256':
+        raise ValueError('Unsupported key hash: {!r}'.format(scheme))
+    digest = bytes.fromhex(digest)
+    if len(digest) != hashlib.sha256().digest_size:
+        raise ValueError('Invalid sha256 key hash')
+    return digest
+
+
+def generate_key(key_id:str=None, nbytes:int=32):
+    """Returns new random key, and its hash to store"""
+    key = '{}.{}'.format(key_id or secrets.token_hex(8),
+                         secrets.token_urlsafe(nbytes))
+    return key, hash_key(key)
+
+
+class ApiKeyFile(JSONFileSource):
+    """
+    Key source which reads a local JSON file of the form
+    `{"keys": [{"id": ..., "hash": ..., "user": {...}}, ...]}`, where
+    user has `guid`, `roles`, `is_active` and optionally `options`
+
+    Returns None while the file is unchanged. Any callable returning
+    such a dict, or None when unchanged, can be used as a source.
+    """
+
+
+class ApiKeyIndex(SourceIndex):
+    """
+    Hashes of API keys, indexed by key id, and the user of each key
+
+    Keys are added directly, or loaded from `source` which is polled
+    at most every `refresh_interval` seconds on lookup. Each refresh
+    replaces all keys from the source at once. Users are built once,
+    when keys are loaded.
+    """
+
+    kind = 'API keys'
+
+    def __init__(self, source=None, refresh_interval:float=30,
+                 user_model_cls=User, clock=monotonic):
+        super().__init__(source, refresh_interval, clock=clock)
+        self.user_model_cls = user_model_cls
+        # compared against when key id is unknown, so that unknown and
+        # wrong keys take the same time
+        self.missing = hashlib.sha256(secrets.token_bytes(32)).digest()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def make_user(self, data):
+        kwargs = dict(guid=UUID(data['guid']), roles=list(data['roles']),
+                      is_active=bool(data['is_active']))
+        if data.get('options') is not None:
+            kwargs['options'] = data['options']
+        return self.user_model_cls(**kwargs)
+
+    def add(self, key_id, key_hash, user):
+        """Add key which is kept across refreshes, `user` may be a dict"""
+        if isinstance(user, dict):
+            user = self.make_user(user)
+        self.put(key_id, (parse_hash(key_hash), user))
+        return user
+
+    def parse(self, data):
+        """Returns keys of a key file document"""
+        keys = {}
+        for item in data.get('keys', []):
+            try:
+                keys[str(item['id'])] = (parse_hash(item['hash']),
+                                         self.make_user(item['user']))
+            except Exception:
+                logger.warning('Skipping invalid API key %r',
+                               item.get('id') if isinstance(item, dict) else None,
+                               exc_info=True)
+        return keys
+
+    def find(self, key):
+        """Returns user of key, or None if key is not valid"""
+        key_id, sep, secret = key.partition('.')
+        entry = self.get(key_id) if sep and secret else None
+        expected = entry[0] if entry is not None else self.missing
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        if hmac.compare_digest(digest, expected) and entry is not None:
+            return entry[1]
+        return None
+
+
+class ApiKeyAuthPlugin(HookPlugin):
+    """
+    Authenticates requests by API key, as an alternative to
+    `JWTAuthPlugin` for machine to machine traffic
+
+    Sets `request.user`, and `request.api_key` to the id of the key,
+    never the key itself. Role requirements of `AuthenticationViewMixin`
+    views are checked as with `JWTAuthPlugin`.
+
+    :attr keys: `ApiKeyIndex` of accepted keys
+    :attr header: Request header which holds the key
+    """
+
+    name = 'apikeyauth'
+
+    def __init__(self, keys:ApiKeyIndex=None, header:str='X-API-Key'):
+        self.keys = keys if keys is not None else ApiKeyIndex()
+        self.header = header
+
+    def get_key_from_request(self):
+        """Returns raw key from request headers"""
+        key = request.headers.get(self.header)
+        if key is None:
+            return None
+        key = key.strip()
+        if not key:
+            raise ex.BadRequestError(
+                error_desc="Request authorization failed",
+                error_detail="Request header {!r} is empty".format(self.header))
+        return key
+
+    def authenticate(self):
+        """Assign user and key id to current request"""
+        # assign defaults, keeping a user set by another authenticator
+        if getattr(request, 'user', None) is None:
+            request.user = None
+        request.api_key = None
+
+        key = self.get_key_from_request()
+        if key is None: return
+
+        user = self.keys.find(key)
+        if user is None:
+            raise ex.NotAuthenticatedError(error_desc='Invalid API key')
+        if user.is_active is False:
+            raise ex.NotAuthorizedError(error_desc='User has been disabled')
+        request.api_key = key.partition('.')[0]
+        request.user = user
+
+    def setup(self, app):
+        RoleCheckPlugin.install_once(app)
+
+    def warmup(self, app):
+        """Load keys, rather than on first request"""
+        self.keys.refresh()
+
+    def prepare(self, route):
+        return auth_hooks(self.authenticate, route)
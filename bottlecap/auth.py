@@ -2,44 +2,179 @@
 Authentication library for BottleCap
 """
 
+import os
+import json
+import time
+import hashlib
 import logging
+import threading
 import jwt
+from jwt.algorithms import get_default_algorithms
+from jwt.utils import base64url_encode
+from calendar import timegm
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, perf_counter_ns
 
 from bottle import request
 from bottlecap import View
+from bottlecap.negotiation import JSONParser, JSONRenderer
 from typing import Union, List
 from box import Box
-from uuid import UUID
+from uuid import UUID, uuid4
 
 from bottlecap import exceptions as ex
+from bottlecap.hooks import HookPlugin, RouteHooks
+from bottlecap.singleflight import SingleFlight
+from bottlecap.sources import JSONFileSource, SourceIndex
 
 logger = logging.getLogger(__name__)
 
+##############################################################
+# Roles
+##############################################################
+
+class RoleRegistry:
+    """
+    Interns role names as bits, so that sets of roles are compared
+    with integer operations
+
+    >>> registry = RoleRegistry()
+    >>> registry.mask(['admin', 'Editor']), registry.mask(['editor'])
+    (3, 2)
+    >>> registry.mask(['viewer'], intern=False)
+    0
+    """
+
+    def __init__(self):
+        self.bits = {}
+        self.lock = threading.Lock()
+
+    def intern(self, role):
+        role = role.lower()
+        bit = self.bits.get(role)
+        if bit is None:
+            with self.lock:
+                bit = self.bits.setdefault(role, 1 << len(self.bits))
+        return bit
+
+    def mask(self, roles, intern:bool=True):
+        """
+        Returns bitmask of roles. Without `intern`, roles which no view
+        requires are ignored, as they cannot affect any check
+        """
+        mask = 0
+        if intern:
+            for role in roles:
+                mask |= self.intern(role)
+        else:
+            bits = self.bits
+            for role in roles:
+                mask |= bits.get(role.lower(), 0)
+        return mask
+
+
+role_registry = RoleRegistry()
+
+
+class RoleRequirement:
+    """
+    Role requirements of a view, compiled into bitmasks
+
+    :attr user_required: Reject requests without a user
+    :attr roles_required: User must have all of these roles
+    :attr roles_accepted: User must have at least one of these roles
+    """
+
+    __slots__ = ('user_required', 'required', 'accepted', 'registry')
+
+    def __init__(self, user_required:bool=True, roles_required=None,
+                 roles_accepted=None, registry:RoleRegistry=role_registry):
+        self.user_required = user_required
+        self.registry = registry
+        self.required = registry.mask(roles_required or ())
+        self.accepted = registry.mask(roles_accepted or ())
+
+    @classmethod
+    def for_view(cls, view_class):
+        return cls(user_required=view_class.user_required,
+                   roles_required=view_class.roles_required,
+                   roles_accepted=view_class.roles_accepted)
+
+    def check(self, user):
+        """Raise unless user meets requirements"""
+        if user is None:
+            if self.user_required or self.required or self.accepted:
+                raise ex.NotAuthenticatedError()
+            return
+        mask = user.role_mask_for(self.registry)
+        if mask & self.required != self.required:
+            raise ex.NotAuthorizedError()
+        if self.accepted and not mask & self.accepted:
+            raise ex.NotAuthorizedError()
+
+
 ##############################################################
 # JWT Auth Plugin
 ##############################################################
 
 class User:
+    """
+    Authenticated user, roles are lowered into a frozenset once
+
+    Options are exposed as a frozen `Box`, built on first access.
+    """
+
+    __slots__ = ('_guid', '_roles', '_is_active', '_options', '_options_box',
+                 '_role_mask')
+
     def __init__(self, guid:UUID, roles:List[str], is_active:bool, options:dict=None):
-        self._data = dict(guid=guid, roles=roles, is_active=is_active, options=options)
+        self._guid = guid
+        self._roles = frozenset(r.lower() for r in roles)
+        self._is_active = is_active
+        self._options = options
+        self._options_box = None
+        self._role_mask = None
 
     @property
     def guid(self):
-        return self._data['guid']
+        return self._guid
 
     @property
     def is_active(self):
-        return self._data['is_active']
+        return self._is_active
 
     @property
     def options(self):
-        return Box(self._data['options'] or {})
+        """Return options as read-only `Box`"""
+        if self._options_box is None:
+            self._options_box = Box(self._options or {}, frozen_box=True)
+        return self._options_box
 
     @property
     def roles(self):
         """Return roles as lowered set"""
-        return set([ r.lower() for r in self._data['roles']])
-    
+        return self._roles
+
+    @property
+    def role_mask(self):
+        """Return roles as bitmask of `role_registry`"""
+        return self.role_mask_for(role_registry)
+
+    def role_mask_for(self, registry:RoleRegistry):
+        """Return roles as bitmask of registry, cached per registry"""
+        masks = self._role_mask
+        if masks is None:
+            masks = self._role_mask = {}
+        cached = masks.get(registry)
+        # roles interned since the mask was built may be held by user
+        version = len(registry.bits)
+        if cached is None or cached[0] != version:
+            cached = masks[registry] = (
+                version, registry.mask(self._roles, intern=False))
+        return cached[1]
+
     def has_role(self, role:str):
         """Check user assumes a particular role.
 
@@ -49,7 +184,7 @@ class User:
         :return: result of a check
         :rtype:  bool
         """
-        return role in self.roles
+        return role in self._roles
 
     def has_roles(self, *roles:str):
         """Check user assumes multiple roles in the same time.
@@ -60,7 +195,7 @@ class User:
         :return: result of a check
         :rtype:  bool
         """
-        return all(self.has_role(role) for role in roles)
+        return self._roles.issuperset(roles)
 
     def has_any_role(self, *roles:str):
         """Check user assumes at least one role from a list.
@@ -71,7 +206,471 @@ class User:
         :return result of a check
         :rtype: bool
         """
-        return any(self.has_role(role) for role in roles)
+        return not self._roles.isdisjoint(roles)
+
+
+##############################################################
+# Verified token cache
+##############################################################
+
+class TokenCache:
+    """
+    Bounded LRU of verified JWT claims, keyed by digest of the raw token
+
+    Entries expire at the `exp` claim of the token, or after `max_age`
+    seconds, whichever is sooner. Cached claims, and the user attached
+    to them, are shared between requests and must not be modified.
+
+    >>> cache = TokenCache(max_size=2, clock=lambda: 100)
+    >>> cache.set('a.b.c', {'sub': 1, 'exp': 200})
+    >>> cache.get('a.b.c'), cache.get('x.y.z')
+    ({'sub': 1, 'exp': 200}, None)
+    >>> cache.stats()
+    {'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0, 'expired': 0}
+    """
+
+    def __init__(self, max_size:int=10000, max_age:float=300, clock=time.time):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    @staticmethod
+    def digest(raw_token):
+        return hashlib.sha256(raw_token.encode('utf-8')).digest()
+
+    def get(self, raw_token):
+        """Returns verified claims, or None if not cached"""
+        key = self.digest(raw_token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, claims, user = entry
+            if expires <= self.clock():
+                del self.entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return claims
+
+    def set(self, raw_token, claims):
+        """Cache claims of a token which has been verified"""
+        expires = self.clock() + self.max_age
+        exp = claims.get('exp') if isinstance(claims, dict) else None
+        if isinstance(exp, (int, float)):
+            expires = min(expires, exp)
+        key = self.digest(raw_token)
+        with self.lock:
+            self.entries[key] = [expires, claims, None]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_user(self, raw_token):
+        """Returns user attached to cached token, or None"""
+        key = self.digest(raw_token)
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry[2] if entry is not None else None
+
+    def set_user(self, raw_token, user):
+        """Attach user built from claims to a cached token"""
+        key = self.digest(raw_token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[2] = user
+
+    def evict(self, raw_token):
+        """Remove token, e.g. once revoked. Returns True if it was cached"""
+        with self.lock:
+            return self.entries.pop(self.digest(raw_token), None) is not None
+
+    def evict_where(self, predicate):
+        """
+        Remove tokens whose claims match `predicate(claims)`, such as
+        every token of a disabled user. Returns number removed
+        """
+        with self.lock:
+            keys = [ key for key, (expires, claims, user) in self.entries.items()
+                     if predicate(claims) ]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return dict(size=len(self.entries), hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, expired=self.expired)
+
+
+##############################################################
+# User loader
+##############################################################
+
+class UserLoader:
+    """
+    Loads users from a user store by guid, through a TTL cache
+
+    Users are cached for `ttl` seconds, and guids which are not found
+    for `negative_ttl` seconds. Concurrent misses for the same guid
+    share a single call of `load`. Errors are raised to every waiting
+    caller, and are not cached. Waiters raise `DeadlineExceededError`
+    once their request deadline passes, or after `wait_timeout` seconds.
+
+    Cache hits and misses are counted as `user_loader` with a `result`
+    label, and load latency observed as `user_loader_load`, in `metrics`.
+    `JWTAuthPlugin` uses the registry of `app.metrics` when not given.
+
+    :attr load: Callable `load(guid)` returning user, or None when the
+                user does not exist
+    :attr metrics: `MetricsRegistry` to report to
+    """
+
+    def __init__(self, load, ttl:float=60, negative_ttl:float=10,
+                 max_size:int=10000, wait_timeout:float=30, metrics=None,
+                 clock=monotonic):
+        self.load = load
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.metrics = metrics
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.flight = SingleFlight(wait_timeout)
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def count(self, result):
+        if self.metrics is not None:
+            self.metrics.count('user_loader', result=result)
+
+    def lookup(self, guid):
+        """Returns (found, user) from cache"""
+        with self.lock:
+            entry = self.entries.get(guid)
+            if entry is None:
+                return False, None
+            if entry[0] <= self.clock():
+                del self.entries[guid]
+                return False, None
+            self.entries.move_to_end(guid)
+            return True, entry[1]
+
+    def store(self, guid, user):
+        ttl = self.ttl if user is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries[guid] = (self.clock() + ttl, user)
+            self.entries.move_to_end(guid)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def fetch(self, guid):
+        start = perf_counter_ns()
+        user = self.load(guid)
+        if self.metrics is not None:
+            self.metrics.observe('user_loader_load',
+                                 (perf_counter_ns() - start) // 1000)
+        self.store(guid, user)
+        return user
+
+    def hit(self, user):
+        self.hits += 1
+        self.count('hit' if user is not None else 'negative_hit')
+        return user
+
+    def get(self, guid):
+        """Returns user with guid, or None if it does not exist"""
+        found, user = self.lookup(guid)
+        if found:
+            return self.hit(user)
+
+        call, leader = self.flight.join(guid)
+        if not leader:
+            self.shared += 1
+            self.count('shared')
+            return self.flight.wait(call)
+
+        # another leader may have stored the user since our lookup
+        try:
+            found, user = self.lookup(guid)
+            if found:
+                self.hit(user)
+            else:
+                self.misses += 1
+                self.count('miss')
+                user = self.fetch(guid)
+        except Exception as exc:
+            self.flight.finish(guid, call, exc=exc)
+            raise
+        self.flight.finish(guid, call, result=user)
+        return user
+
+    def invalidate(self, guid):
+        """Drop cached user, e.g. once changed in the user store"""
+        with self.lock:
+            self.entries.pop(guid, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return dict(size=len(self.entries), hits=self.hits,
+                    misses=self.misses, shared=self.shared)
+
+
+##############################################################
+# Key ring
+##############################################################
+
+def load_key(key, algorithm:str):
+    """
+    Parse PEM encoded key, or JWK dict, into key object for `algorithm`
+    """
+    if not isinstance(key, (str, bytes, dict)):
+        return key
+    algo = get_default_algorithms().get(algorithm)
+    if algo is None:
+        raise ValueError('Unsupported algorithm: {!r}'.format(algorithm))
+    if isinstance(key, dict):
+        return algo.from_jwk(json.dumps(key))
+    return algo.prepare_key(key)
+
+
+class JWKSFile(JSONFileSource):
+    """
+    Key source which reads a JWKS document from a local file
+
+    Returns None while the file is unchanged. Any callable returning a
+    JWKS dict, or None when unchanged, can be used as a `KeyRing` source,
+    such as a fetcher for the JWKS endpoint of an identity provider.
+    """
+
+
+class KeyRing(SourceIndex):
+    """
+    Verification keys indexed by `kid`, parsed once into key objects
+
+    Keys are added directly, or loaded from a JWKS `source` which is
+    polled every `refresh_interval` seconds and, at most every
+    `miss_interval` seconds, when a token names an unknown `kid`. Each
+    refresh replaces all keys from the source at once, so during
+    rollover tokens signed with either key select exactly one key.
+
+    Tokens without a `kid` use the key added without one, or the only
+    key in the ring. Tokens naming a `kid` which is not in the ring are
+    rejected, even if a key without one exists.
+    """
+
+    kind = 'verification keys'
+
+    def __init__(self, algorithm:str='RS512', source=None,
+                 refresh_interval:float=300, miss_interval:float=5,
+                 clock=monotonic):
+        super().__init__(source, refresh_interval, miss_interval, clock)
+        self.algorithm = algorithm
+
+    @property
+    def configured(self):
+        return bool(self.keys) or self.source is not None
+
+    def add(self, kid, key, algorithm:str=None):
+        """Add key which is kept across refreshes, returns key object"""
+        entry = (load_key(key, algorithm or self.algorithm), algorithm)
+        self.put(kid, entry)
+        return entry[0]
+
+    def parse(self, jwks):
+        """Returns keys of a JWKS document"""
+        keys = {}
+        for jwk in jwks.get('keys', []):
+            if jwk.get('use', 'sig') != 'sig':
+                continue
+            algorithm = jwk.get('alg')
+            try:
+                key = load_key(jwk, algorithm or self.algorithm)
+            except Exception:
+                logger.warning('Skipping invalid JWK %r', jwk.get('kid'),
+                               exc_info=True)
+                continue
+            keys[jwk.get('kid')] = (key, algorithm)
+        return keys
+
+    def find(self, kid):
+        """
+        Returns (key, algorithm) for `kid`, algorithm is None unless
+        given by the key
+
+        :raises jwt.exceptions.InvalidTokenError: No key for `kid`
+        """
+        entry = self.get(kid) if kid is not None else self.default_key()
+        if entry is None:
+            raise jwt.exceptions.InvalidTokenError(
+                'No verification key for kid {!r}'.format(kid))
+        return entry
+
+    def default_key(self):
+        """Returns key for tokens without `kid`, or None"""
+        # refreshes periodically, as lookups by kid do
+        self.get(None)
+        keys = self.keys
+        entry = keys.get(None)
+        if entry is None and len(keys) == 1:
+            entry = next(iter(keys.values()))
+        return entry
+
+
+##############################################################
+# Token issuance
+##############################################################
+
+class TokenIssuer:
+    """
+    Signs tokens with a key parsed once, under a header encoded once
+
+    With `workers`, `call()` runs signing on a pool of threads, so that
+    bursts of logins queue for the pool instead of taking CPU from
+    every request thread, and at most `max_pending` jobs wait before
+    further ones are rejected.
+
+    :attr access_ttl: Lifetime of access tokens, in seconds
+    :attr refresh_ttl: Lifetime of refresh tokens, in seconds
+    """
+
+    # claims set by the issuer, not carried over on refresh
+    reserved = frozenset(('iat', 'nbf', 'exp', 'jti', 'type'))
+
+    time_claims = ('exp', 'iat', 'nbf')
+
+    def __init__(self, private_key, algorithm:str='RS512', kid=None,
+                 access_ttl:float=900, refresh_ttl:float=86400,
+                 workers:int=0, max_pending:int=1000, clock=time.time):
+        self.algorithm = algorithm
+        self.algo = get_default_algorithms()[algorithm]
+        self.key = load_key(private_key, algorithm)
+        self.kid = kid
+        self.access_ttl = access_ttl
+        self.refresh_ttl = refresh_ttl
+        self.workers = workers
+        self.max_pending = max_pending
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.pool = None
+        self.pid = None
+
+        header = {'alg': algorithm, 'typ': 'JWT'}
+        if kid is not None:
+            header['kid'] = kid
+        self.header = base64url_encode(json.dumps(
+            header, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+
+    def encode(self, claims:dict):
+        """Returns signed token for claims"""
+        for name in self.time_claims:
+            value = claims.get(name)
+            if isinstance(value, datetime):
+                claims = dict(claims)
+                claims[name] = timegm(value.utctimetuple())
+        payload = base64url_encode(json.dumps(
+            claims, separators=(',', ':')).encode('utf-8'))
+        signing_input = self.header + b'.' + payload
+        signature = self.algo.sign(signing_input, self.key)
+        return (signing_input + b'.' + base64url_encode(signature)).decode('ascii')
+
+    def make_claims(self, claims:dict, token_type:str, ttl:float, now:float):
+        claims = dict(claims)
+        claims['iat'] = int(now)
+        claims['exp'] = int(now + ttl)
+        claims['jti'] = uuid4().hex
+        claims['type'] = token_type
+        return claims
+
+    def issue(self, claims:dict, token_type:str='access', ttl:float=None):
+        """Returns token for claims, with issued time, expiry and jti"""
+        if ttl is None:
+            ttl = self.refresh_ttl if token_type == 'refresh' else self.access_ttl
+        return self.encode(self.make_claims(claims, token_type, ttl, self.clock()))
+
+    def issue_pair(self, claims:dict):
+        """Returns access and refresh tokens for claims"""
+        now = self.clock()
+        return dict(
+            access_token=self.encode(self.make_claims(
+                claims, 'access', self.access_ttl, now)),
+            refresh_token=self.encode(self.make_claims(
+                claims, 'refresh', self.refresh_ttl, now)),
+            token_type='Bearer',
+            expires_in=self.access_ttl)
+
+    def issue_many(self, claims_list, token_type:str='access', ttl:float=None):
+        """
+        Returns token for each claims, in order, such as for a fleet of
+        services. Split across the pool when it has several workers
+        """
+        claims_list = list(claims_list)
+        sign = lambda chunk: [ self.issue(claims, token_type, ttl)
+                               for claims in chunk ]
+        if self.workers < 2 or len(claims_list) < 2:
+            return sign(claims_list)
+        size = -(-len(claims_list) // self.workers)
+        pool = self.get_pool()
+        futures = [ pool.submit(sign, claims_list[x:x + size])
+                    for x in range(0, len(claims_list), size) ]
+        return [ token for future in futures for token in future.result() ]
+
+    def get_pool(self):
+        # threads do not survive a fork
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.pending = 0
+                self.pool = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='bottlecap-issuer')
+            return self.pool
+
+    def call(self, fn, *args, timeout:float=None):
+        """
+        Run signing function on the pool, or inline without workers
+
+        :raises TooManyRequestsError: `max_pending` jobs already queued
+        """
+        if not self.workers:
+            return fn(*args)
+        pool = self.get_pool()
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise ex.TooManyRequestsError(headers={'Retry-After': '1'})
+            self.pending += 1
+        try:
+            return pool.submit(fn, *args).result(timeout)
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def shutdown(self):
+        if self.pool is not None and self.pid == os.getpid():
+            self.pool.shutdown()
+            self.pool = None
+            self.pid = None
 
 
 ##############################################################
@@ -79,21 +678,49 @@ class User:
 ##############################################################
 
 
-class JWTAuthPlugin:
+class JWTAuthPlugin(HookPlugin):
     """Extends for JWT authentication support
     """
 
+    name = 'jwtauth'
+
     # XXX: needs type hints
-    def __init__(self, public_key, private_key=None, valsig=True, 
-                 algos=['RS512'], user_model_cls=User):
+    def __init__(self, public_key=None, private_key=None, valsig=True, 
+                 algos=['RS512'], user_model_cls=User, token_cache=True,
+                 keyring=None, kid=None, revocations=None, user_loader=None,
+                 issuer=None):
         """
         XXX: needs docs
+
+        :attr token_cache: True or `TokenCache` to skip verifying tokens
+                           which were verified recently, False to disable
+        :attr keyring: `KeyRing` of verification keys, `public_key` is
+                       added to it
+        :attr kid: Key id of `public_key` and `private_key`, also set in
+                   the header of issued tokens
+        :attr revocations: `RevocationList` checked on every request,
+                           including tokens served from `token_cache`
+        :attr user_loader: `UserLoader` which loads the user named by
+                           the token from a user store, instead of
+                           building it from claims
+        :attr issuer: `TokenIssuer` used by `token_encode()` and
+                      `TokenView`, built from `private_key` by default
         """
+        self.keyring = keyring or KeyRing(algorithm=algos[0])
+        if public_key is not None:
+            public_key = self.keyring.add(kid, public_key)
         self.jwt_public_key = public_key
         self.jwt_private_key = private_key
+        self.jwt_kid = kid
+        self.revocations = revocations
+        self.user_loader = user_loader
+        self._issuer = issuer
         self.jwt_valsig = valsig
         self.jwt_algos = algos
         self.user_model_cls = user_model_cls
+        if token_cache is True:
+            token_cache = TokenCache()
+        self.token_cache = token_cache or None
 
     def get_token_from_request(self):
         """Returns raw token from request headers"""
@@ -116,11 +743,45 @@ class JWTAuthPlugin:
                 error_detail="Request header 'Authorization' contains malformed 'Bearer' token")
 
         # we require a public key to proceed
-        if self.jwt_public_key is None:
+        if not self.keyring.configured:
             raise RuntimeError("BottleCap: JWT Public Key not configured")
 
         return token
 
+    @property
+    def issuer(self):
+        if self._issuer is None:
+            if self.jwt_private_key is None:
+                raise RuntimeError("BottleCap: JWT Private Key not configured")
+            self._issuer = TokenIssuer(self.jwt_private_key,
+                                       algorithm=self.jwt_algos[0], kid=self.jwt_kid)
+        return self._issuer
+
+    def setup(self, app):
+        app.jwt_auth = self
+        RoleCheckPlugin.install_once(app)
+        loader = self.user_loader
+        if loader is not None and loader.metrics is None:
+            loader.metrics = getattr(app, 'metrics', None)
+
+    def get_guid_from_token(self, token):
+        """Returns user guid claimed by token"""
+        try:
+            return UUID(token['user']['guid'])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ex.BadRequestError(
+                error_desc='Request authorization failed',
+                error_detail='Token does not contain a valid user')
+
+    def load_user(self, token):
+        """Lookup user of token with `user_loader`"""
+        user = self.user_loader.get(self.get_guid_from_token(token))
+        if user is None:
+            raise ex.NotAuthenticatedError(error_desc='User does not exist')
+        if user.is_active is False:
+            raise ex.NotAuthorizedError(error_desc='User has been disabled')
+        return user
+
     def get_user_from_token(self, token):
         """Lookup user for request"""
 
@@ -128,59 +789,158 @@ class JWTAuthPlugin:
 
         # convert to a user object
         try:
-            guid = UUID(token.user.guid)
-        except:
-            raise RuntimeError('Malformed JWT')
+            guid = UUID(ttoken.user.guid)
+            roles = ttoken.user.roles
+            is_active = ttoken.user.is_active
+        except (AttributeError, KeyError, TypeError, ValueError):
+            raise ex.BadRequestError(
+                error_desc='Request authorization failed',
+                error_detail='Token does not contain a valid user')
 
-        assert isinstance(ttoken.user.roles, list)
-        assert isinstance(ttoken.user.is_active, bool)
+        if not isinstance(roles, list) or not isinstance(is_active, bool):
+            raise ex.BadRequestError(
+                error_desc='Request authorization failed',
+                error_detail='Token does not contain a valid user')
 
-        user = User(guid=guid,
-                    roles=set(ttoken.user.roles), 
-                    is_active=ttoken.user.is_active)
+        user = self.user_model_cls(guid=guid, roles=roles, is_active=is_active)
 
         # check whether user has been disabled
-        if request.user.is_active is False:
-            raise NotAuthorizedError(error_desc='User has been disabled')
+        if user.is_active is False:
+            raise ex.NotAuthorizedError(error_desc='User has been disabled')
+        return user
+
+    def load_key(self, key):
+        """Parse PEM encoded key into key object for the first algorithm"""
+        return load_key(key, self.jwt_algos[0])
+
+    def warmup(self, app):
+        """Parse signing key and load key ring, rather than on first use"""
+        if self.jwt_private_key is not None or self._issuer is not None:
+            self.jwt_private_key = self.issuer.key
+        self.keyring.refresh()
+        if self.revocations is not None:
+            self.revocations.refresh()
+
+    def close(self):
+        if self.revocations is not None:
+            self.revocations.shutdown()
+        if self._issuer is not None:
+            self._issuer.shutdown()
+
+    def is_revoked(self, token):
+        """Check token against revocation list, by jti or user and iat"""
+        user = token.get('user')
+        guid = user.get('guid') if isinstance(user, dict) else None
+        return self.revocations.is_revoked(
+            jti=token.get('jti'), guid=guid, issued_at=token.get('iat'))
 
     def token_decode(self, token):
         """Wrapper method for decoding JWTs"""
-        return jwt.decode(token, self.jwt_public_key, algorithms=self.jwt_algos)
+        kid = jwt.get_unverified_header(token).get('kid')
+        key, algorithm = self.keyring.find(kid)
+        algorithms = self.jwt_algos
+        if algorithm is not None:
+            if algorithm not in algorithms:
+                raise jwt.exceptions.InvalidAlgorithmError(
+                    'Key {!r} uses disallowed algorithm {}'.format(kid, algorithm))
+            algorithms = [algorithm]
+        return jwt.decode(token, key, algorithms=algorithms)
+
+    def verify_token(self, raw_token):
+        """Decode token, unless it was verified recently"""
+        cache = self.token_cache
+        if cache is None:
+            return self.token_decode(raw_token)
+        token = cache.get(raw_token)
+        if token is None:
+            token = self.token_decode(raw_token)
+            cache.set(raw_token, token)
+        return token
 
     def token_encode(self, data):
         """Wrapper method for encoding JWTs"""
-        return jwt.encode(data, self.jwt_private_key, algorithm=self.jwt_algos[0])
+        return self.issuer.encode(data)
 
-    def apply(self, callback, context):
-
-        def wrapper(*args, **kwargs):
-            # assign defaults
+    def authenticate(self):
+        """Assign user and token to current request"""
+        # assign defaults, keeping a user set by another authenticator
+        if getattr(request, 'user', None) is None:
             request.user = None
-            request.jwt = None
+        request.jwt = None
 
-            # extract raw token from request
-            raw_token = self.get_token_from_request()
-            if raw_token is None: return
+        # extract raw token from request
+        raw_token = self.get_token_from_request()
+        if raw_token is None: return
 
-            # try and decode token
-            try:
-                token = self.token_decode(raw_token)
-            except jwt.exceptions.InvalidTokenError:
-                raise ex.BadRequestError(
-                    error_desc='Request authorization failed',
-                    error_detail="Failed to decode token")
+        # try and decode token
+        try:
+            token = self.verify_token(raw_token)
+        except jwt.exceptions.InvalidTokenError:
+            raise ex.BadRequestError(
+                error_desc='Request authorization failed',
+                error_detail="Failed to decode token")
+
+        if token is None: return
+        if token.get('type') == 'refresh':
+            raise ex.NotAuthenticatedError(
+                error_desc='Refresh tokens cannot authenticate requests')
+        if self.revocations is not None and self.is_revoked(token):
+            raise ex.NotAuthenticatedError(error_desc='Token has been revoked')
+        request.jwt = token
+
+        # users from the loader are cached by the loader, for its ttl
+        if self.user_loader is not None:
+            request.user = self.load_user(token)
+            return
 
-            if token is None: return
-            request.jwt = token
+        # lookup user from token, once per cached token
+        cache = self.token_cache
+        user = cache.get_user(raw_token) if cache is not None else None
+        if user is None:
+            user = self.get_user_from_token(token)
+            if cache is not None:
+                cache.set_user(raw_token, user)
+        request.user = user
 
-            # lookup user from token
-            request.user = self.get_user_from_token(token)
+    def prepare(self, route):
+        return auth_hooks(self.authenticate, route)
 
-            # continue with request
-            return callback(*args, **kwargs)
 
-        return wrapper
-        
+def auth_hooks(authenticate, route):
+    """
+    Returns `RouteHooks` which run `authenticate()`, roles are checked
+    afterwards by `RoleCheckPlugin`
+    """
+    return RouteHooks(before=authenticate, before_phase='auth')
+
+
+class RoleCheckPlugin(HookPlugin):
+    """
+    Checks role requirements of `AuthenticationViewMixin` views, once
+    every authentication plugin has run, and before the request body
+    is parsed. Installed by authentication plugins, so that several of
+    them can be combined on one app.
+    """
+
+    name = 'rolecheck'
+
+    @classmethod
+    def install_once(cls, app):
+        if not any(isinstance(plugin, cls) for plugin in app.plugins):
+            app.install(cls())
+
+    def prepare(self, route):
+        # role requirements of views are compiled once per route
+        view_class = getattr(route.callback, 'view_class', None)
+        if view_class is None or not issubclass(view_class, AuthenticationViewMixin):
+            return None
+
+        check = RoleRequirement.for_view(view_class).check
+
+        def before():
+            check(getattr(request, 'user', None))
+        return RouteHooks(before=before, before_phase='auth', before_order=0.5)
+
 
 class AuthenticationViewMixin:
     """Provides authentication support to Bottle CBVs
@@ -190,22 +950,62 @@ class AuthenticationViewMixin:
     roles_accepted = None
 
     def pre_dispatch(self):
-        # do we require a user to be present?
-        if self.user_required and not isinstance(request.user, User):
-            raise NotAuthenticatedError()
-
-        # user must have ALL these roles
-        if self.roles_required:
-            has_roles = request.user.has_roles(*self.roles_required)
-            if not has_roles:
-                raise NotAuthorizedError()
+        # `RoleCheckPlugin` checks compiled requirements before parsing,
+        # this is only needed for views served without it
+        RoleRequirement.for_view(type(self)).check(getattr(request, 'user', None))
+        pre_dispatch = getattr(super(), 'pre_dispatch', None)
+        if pre_dispatch is not None:
+            pre_dispatch()
 
-        # user must have at least one of these roles
-        if self.roles_accepted:
-            has_roles = request.user.has_any_roles(*self.roles_accepted)
-            if not has_roles:
-                raise NotAuthorizedError()
 
-        super().pre_dispatch()
+class TokenView(View):
+    """
+    Issues access and refresh tokens, with `JWTAuthPlugin.issuer`
 
+    `{"grant_type": "refresh_token", "refresh_token": ...}` exchanges a
+    refresh token for a new pair. Other grants are passed to
+    `authenticate_grant()`, which subclasses implement to check
+    credentials and return the claims of the user. Signing runs on the
+    worker pool of the issuer, when it has one.
+    """
 
+    class Meta:
+        name = 'token'
+        path = '/token'
+        method = ['POST']
+        parser_classes = [JSONParser]
+        renderer_classes = [JSONRenderer]
+
+    def authenticate_grant(self, body):
+        """Returns claims of user for grant, override to support grants"""
+        raise ex.BadRequestError(
+            error_desc='Unsupported grant type',
+            error_detail='Grant type {!r} is not supported'.format(
+                body.get('grant_type')))
+
+    def refresh_grant(self, plugin, body):
+        try:
+            token = plugin.token_decode(str(body.get('refresh_token')))
+        except jwt.exceptions.InvalidTokenError:
+            token = None
+        if not isinstance(token, dict) or token.get('type') != 'refresh':
+            raise ex.NotAuthenticatedError(error_desc='Invalid refresh token')
+        if plugin.revocations is not None and plugin.is_revoked(token):
+            raise ex.NotAuthenticatedError(error_desc='Token has been revoked')
+        if plugin.user_loader is not None:
+            plugin.load_user(token)
+        reserved = plugin.issuer.reserved
+        return { k: v for k, v in token.items() if k not in reserved }
+
+    def dispatch(self):
+        plugin = request.app.jwt_auth
+        body = request.body_parsed
+        if not isinstance(body, dict):
+            raise ex.BadRequestError(error_detail='Expected JSON object')
+
+        if body.get('grant_type') == 'refresh_token':
+            claims = self.refresh_grant(plugin, body)
+        else:
+            claims = self.authenticate_grant(body)
+        issuer = plugin.issuer
+        return issuer.call(issuer.issue_pair, claims)
@@ -0,0 +1,438 @@
+"""
+In-process load generation for BottleCap
+"""
+
+import io
+import os
+import sys
+import json
+import marshal
+import logging
+import threading
+import tracemalloc
+
+from collections import Counter
+from time import monotonic_ns
+from urllib.parse import quote
+
+from bottlecap.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['BenchRequest', 'Benchmark', 'BenchResult', 'RouteStats',
+           'load_requests', 'generate_requests']
+
+
+############################################################
+# Request mix
+############################################################
+
+class BenchRequest:
+    """
+    Request replayed directly through a WSGI callable
+
+    The environ is built once, and copied for each request.
+
+    >>> req = BenchRequest.from_dict({'path': '/users?page=2', 'json': [1]})
+    >>> req.name, req.method, req.environ()['QUERY_STRING']
+    ('POST /users', 'POST', 'page=2')
+    """
+
+    __slots__ = ('name', 'method', 'weight', 'body', 'template')
+
+    def __init__(self, method:str, path:str, headers:dict=None, body:bytes=b'',
+                 name:str=None, weight:int=1):
+        path, _, query = path.partition('?')
+        self.method = method.upper()
+        self.name = name or '{} {}'.format(self.method, path)
+        self.weight = weight
+        self.body = body
+
+        template = {
+            'REQUEST_METHOD': self.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': '127.0.0.1',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if body:
+            template['CONTENT_LENGTH'] = str(len(body))
+        for key, value in (headers or {}).items():
+            key = key.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            template[key] = str(value)
+        self.template = template
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Create from a request mix entry, with keys `method`, `path`,
+        `headers`, `body` or `json`, `name` and `weight`
+        """
+        headers = dict(data.get('headers') or {})
+        body = data.get('body') or b''
+        if 'json' in data:
+            body = json.dumps(data['json'])
+            headers.setdefault('Content-Type', 'application/json')
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        method = data.get('method') or ('POST' if body else 'GET')
+        return cls(method, data['path'], headers=headers, body=body,
+                   name=data.get('name'), weight=int(data.get('weight', 1)))
+
+    def environ(self):
+        environ = self.template.copy()
+        environ['wsgi.input'] = io.BytesIO(self.body)
+        return environ
+
+
+def load_requests(path):
+    """Load request mix from JSON lines, blank and # lines are ignored"""
+    requests = []
+    with open(path, encoding='utf-8') as fh:
+        for lineno, line in enumerate(fh, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                requests.append(BenchRequest.from_dict(json.loads(line)))
+            except (ValueError, KeyError, TypeError) as exc:
+                raise ValueError('{}:{}: invalid request: {}'.format(
+                    path, lineno, exc)) from exc
+    return requests
+
+
+def generate_requests(app):
+    """
+    Generate a GET request for each route without wildcards, as these
+    can be sent without knowing anything about the app
+    """
+    requests = []
+    for route in app.routes:
+        if route.method not in ('GET', 'ANY') or '<' in route.rule:
+            logger.debug('Skipping route %s %s', route.method, route.rule)
+            continue
+        name = 'GET {}'.format(route.name or route.rule)
+        requests.append(BenchRequest('GET', quote(route.rule), name=name))
+    return requests
+
+
+############################################################
+# Execution
+############################################################
+
+def call(app, req):
+    """Send request through app, returns status code or 'error'"""
+    status = []
+
+    def start_response(value, headers, exc_info=None):
+        status.append(value)
+        return lambda data: None
+
+    try:
+        body = app(req.environ(), start_response)
+        try:
+            for chunk in body:
+                pass
+        finally:
+            close = getattr(body, 'close', None)
+            if close is not None:
+                close()
+    except Exception:
+        logger.debug('Request %s failed', req.name, exc_info=True)
+        return 'error'
+    return int(status[0].split(None, 1)[0]) if status else 'error'
+
+
+class RouteStats:
+    """Latency and status counts for one entry of the request mix"""
+
+    __slots__ = ('latency', 'statuses', 'peak_bytes', 'retained_bytes')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses = Counter()
+        self.peak_bytes = None
+        self.retained_bytes = None
+
+    @property
+    def count(self):
+        return self.latency.count
+
+    @property
+    def errors(self):
+        return sum(count for status, count in self.statuses.items()
+                   if status == 'error' or status >= 500)
+
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        self.statuses.update(other.statuses)
+
+    def to_tuple(self):
+        return (self.latency.to_tuple(), dict(self.statuses))
+
+    @classmethod
+    def from_tuple(cls, value):
+        latency, statuses = value
+        stats = cls()
+        stats.latency = Histogram(*latency)
+        stats.statuses.update(statuses)
+        return stats
+
+    def to_dict(self):
+        latency = self.latency
+        return dict(
+            requests=self.count,
+            errors=self.errors,
+            statuses={ str(k): v for k, v in self.statuses.items() },
+            mean_us=latency.sum / latency.count if latency.count else None,
+            p50_us=latency.quantile(0.5),
+            p90_us=latency.quantile(0.9),
+            p99_us=latency.quantile(0.99),
+            max_us=latency.quantile(1.0),
+            peak_bytes=self.peak_bytes,
+            retained_bytes=self.retained_bytes)
+
+
+class BenchResult:
+    """Merged results of all threads and processes"""
+
+    def __init__(self, routes=None, start=None, end=None):
+        self.routes = routes if routes is not None else {}
+        self.start = start
+        self.end = end
+
+    def merge(self, other):
+        for name, stats in other.routes.items():
+            self.stats(name).merge(stats)
+        self.start = min(x for x in (self.start, other.start) if x is not None)
+        self.end = max(x for x in (self.end, other.end) if x is not None)
+
+    def stats(self, name):
+        stats = self.routes.get(name)
+        if stats is None:
+            stats = self.routes[name] = RouteStats()
+        return stats
+
+    @property
+    def total(self):
+        return sum(stats.count for stats in self.routes.values())
+
+    @property
+    def elapsed(self):
+        return (self.end - self.start) / 1e9 if self.start is not None else 0
+
+    @property
+    def throughput(self):
+        return self.total / self.elapsed if self.elapsed else 0
+
+    def dumps(self):
+        routes = { name: stats.to_tuple() for name, stats in self.routes.items() }
+        return marshal.dumps((routes, self.start, self.end))
+
+    @classmethod
+    def loads(cls, data):
+        routes, start, end = marshal.loads(data)
+        routes = { name: RouteStats.from_tuple(value)
+                   for name, value in routes.items() }
+        return cls(routes, start, end)
+
+    def to_dict(self):
+        return dict(
+            requests=self.total,
+            elapsed=self.elapsed,
+            throughput=self.throughput,
+            routes={ name: stats.to_dict() for name, stats in self.routes.items() })
+
+    def format(self):
+        lines = ['{:<40} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10}'.format(
+            'route', 'requests', 'errors', 'p50 us', 'p90 us', 'p99 us',
+            'max us', 'peak B', 'retained B')]
+        for name, stats in sorted(self.routes.items()):
+            latency = stats.latency
+            lines.append('{:<40} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10}'.format(
+                name[:40], stats.count, stats.errors,
+                latency.quantile(0.5), latency.quantile(0.9),
+                latency.quantile(0.99), latency.quantile(1.0),
+                '-' if stats.peak_bytes is None else int(stats.peak_bytes),
+                '-' if stats.retained_bytes is None else int(stats.retained_bytes)))
+        lines.append('{} requests in {:.2f}s, {:.1f} requests/s'.format(
+            self.total, self.elapsed, self.throughput))
+        return '\n'.join(lines)
+
+
+class Benchmark:
+    """
+    Replays a request mix through a WSGI app, without a network
+
+    Requests are sent in a weighted round robin by `threads` threads in
+    each of `processes` forked processes, until `requests` have been
+    sent in total or for `duration` seconds. Latency is recorded into
+    the same histograms as `MetricsPlugin`, so percentiles are upper
+    bounds of buckets.
+
+    Allocations are measured separately with tracemalloc, from a single
+    thread, as tracing slows down every allocation in the process.
+    """
+
+    def __init__(self, app, requests, threads:int=1, processes:int=1,
+                 warmup:int=10):
+        if not requests:
+            raise ValueError('No requests to send')
+        if processes > 1 and not hasattr(os, 'fork'):
+            raise ValueError('Multiple processes require fork')
+        self.app = app
+        self.requests = requests
+        self.threads = max(threads, 1)
+        self.processes = max(processes, 1)
+        self.warmup = warmup
+        self.schedule = [ req for req in requests for x in range(req.weight) ]
+
+    def run_thread(self, offset, count, deadline, result):
+        app, schedule = self.app, self.schedule
+        size = len(schedule)
+        routes = {}
+        index = offset
+        sent = 0
+        while True:
+            if count is not None and sent >= count:
+                break
+            if deadline is not None and monotonic_ns() >= deadline:
+                break
+            req = schedule[index % size]
+            start = monotonic_ns()
+            status = call(app, req)
+            elapsed = (monotonic_ns() - start) // 1000
+
+            stats = routes.get(req.name)
+            if stats is None:
+                stats = routes[req.name] = RouteStats()
+            stats.latency.record(elapsed)
+            stats.statuses[status] += 1
+            index += 1
+            sent += 1
+        result.append(routes)
+
+    def run_process(self, offset, count, duration):
+        """Run threads of this process, returns BenchResult"""
+        threads = []
+        results = []
+        start = monotonic_ns()
+        deadline = start + int(duration * 1e9) if duration else None
+        for x in range(self.threads):
+            thread_count = None
+            if count is not None:
+                thread_count = count // self.threads + (x < count % self.threads)
+            thread = threading.Thread(
+                target=self.run_thread, name='bottlecap-bench',
+                args=(offset + x * len(self.schedule) // self.threads,
+                      thread_count, deadline, results))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        result = BenchResult(start=start, end=monotonic_ns())
+        for routes in results:
+            result.merge(BenchResult(routes, start, result.end))
+        return result
+
+    def run_processes(self, count, duration):
+        children = []
+        for x in range(self.processes):
+            process_count = None
+            if count is not None:
+                process_count = count // self.processes + (x < count % self.processes)
+            reader, writer = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    os.close(reader)
+                    result = self.run_process(x * self.threads, process_count,
+                                              duration)
+                    with os.fdopen(writer, 'wb') as fh:
+                        fh.write(result.dumps())
+                except Exception:
+                    logger.exception('Benchmark process failed')
+                    code = 1
+                finally:
+                    os._exit(code)
+            os.close(writer)
+            children.append((pid, reader))
+
+        result = BenchResult()
+        for pid, reader in children:
+            with os.fdopen(reader, 'rb') as fh:
+                data = fh.read()
+            _, status = os.waitpid(pid, 0)
+            if not data or os.WIFSIGNALED(status) or os.WEXITSTATUS(status):
+                raise RuntimeError('Benchmark process {} failed'.format(pid))
+            result.merge(BenchResult.loads(data))
+        return result
+
+    def run(self, requests:int=None, duration:float=None,
+            allocations:bool=True, rounds:int=20):
+        """
+        Send `requests` in total, or for `duration` seconds
+
+        :returns: BenchResult
+        """
+        if requests is None and duration is None:
+            requests = 1000
+        for req in self.requests:
+            for x in range(self.warmup):
+                call(self.app, req)
+
+        if self.processes > 1:
+            result = self.run_processes(requests, duration)
+        else:
+            result = self.run_process(0, requests, duration)
+
+        if allocations:
+            for name, (peak, retained) in self.measure_allocations(rounds).items():
+                stats = result.stats(name)
+                stats.peak_bytes = peak
+                stats.retained_bytes = retained
+        return result
+
+    def measure_allocations(self, rounds:int=20):
+        """
+        Returns {name: (peak_bytes, retained_bytes)}, averaged per request
+
+        Peak is the most memory allocated at once while handling a
+        request, retained is memory still allocated afterwards.
+        """
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        try:
+            measured = {}
+            for req in self.requests:
+                call(self.app, req)
+                peak = retained = 0
+                for x in range(rounds):
+                    before = tracemalloc.get_traced_memory()[0]
+                    tracemalloc.reset_peak()
+                    call(self.app, req)
+                    current, highest = tracemalloc.get_traced_memory()
+                    peak += highest - before
+                    retained += current - before
+                totals = measured.get(req.name, (0, 0, 0))
+                measured[req.name] = (totals[0] + peak, totals[1] + retained,
+                                      totals[2] + rounds)
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+        return { name: (peak / n, retained / n)
+                 for name, (peak, retained, n) in measured.items() }
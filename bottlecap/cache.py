@@ -0,0 +1,394 @@
+"""
+Response caching for BottleCap
+
+Views opt in with `Meta.cache_ttl`. Rendered responses of GET requests
+are stored by `ResponseCache`, so that a hit skips both dispatch and
+rendering. Entries are grouped by tags, and `invalidate()` drops every
+entry of a tag, typically from the view which changed the data.
+"""
+
+import zlib
+import mmap
+import struct
+import marshal
+import hashlib
+import logging
+import threading
+import multiprocessing
+
+from time import time
+from collections import OrderedDict
+from bottle import request
+
+from bottlecap.negotiation import RenderedResponse
+from bottlecap.singleflight import auth_scope
+from bottlecap.hooks import HookPlugin, RouteHooks, get_meta
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ResponseCache', 'MemoryBackend', 'SharedMemoryBackend',
+           'ResponseCachePlugin', 'invalidate']
+
+
+def invalidate(*tags):
+    """Invalidate cached responses with any of tags, on current app"""
+    cache = getattr(request.app, 'response_cache', None)
+    if cache is not None:
+        cache.invalidate(*tags)
+
+
+############################################################
+# Backends
+############################################################
+
+class MemoryBackend:
+    """
+    In-process LRU of entries, bounded by approximate size in bytes
+
+    Tags are versioned, invalidating a tag bumps its version, and
+    entries stored with an older version are dropped on lookup. As with
+    `SharedMemoryBackend`, versions are counters in a fixed table, tags
+    which share a counter are invalidated together.
+    """
+
+    # bookkeeping per entry, beyond its body and headers
+    overhead = 256
+
+    def __init__(self, max_bytes:int=64 * 1024 * 1024, tag_slots:int=4096,
+                 clock=time):
+        self.max_bytes = max_bytes
+        self.tag_slots = tag_slots
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.versions = [0] * tag_slots
+        self.size = 0
+        self.evictions = 0
+
+    @classmethod
+    def entry_size(cls, entry):
+        status, headers, body, tags, versions = entry
+        return (cls.overhead + len(body) +
+                sum(len(name) + len(value) for name, value in headers))
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            expires, entry, size = item
+            if expires <= self.clock():
+                del self.entries[key]
+                self.size -= size
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def delete(self, key):
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is not None:
+                self.size -= item[2]
+
+    def set(self, key, entry, ttl):
+        size = self.entry_size(entry)
+        if size > self.max_bytes:
+            return False
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[key] = (self.clock() + ttl, entry, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                key, (expires, entry, size) = self.entries.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+        return True
+
+    def tag_slot(self, tag):
+        return zlib.crc32(tag.encode('utf-8')) % self.tag_slots
+
+    def tag_versions(self, tags):
+        versions = self.versions
+        return tuple(versions[self.tag_slot(tag)] for tag in tags)
+
+    def invalidate(self, tags):
+        with self.lock:
+            for tag in tags:
+                self.versions[self.tag_slot(tag)] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return dict(entries=len(self.entries), bytes=self.size,
+                    evictions=self.evictions)
+
+
+class SharedMemoryBackend:
+    """
+    Entries in fixed size slots of anonymous shared memory, visible to
+    all prefork workers
+
+    Must be created before workers are forked. Each key maps to a single
+    slot, and replaces whatever it held. Entries larger than a slot are
+    not cached. Tag versions are counters in a separate table, tags
+    which share a counter are invalidated together.
+    """
+
+    header = struct.Struct('20sdI')
+    counter = struct.Struct('Q')
+
+    def __init__(self, slots:int=4096, slot_size:int=16 * 1024,
+                 tag_slots:int=4096, lock_stripes:int=64, clock=time):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.tag_slots = tag_slots
+        self.clock = clock
+        self.mmap = mmap.mmap(-1, slots * slot_size)
+        self.tags = mmap.mmap(-1, tag_slots * self.counter.size)
+        self.locks = [ multiprocessing.Lock() for x in range(lock_stripes) ]
+        self.tag_lock = multiprocessing.Lock()
+
+    def slot(self, key):
+        index = int.from_bytes(key[:8], 'little') % self.slots
+        return index, self.locks[index % len(self.locks)]
+
+    def get(self, key):
+        index, lock = self.slot(key)
+        offset = index * self.slot_size
+        with lock:
+            stored, expires, length = self.header.unpack_from(self.mmap, offset)
+            if stored != key or not length or expires <= self.clock():
+                return None
+            start = offset + self.header.size
+            data = self.mmap[start:start + length]
+        return marshal.loads(data)
+
+    def set(self, key, entry, ttl):
+        data = marshal.dumps(entry)
+        if len(data) > self.slot_size - self.header.size:
+            return False
+        index, lock = self.slot(key)
+        offset = index * self.slot_size
+        start = offset + self.header.size
+        with lock:
+            self.header.pack_into(self.mmap, offset, key,
+                                  self.clock() + ttl, len(data))
+            self.mmap[start:start + len(data)] = data
+        return True
+
+    def delete(self, key):
+        index, lock = self.slot(key)
+        offset = index * self.slot_size
+        with lock:
+            stored, expires, length = self.header.unpack_from(self.mmap, offset)
+            if stored == key:
+                self.header.pack_into(self.mmap, offset, b'', 0, 0)
+
+    def tag_offset(self, tag):
+        return (zlib.crc32(tag.encode('utf-8')) % self.tag_slots) * self.counter.size
+
+    def tag_versions(self, tags):
+        return tuple(self.counter.unpack_from(self.tags, self.tag_offset(tag))[0]
+                     for tag in tags)
+
+    def invalidate(self, tags):
+        with self.tag_lock:
+            for tag in tags:
+                offset = self.tag_offset(tag)
+                version, = self.counter.unpack_from(self.tags, offset)
+                self.counter.pack_into(self.tags, offset, version + 1)
+
+    def clear(self):
+        for index in range(self.slots):
+            with self.locks[index % len(self.locks)]:
+                self.header.pack_into(self.mmap, index * self.slot_size,
+                                      b'', 0, 0)
+
+    def stats(self):
+        return dict(slots=self.slots, slot_size=self.slot_size)
+
+
+############################################################
+# Response cache
+############################################################
+
+class ResponseCache:
+    """
+    Rendered responses, stored in `backend` with their tags
+
+    Entries are `(status, headers, body, tags, versions)`, where
+    versions are those of the tags when the response was rendered, so
+    responses invalidated while rendering are never served. Entries
+    with outdated versions are deleted from the backend when looked up.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def get(self, key):
+        """Returns cached `RenderedResponse`, or None"""
+        entry = self.backend.get(key)
+        if entry is not None:
+            status, headers, body, tags, versions = entry
+            if self.backend.tag_versions(tags) == tuple(versions):
+                self.hits += 1
+                return RenderedResponse(body, status, list(headers))
+            self.backend.delete(key)
+        self.misses += 1
+        return None
+
+    def versions(self, tags):
+        return self.backend.tag_versions(tags)
+
+    def set(self, key, resp, ttl:float, tags=(), versions=None):
+        """
+        Store rendered response, unless it cannot be shared
+
+        :returns: True if response was stored
+        """
+        body = resp.body
+        if resp.status_code != 200 or not isinstance(body, (str, bytes)):
+            return False
+        headers = resp.headerlist
+        if any(name.lower() == 'set-cookie' for name, value in headers):
+            return False
+        tags = tuple(tags)
+        if versions is None:
+            versions = self.versions(tags)
+        entry = (resp.status_code, tuple(headers), body, tags, tuple(versions))
+        stored = self.backend.set(key, entry, ttl)
+        if stored:
+            self.stores += 1
+        return stored
+
+    def invalidate(self, *tags):
+        """Drop cached responses with any of tags"""
+        self.backend.invalidate(tags)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        stats = dict(hits=self.hits, misses=self.misses, stores=self.stores)
+        stats.update(self.backend.stats())
+        return stats
+
+
+############################################################
+# Plugin
+############################################################
+
+class ResponseCachePlugin(HookPlugin):
+    """
+    Serves GET requests of views from `ResponseCache`, for views which
+    enable it with
+
+        class Meta:
+            cache_ttl = 60
+            cache_vary = ['Accept-Language']
+            cache_scope = 'credentials'
+            cache_tags = ['items', 'item:{id}']
+
+    Responses are keyed by route, url args, query string, negotiated
+    media type, the values of `cache_vary` headers, and `cache_scope`:
+
+    `credentials`
+        Request credentials, as with `CoalescingPlugin`, the default
+    `user`
+        Guid of `request.user`, shared between tokens of a user
+    `public`
+        Shared by every client
+
+    Tags are formatted with url args. Lookups run after authentication
+    and role checks, so a hit is served only to authorized requests.
+    Installed by `BottleCap(response_cache=...)`, after negotiation.
+    """
+
+    name = 'response_cache'
+
+    scopes = ('credentials', 'user', 'public')
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else ResponseCache()
+        self.metrics = None
+
+    def setup(self, app):
+        app.response_cache = self.cache
+        self.metrics = getattr(app, 'metrics', None)
+
+    def count(self, result):
+        if self.metrics is not None:
+            self.metrics.count('response_cache', result=result)
+
+    def get_key(self, label, vary, scope):
+        parts = [label, repr(sorted(request.url_args.items())),
+                 request.query_string, str(request.nctx.response_content_type)]
+        parts.extend(request.headers.get(name, '') for name in vary)
+        if scope == 'credentials':
+            parts.append(auth_scope())
+        elif scope == 'user':
+            user = getattr(request, 'user', None)
+            parts.append(str(user.guid) if user is not None else '')
+        return hashlib.sha1('\0'.join(parts).encode('utf-8')).digest()
+
+    def prepare(self, route):
+        ttl = get_meta(route, 'cache_ttl')
+        if not ttl:
+            return None
+        label = route.name or route.rule
+        vary = tuple(get_meta(route, 'cache_vary') or ())
+        scope = get_meta(route, 'cache_scope') or 'credentials'
+        if scope not in self.scopes:
+            raise ValueError('Unknown cache scope {!r} for route {}'.format(
+                scope, label))
+        tags = tuple(get_meta(route, 'cache_tags') or ())
+        cache = self.cache
+
+        def get_tags():
+            if not tags:
+                return ()
+            url_args = request.url_args
+            return tuple(tag.format(**url_args) for tag in tags)
+
+        def before():
+            if request.method not in ('GET', 'HEAD'):
+                return None
+            key = self.get_key(label, vary, scope)
+            resp = cache.get(key)
+            if resp is not None:
+                self.count('hit')
+                return resp
+            self.count('miss')
+
+            # versions before dispatch, so that invalidations during it
+            # are not masked by the stored entry
+            entry_tags = get_tags()
+            request.environ['bottlecap.cache'] = (
+                key, entry_tags, cache.versions(entry_tags))
+            return None
+
+        def after(resp):
+            state = request.environ.pop('bottlecap.cache', None)
+            if state is None:
+                return resp
+
+            # render here, so the stored response is the rendered one
+            resp = request.nctx.negotiator.render_response(resp)
+            key, entry_tags, versions = state
+            cache.set(key, resp, ttl, entry_tags, versions)
+            return resp
+
+        def error(exc):
+            request.environ.pop('bottlecap.cache', None)
+
+        # after authentication, so role checks are never skipped
+        return RouteHooks(before=before, after=after, error=error,
+                          before_phase='cache', before_order=1)
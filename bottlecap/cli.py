@@ -0,0 +1,185 @@
+"""
+Management CLI for BottleCap
+"""
+
+import code
+import json
+import click
+
+
+@click.group()
+def cli(): # pragma: no cover
+    pass
+
+@cli.command(name='runserver', help='Start development server')
+@click.argument('app', type=str)
+@click.option('--host', '-h',
+    default='127.0.0.1', type=str,
+    help='Server hostname/IP')
+@click.option('--port', '-p',
+    default=8080, type=int,
+    help='Server port')
+@click.option('--reloader/--no-reloader',
+    default=True,
+    help='restart the server when modules are changed')
+@click.option('--interval',
+    type=float, default=1,
+    help='the interval for the reloader in seconds')
+@click.option('--debug/--no-debug',
+    default=True,
+    help='show tracebacks of errors in responses')
+@click.option('--quiet', '-q',
+    is_flag=True, default=False,
+    help='do not log requests')
+def cli_runserver(app, **kwargs): # pragma: no cover
+    import bottle
+    from bottlecap.server import load_app
+    bottle.run(load_app(app), **kwargs)
+
+
+@cli.command(name='serve', help='Start prefork production server')
+@click.argument('app', type=str)
+@click.option('--host', '-h',
+    default='127.0.0.1', type=str,
+    help='Server hostname/IP')
+@click.option('--port', '-p',
+    default=8080, type=int,
+    help='Server port')
+@click.option('--workers', '-w',
+    default=None, type=int,
+    help='number of worker processes, defaults to number of CPUs')
+@click.option('--worker-class',
+    type=click.Choice(['sync', 'threaded']), default='sync',
+    help='serve one request at a time, or use a thread pool per worker')
+@click.option('--threads',
+    default=8, type=int,
+    help='threads per worker, for threaded workers')
+@click.option('--reuse-port/--shared-socket',
+    default=None,
+    help='bind each worker with SO_REUSEPORT, or accept from one socket '
+         'bound by the master. Defaults to SO_REUSEPORT where supported')
+@click.option('--max-requests',
+    default=0, type=int,
+    help='recycle workers after this many requests, zero to disable')
+@click.option('--max-requests-jitter',
+    default=0, type=int,
+    help='add up to this many requests to --max-requests, per worker')
+@click.option('--max-rss',
+    default=None, type=int,
+    help='recycle workers once resident memory exceeds this many megabytes')
+@click.option('--graceful-timeout',
+    default=30, type=float,
+    help='seconds to wait for workers to drain on SIGTERM')
+@click.option('--warmup/--no-warmup',
+    default=True,
+    help='prepare routes and plugins before forking workers')
+def cli_serve(app, worker_class, threads, max_rss, **kwargs): # pragma: no cover
+    from bottlecap.server import PreforkServer, load_app
+    threads = threads if worker_class == 'threaded' else 0
+    max_rss = max_rss * 1024 * 1024 if max_rss else None
+    PreforkServer(load_app(app), threads=threads, max_rss=max_rss,
+                  **kwargs).run()
+
+
+@cli.command(name='ishell', help='Start IPython shell')
+def cli_ishell(ctx): # pragma: no cover
+    from IPython import start_ipython
+    start_ipython(argv=[])
+
+
+@cli.command(name='shell', help='Start python shell')
+def cli_shell(ctx): # pragma: no cover
+    code.interact(local=locals())
+
+
+@cli.command(name='profile', help='Summarise sampled request profiles')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--route', '-r',
+    default=None, type=str,
+    help='only show profiles of routes containing this name')
+@click.option('--sort', '-s',
+    default='cumulative', type=str,
+    help='pstats sort key')
+@click.option('--limit', '-l',
+    default=25, type=int,
+    help='number of functions to show per route')
+@click.option('--collapsed', '-c',
+    type=click.File('w'), default=None,
+    help='write merged collapsed stacks to this file, e.g. for flamegraph.pl')
+def cli_profile(directory, route, sort, limit, collapsed): # pragma: no cover
+    from bottlecap.profiling import load_profiles
+    for name, (stats, stacks) in sorted(load_profiles(directory).items()):
+        if route and route not in name:
+            continue
+        click.echo('==> {}'.format(name))
+        if stats is not None:
+            stats.sort_stats(sort).print_stats(limit)
+        for stack, count in stacks.most_common(limit):
+            click.echo('{:>8} {}'.format(count, stack.rsplit(';', 1)[-1]))
+        if collapsed is not None:
+            for stack, count in sorted(stacks.items()):
+                collapsed.write('{} {}\n'.format(stack, count))
+
+
+@cli.command(name='bench', help='Benchmark app in-process, without a network')
+@click.argument('app', type=str)
+@click.option('--requests-file', '-f',
+    type=click.Path(exists=True, dir_okay=False), default=None,
+    help='JSON lines request mix, defaults to GET of each route without wildcards')
+@click.option('--requests', '-n',
+    default=None, type=int,
+    help='total number of requests to send, defaults to 1000')
+@click.option('--duration', '-d',
+    default=None, type=float,
+    help='send requests for this many seconds, instead of --requests')
+@click.option('--threads', '-t',
+    default=1, type=int,
+    help='threads per process')
+@click.option('--processes', '-P',
+    default=1, type=int,
+    help='number of forked processes')
+@click.option('--warmup',
+    default=10, type=int,
+    help='requests sent to each entry of the mix before measuring')
+@click.option('--allocations/--no-allocations',
+    default=True,
+    help='measure memory allocated per request with tracemalloc')
+@click.option('--json', 'as_json',
+    is_flag=True, default=False,
+    help='print results as JSON')
+def cli_bench(app, requests_file, threads, processes, warmup, as_json,
+              **kwargs): # pragma: no cover
+    from bottlecap.bench import Benchmark, load_requests, generate_requests
+    from bottlecap.server import load_app
+    app = load_app(app)
+    if requests_file:
+        requests = load_requests(requests_file)
+    else:
+        requests = generate_requests(app)
+    result = Benchmark(app, requests, threads=threads, processes=processes,
+                       warmup=warmup).run(**kwargs)
+    if as_json:
+        click.echo(json.dumps(result.to_dict(), indent=2))
+    else:
+        click.echo(result.format())
+
+
+@cli.command(name='startup-report',
+             help='Show import and app construction time per module and route')
+@click.argument('app', type=str)
+@click.option('--limit', '-l',
+    default=25, type=int,
+    help='number of modules to show')
+@click.option('--sort', '-s',
+    type=click.Choice(['self', 'cumulative']), default='self',
+    help='sort modules by own import time, or including their imports')
+@click.option('--json', 'as_json',
+    is_flag=True, default=False,
+    help='print report as JSON')
+def cli_startup_report(app, limit, sort, as_json): # pragma: no cover
+    from bottlecap.startup import startup_report
+    report = startup_report(app)
+    if as_json:
+        click.echo(json.dumps(report.to_dict(), indent=2))
+    else:
+        click.echo(report.format(limit=limit, sort=sort))
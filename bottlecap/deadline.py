@@ -0,0 +1,98 @@
+"""
+Request deadlines for BottleCap
+"""
+
+from time import monotonic
+from bottle import request
+
+from bottlecap import exceptions as ex
+from bottlecap.hooks import HookPlugin, RouteHooks, get_meta
+
+__all__ = ['Deadline', 'DeadlinePlugin', 'time_remaining']
+
+
+def time_remaining(default:float=None):
+    """
+    Returns seconds left before the deadline of the current request,
+    or `default` when there is none
+    """
+    try:
+        deadline = request.deadline
+    except (AttributeError, RuntimeError):
+        return default
+    return deadline.remaining if deadline is not None else default
+
+
+class Deadline:
+    """
+    Time budget for a single request, available as `request.deadline`
+    """
+
+    def __init__(self, timeout:float, start:float=None):
+        self.timeout = timeout
+        self.start = monotonic() if start is None else start
+        self.expires = self.start + timeout
+
+    def __repr__(self):
+        return "Deadline(timeout={}, remaining={:.3f})".format(
+            self.timeout, self.remaining)
+
+    @property
+    def remaining(self):
+        """Seconds left before deadline, never negative"""
+        return max(0.0, self.expires - monotonic())
+
+    @property
+    def expired(self):
+        return monotonic() >= self.expires
+
+    def check(self):
+        """Raise `DeadlineExceededError` if deadline has passed"""
+        if monotonic() >= self.expires:
+            raise ex.DeadlineExceededError()
+
+
+class DeadlinePlugin(HookPlugin):
+    """
+    Assigns a `Deadline` to every request
+
+    The timeout is the shortest of the client `X-Request-Timeout`
+    header, `Meta.timeout` on the view (or `default_timeout`), and the
+    server cap `max_timeout`. Malformed header values are ignored.
+
+    Deadlines are enforced by content negotiation, which rejects the
+    request before parsing the body, and drops any response which
+    became ready after the deadline passed.
+    """
+
+    name = 'deadline'
+
+    def __init__(self, default_timeout:float=None, max_timeout:float=None,
+                 header:str='X-Request-Timeout'):
+        self.default_timeout = default_timeout
+        self.max_timeout = max_timeout
+        self.header = header
+
+    def get_client_timeout(self):
+        """Returns timeout requested by client, if any"""
+        value = request.headers.get(self.header)
+        if not value: return None
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+        return value if value >= 0 else None
+
+    def get_deadline(self, timeout=None):
+        """Returns deadline for current request, if any"""
+        timeouts = [ x for x in (self.get_client_timeout(), timeout,
+                     self.max_timeout) if x is not None ]
+        return Deadline(min(timeouts)) if timeouts else None
+
+    def prepare(self, route):
+        timeout = get_meta(route, 'timeout')
+        timeout = self.default_timeout if timeout is None else timeout
+
+        def before():
+            request.deadline = self.get_deadline(timeout)
+        return RouteHooks(before=before)
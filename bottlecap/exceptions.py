@@ -3,8 +3,11 @@
 class BaseError(Exception):
     """Base exception class"""
 
+    # Extra response headers, e.g. Retry-After
+    headers = None
+
     def __init__(self, status_code:int=None, error_code:str=None, error_desc:str=None, 
-                 error_detail=None, original_exc:Exception=None):
+                 error_detail=None, original_exc:Exception=None, headers:dict=None):
         super().__init__(self)
 
         if status_code is not None: 
@@ -14,6 +17,9 @@ class BaseError(Exception):
         if error_desc is not None:
             self.error_desc = error_desc
 
+        if headers is not None:
+            self.headers = headers
+
         self.error_detail = error_detail
         self.original_exc = original_exc
 
@@ -69,3 +75,17 @@ class NotAuthorizedError(ClientError):
     error_code = "auth_error"
     error_desc = "Client has insufficient authorization"
 
+
+
+class TooManyRequestsError(ClientError):
+    """Request was rate limited"""
+    status_code = 429
+    error_code = "rate_limited"
+    error_desc = "Too many requests, please try again later"
+
+
+class DeadlineExceededError(ServerError):
+    """Request deadline passed before a response was ready"""
+    status_code = 504
+    error_code = "deadline_exceeded"
+    error_desc = "Request could not be completed within its deadline"
@@ -0,0 +1,194 @@
+"""
+Route compilation for BottleCap
+
+Plugins which implement `HookPlugin` do not wrap the route callback
+with nested closures. Instead they return `RouteHooks` for each route,
+and `RouteCompilerPlugin` fuses the hooks of every such plugin into a
+single generated handler per route.
+"""
+
+__all__ = ['RouteHooks', 'HookPlugin', 'RouteCompilerPlugin',
+           'compile_handler', 'get_meta']
+
+
+def get_meta(route, key, default=None):
+    """Returns field from view `Meta` of route"""
+    return route.config.get('meta.' + key, default)
+
+
+class RouteHooks:
+    """
+    Hooks provided by a plugin for a single route
+
+    before()
+        Runs before dispatch, in plugin order. Returning anything other
+        than None skips dispatch and any remaining `before` hooks, and
+        is used as the response.
+
+    after(resp)
+        Runs after dispatch, in reverse plugin order, and returns the
+        (possibly replaced) response.
+
+    error(exc)
+        Runs when any hook or dispatch raises, in reverse plugin order.
+        Raising from this hook replaces the exception which is passed
+        to remaining hooks, and eventually raised.
+
+    `before_phase` and `after_phase` name the request phase which a
+    hook represents, and are used when timing is enabled.
+
+    `before_order` moves a `before` hook after those with a lower
+    order, regardless of plugin order. Request bodies are parsed with
+    order 1, so that checks such as authentication run first, and role
+    requirements are checked in between with order 0.5.
+    """
+
+    def __init__(self, before=None, after=None, error=None,
+                 before_phase=None, after_phase=None, before_order=0):
+        self.before = before
+        self.after = after
+        self.error = error
+        self.before_phase = before_phase
+        self.after_phase = after_phase
+        self.before_order = before_order
+
+
+class HookPlugin:
+    """
+    Base class for BottleCap-aware plugins
+    """
+
+    api = 2
+    name = None
+
+    def prepare(self, route):
+        """
+        Returns `RouteHooks` for route, or None if plugin does
+        not apply to this route
+        """
+        return None
+
+    def apply(self, callback, route):
+        # hooks are fused by the route compiler where available
+        if getattr(route.app, 'route_compiler', None):
+            return callback
+        hooks = self.prepare(route)
+        return compile_handler(callback, [hooks]) if hooks else callback
+
+
+def flatten_hooks(hooks):
+    """Plugins may return a single `RouteHooks`, or a list of them"""
+    for h in hooks:
+        if isinstance(h, (list, tuple)):
+            yield from flatten_hooks(h)
+        elif h is not None:
+            yield h
+
+
+def compile_handler(callback, hooks, view_class=None, timer=None):
+    """
+    Generate single callable which runs hooks around callback
+
+    :attr callback: Route callback, called with url args
+    :attr hooks: List of `RouteHooks`, outermost first
+    :attr view_class: Instantiate and call CBV directly, instead
+                      of calling `callback`
+    :attr timer: Records phase timings, see `TimingPlugin`. When not
+                 given, no timing code is generated at all
+    """
+    hooks = list(flatten_hooks(hooks))
+    before = [ (h.before, h.before_phase)
+               for h in sorted(hooks, key=lambda h: h.before_order) if h.before ]
+    after = [ (h.after, h.after_phase) for h in reversed(hooks) if h.after ]
+    error = [ h.error for h in reversed(hooks) if h.error ]
+    if not (before or after or error or view_class or timer):
+        return callback
+
+    ns = dict(callback=callback, view_class=view_class, timer=timer)
+    lines = ['def handler(**url_args):']
+    indent = '    '
+
+    def emit(stmt, phase=None, check=''):
+        if timer and phase:
+            stmt = ('t = clock(); {}; timings[{!r}] = timings.get({!r}, 0) '
+                    '+ clock() - t').format(stmt, phase, phase)
+        lines.append(indent + check + stmt)
+
+    if timer:
+        ns['clock'] = timer.clock
+        ns['environ_of'] = timer.environ_of
+        lines.append('    timings = environ_of()["bottlecap.timings"] = {}')
+        lines.append('    start = clock()')
+
+    if error or timer:
+        lines.append('    try:')
+        indent = '        '
+
+    # before hooks may short-circuit the remaining hooks and dispatch
+    check = ''
+    for i, (hook, phase) in enumerate(before):
+        ns['before%d' % i] = hook
+        emit('resp = before%d()' % i, phase, check)
+        check = 'if resp is None: '
+
+    call = 'view_class(**url_args)()' if view_class else 'callback(**url_args)'
+    emit('resp = ' + call, 'dispatch', check)
+
+    for i, (hook, phase) in enumerate(after):
+        ns['after%d' % i] = hook
+        emit('resp = after%d(resp)' % i, phase)
+
+    if timer:
+        lines.append(indent + 'return timer.finish(timings, start, resp)')
+    else:
+        lines.append(indent + 'return resp')
+
+    if error or timer:
+        lines.append('    except Exception as exc:')
+        for i, hook in enumerate(error):
+            ns['error%d' % i] = hook
+            lines.append('        try: error%d(exc)' % i)
+            lines.append('        except Exception as nexc: exc = nexc')
+        if timer:
+            lines.append('        timer.finish(timings, start, exc)')
+        lines.append('        raise exc')
+
+    source = '\n'.join(lines) + '\n'
+    code = compile(source, '<bottlecap route {!r}>'.format(
+        getattr(callback, '__name__', callback)), 'exec')
+    exec(code, ns)
+    handler = ns['handler']
+    handler.source = source
+    return handler
+
+
+class RouteCompilerPlugin:
+    """
+    Fuses hooks from all `HookPlugin` instances of a route into a
+    single handler. Must be installed before any other plugin, so it
+    is applied last. Plugins which do not support hooks have already
+    wrapped the callback by then, so they always run innermost.
+    """
+
+    api = 2
+    name = 'compiler'
+
+    def setup(self, app):
+        app.route_compiler = self
+
+    def apply(self, callback, route):
+        plugins = [ p for p in route.all_plugins() if isinstance(p, HookPlugin) ]
+        hooks = [ p.prepare(route) for p in reversed(plugins) ]
+
+        # timing code is only generated when a timing plugin applies
+        timer = None
+        for plugin in plugins:
+            if hasattr(plugin, 'get_route_timer'):
+                timer = plugin.get_route_timer(route)
+
+        # call CBVs directly, unless wrapped by other plugins
+        view_class = None
+        if callback is route.callback:
+            view_class = getattr(callback, 'view_class', None)
+        return compile_handler(callback, hooks, view_class=view_class,
+                               timer=timer)
@@ -0,0 +1,548 @@
+"""
+Request metrics for BottleCap
+"""
+
+import os
+import mmap
+import struct
+import marshal
+import logging
+import weakref
+import threading
+import multiprocessing
+
+from time import sleep, monotonic_ns
+from bottle import request, HTTPResponse
+
+from bottlecap.views import View
+from bottlecap.hooks import HookPlugin, RouteHooks
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Histogram', 'MetricsRegistry', 'SharedMetrics', 'MetricsPlugin',
+           'MetricsView']
+
+
+############################################################
+# Histograms
+############################################################
+
+class Histogram:
+    """
+    Log-linear latency histogram, in microseconds
+
+    Each power of two is split into `SUB_BUCKETS` linear buckets, so
+    the relative error of any recorded value is bounded by 25%, from
+    one microsecond up to `MAX_VALUE`. Larger values are clamped into
+    the last bucket.
+
+    >>> [ Histogram.bucket_index(v) for v in (0, 3, 4, 7, 8, 9, 10, 16) ]
+    [0, 3, 4, 7, 8, 8, 9, 12]
+    >>> [ Histogram.bucket_upper(i) for i in (0, 3, 7, 8, 9, 12) ]
+    [1, 4, 8, 10, 12, 20]
+    """
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    SUB_BITS = 2
+    SUB_BUCKETS = 1 << SUB_BITS
+    EXPONENTS = 24
+    BUCKETS = SUB_BUCKETS * (EXPONENTS + 1)
+    MAX_VALUE = (2 * SUB_BUCKETS) << (EXPONENTS - 1)
+
+    def __init__(self, counts=None, count=0, sum=0):
+        self.counts = counts if counts is not None else [0] * self.BUCKETS
+        self.count = count
+        self.sum = sum
+
+    @classmethod
+    def bucket_index(cls, value):
+        if value < cls.SUB_BUCKETS:
+            return value
+        exp = value.bit_length() - cls.SUB_BITS - 1
+        if exp >= cls.EXPONENTS:
+            return cls.BUCKETS - 1
+        return cls.SUB_BUCKETS * (exp + 1) + (value >> exp) - cls.SUB_BUCKETS
+
+    @classmethod
+    def bucket_upper(cls, index):
+        """Exclusive upper bound of bucket"""
+        if index < cls.SUB_BUCKETS:
+            return index + 1
+        exp, sub = divmod(index - cls.SUB_BUCKETS, cls.SUB_BUCKETS)
+        return (cls.SUB_BUCKETS + sub + 1) << exp
+
+    def record(self, value):
+        self.counts[self.bucket_index(value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        """Upper bound of bucket holding the q-th quantile"""
+        target = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return self.bucket_upper(index)
+        return 0
+
+    def cumulative(self):
+        """Yields (upper, count) at each power of two, for export"""
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if index >= self.SUB_BUCKETS and \
+                    index % self.SUB_BUCKETS == self.SUB_BUCKETS - 1:
+                yield self.bucket_upper(index), seen
+
+    def to_tuple(self):
+        return (list(self.counts), self.count, self.sum)
+
+
+############################################################
+# Metrics registry
+############################################################
+
+class ThreadMetrics:
+    """Metrics written by a single thread, read without locking"""
+
+    __slots__ = ('requests', 'latency', 'in_flight', 'counters', 'observed')
+
+    def __init__(self):
+        self.requests = {}
+        self.latency = {}
+        self.in_flight = {}
+        self.counters = {}
+        self.observed = {}
+
+    def snapshot(self):
+        return dict(requests=self.requests.copy(), latency=self.latency.copy(),
+                    in_flight=self.in_flight.copy(),
+                    counters=self.counters.copy(), observed=self.observed.copy())
+
+
+def empty_snapshot():
+    return dict(requests={}, latency={}, in_flight={}, counters={}, observed={})
+
+
+def merge_histograms(target, histograms):
+    for key, value in histograms.items():
+        hist = target.get(key)
+        if hist is None:
+            hist = target[key] = Histogram()
+        hist.merge(value if isinstance(value, Histogram) else Histogram(*value))
+
+
+def merge_snapshot(target, snapshot):
+    """Merge plain snapshot into target, used across threads and workers"""
+    requests = target['requests']
+    for key, count in snapshot['requests'].items():
+        requests[key] = requests.get(key, 0) + count
+
+    in_flight = target['in_flight']
+    for key, count in snapshot['in_flight'].items():
+        in_flight[key] = in_flight.get(key, 0) + count
+
+    counters = target['counters']
+    for key, count in snapshot.get('counters', {}).items():
+        counters[key] = counters.get(key, 0) + count
+
+    merge_histograms(target['latency'], snapshot['latency'])
+    merge_histograms(target['observed'], snapshot.get('observed', {}))
+    return target
+
+
+class MetricsRegistry:
+    """
+    Request counts, in-flight gauges and latency histograms, labelled
+    by route and negotiated media type, and counters and histograms
+    recorded by plugins with `count()` and `observe()`
+
+    Each thread records into its own `ThreadMetrics` without locks, and
+    threads are merged when collected. Metrics of threads which have
+    exited are folded into a baseline, so that thread-per-request
+    servers do not accumulate them. Pass `SharedMetrics` to also
+    aggregate across prefork workers.
+    """
+
+    def __init__(self, shared=None):
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.reset()
+
+        # metrics of the parent process are not inherited by workers
+        ref = weakref.ref(self)
+        def after_fork():
+            registry = ref()
+            if registry is not None: registry.reset()
+        os.register_at_fork(after_in_child=after_fork)
+
+    def reset(self):
+        self.local = threading.local()
+        self.threads = []
+        self.prune_at = 64
+        self.baseline = empty_snapshot()
+
+    def thread_metrics(self):
+        try:
+            return self.local.metrics
+        except AttributeError:
+            pass
+        metrics = self.local.metrics = ThreadMetrics()
+        with self.lock:
+            self.threads.append((weakref.ref(threading.current_thread()), metrics))
+            if len(self.threads) >= self.prune_at:
+                self.prune()
+                self.prune_at = max(64, 2 * len(self.threads))
+        if self.shared is not None:
+            self.shared.start(self)
+        return metrics
+
+    def begin(self, route):
+        """Mark request as in-flight, returns start time"""
+        in_flight = self.thread_metrics().in_flight
+        in_flight[route] = in_flight.get(route, 0) + 1
+        return monotonic_ns()
+
+    def finish(self, route, media_type, status, start):
+        """Record completed request"""
+        duration = monotonic_ns() - start
+        metrics = self.thread_metrics()
+        metrics.in_flight[route] -= 1
+
+        key = (route, media_type, '{}xx'.format(status // 100))
+        metrics.requests[key] = metrics.requests.get(key, 0) + 1
+
+        key = (route, media_type)
+        hist = metrics.latency.get(key)
+        if hist is None:
+            hist = metrics.latency[key] = Histogram()
+        hist.record(duration // 1000)
+
+    def count(self, name, n:int=1, **labels):
+        """Increment counter, exported as `bottlecap_<name>_total`"""
+        counters = self.thread_metrics().counters
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + n
+
+    def observe(self, name, duration_us:int, **labels):
+        """Record duration, exported as `bottlecap_<name>_seconds`"""
+        observed = self.thread_metrics().observed
+        key = (name, tuple(sorted(labels.items())))
+        hist = observed.get(key)
+        if hist is None:
+            hist = observed[key] = Histogram()
+        hist.record(int(duration_us))
+
+    def prune(self):
+        """Fold metrics of exited threads into baseline, holding lock"""
+        live = []
+        for ref, metrics in self.threads:
+            thread = ref()
+            if thread is not None and thread.is_alive():
+                live.append((ref, metrics))
+                continue
+            merge_snapshot(self.baseline, metrics.snapshot())
+        self.threads = live
+
+    def snapshot(self):
+        """Merged metrics of this process, as plain data"""
+        with self.lock:
+            self.prune()
+            result = merge_snapshot(empty_snapshot(), self.baseline)
+            threads = [ metrics for ref, metrics in self.threads ]
+        for metrics in threads:
+            merge_snapshot(result, metrics.snapshot())
+        for field in ('latency', 'observed'):
+            result[field] = { key: hist.to_tuple()
+                              for key, hist in result[field].items() }
+        return result
+
+    def collect(self):
+        """Merged metrics of all workers"""
+        if self.shared is None:
+            return merge_snapshot(empty_snapshot(), self.snapshot())
+        self.shared.publish(self.snapshot())
+        return self.shared.collect()
+
+    def render(self):
+        """Returns metrics in Prometheus text format"""
+        return render_prometheus(self.collect())
+
+
+############################################################
+# Prefork aggregation
+############################################################
+
+class SharedMetrics:
+    """
+    Aggregates metrics of prefork workers through shared memory
+
+    Must be created before workers are forked. Each worker claims a
+    slot, and a background thread publishes its snapshot into the slot
+    every `interval` seconds, as well as on each scrape. A worker which
+    replaces a dead one inherits its counters, so that totals never
+    decrease when workers are recycled.
+    """
+
+    header = struct.Struct('qI')
+
+    def __init__(self, workers:int=16, slot_size:int=256*1024,
+                 interval:float=1.0):
+        self.workers = workers
+        self.slot_size = slot_size
+        self.interval = interval
+        self.claim_lock = multiprocessing.Lock()
+        self.locks = [ multiprocessing.Lock() for x in range(workers) ]
+        self.mmap = mmap.mmap(-1, workers * slot_size)
+        self.slot = None
+        self.pid = None
+
+    def read_slot(self, index):
+        offset = index * self.slot_size
+        pid, length = self.header.unpack_from(self.mmap, offset)
+        if not length:
+            return pid, None
+        start = offset + self.header.size
+        return pid, marshal.loads(self.mmap[start:start + length])
+
+    def write_slot(self, index, pid, snapshot):
+        data = marshal.dumps(snapshot) if snapshot is not None else b''
+        if len(data) > self.slot_size - self.header.size:
+            logger.warning('BottleCap: metrics snapshot exceeds slot size')
+            return
+        offset = index * self.slot_size
+        with self.locks[index]:
+            self.header.pack_into(self.mmap, offset, pid, len(data))
+            start = offset + self.header.size
+            self.mmap[start:start + len(data)] = data
+
+    def claim(self, registry):
+        """Claim free slot for this process, inheriting dead workers"""
+        pid = os.getpid()
+        with self.claim_lock:
+            for index in range(self.workers):
+                with self.locks[index]:
+                    owner, snapshot = self.read_slot(index)
+                if owner and pid_alive(owner):
+                    continue
+                if snapshot is not None:
+                    snapshot['in_flight'] = {}
+                    merge_snapshot(registry.baseline, snapshot)
+                self.write_slot(index, pid, None)
+                return index
+        raise RuntimeError('BottleCap: no free metrics slots, increase workers')
+
+    def start(self, registry):
+        """Claim slot and start publisher, once per process"""
+        pid = os.getpid()
+        with registry.lock:
+            if self.pid == pid:
+                return
+            self.pid = pid
+            self.slot = self.claim(registry)
+
+        # publish inherited counters before they are next scraped
+        self.publish(registry.snapshot())
+        ref = weakref.ref(registry)
+        thread = threading.Thread(target=self.run, args=(ref,),
+                                  name='bottlecap-metrics', daemon=True)
+        thread.start()
+
+    def run(self, ref):
+        pid = os.getpid()
+        while self.pid == pid:
+            registry = ref()
+            if registry is None:
+                return
+            self.publish(registry.snapshot())
+            del registry
+            sleep(self.interval)
+
+    def publish(self, snapshot):
+        if self.slot is not None:
+            self.write_slot(self.slot, os.getpid(), snapshot)
+
+    def collect(self):
+        result = empty_snapshot()
+        for index in range(self.workers):
+            with self.locks[index]:
+                owner, snapshot = self.read_slot(index)
+            if snapshot is not None:
+                merge_snapshot(result, snapshot)
+        return result
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+############################################################
+# Prometheus export
+############################################################
+
+def escape_label(value):
+    r"""
+    >>> escape_label('say "hi"')
+    'say \\"hi\\"'
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(**labels):
+    """
+    >>> format_labels(route='hello', le='+Inf')
+    '{route="hello",le="+Inf"}'
+    >>> format_labels()
+    ''
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, escape_label(v))
+                          for k, v in labels.items()) + '}'
+
+
+def render_prometheus(snapshot):
+    lines = [
+        '# HELP bottlecap_requests_total Completed requests',
+        '# TYPE bottlecap_requests_total counter']
+    for (route, media_type, status), count in sorted(snapshot['requests'].items()):
+        labels = format_labels(route=route, media_type=media_type, status=status)
+        lines.append('bottlecap_requests_total{} {}'.format(labels, count))
+
+    lines += [
+        '# HELP bottlecap_requests_in_flight Requests currently being handled',
+        '# TYPE bottlecap_requests_in_flight gauge']
+    for route, count in sorted(snapshot['in_flight'].items()):
+        labels = format_labels(route=route)
+        lines.append('bottlecap_requests_in_flight{} {}'.format(labels, count))
+
+    name = 'bottlecap_request_duration_seconds'
+    lines += [
+        '# HELP {} Request latency'.format(name),
+        '# TYPE {} histogram'.format(name)]
+    for (route, media_type), hist in sorted(snapshot['latency'].items()):
+        for upper, count in hist.cumulative():
+            labels = format_labels(route=route, media_type=media_type,
+                                   le='{:g}'.format(upper / 1e6))
+            lines.append('{}_bucket{} {}'.format(name, labels, count))
+        labels = format_labels(route=route, media_type=media_type, le='+Inf')
+        lines.append('{}_bucket{} {}'.format(name, labels, hist.count))
+        labels = format_labels(route=route, media_type=media_type)
+        lines.append('{}_sum{} {}'.format(name, labels, hist.sum / 1e6))
+        lines.append('{}_count{} {}'.format(name, labels, hist.count))
+
+    seen = set()
+    for (name, labels), count in sorted(snapshot['counters'].items()):
+        name = 'bottlecap_{}_total'.format(name)
+        if name not in seen:
+            seen.add(name)
+            lines.append('# TYPE {} counter'.format(name))
+        lines.append('{}{} {}'.format(name, format_labels(**dict(labels)), count))
+
+    for (name, labels), hist in sorted(snapshot['observed'].items()):
+        name = 'bottlecap_{}_seconds'.format(name)
+        if name not in seen:
+            seen.add(name)
+            lines.append('# TYPE {} histogram'.format(name))
+        labels = dict(labels)
+        for upper, count in hist.cumulative():
+            lines.append('{}_bucket{} {}'.format(name, format_labels(
+                **labels, le='{:g}'.format(upper / 1e6)), count))
+        lines.append('{}_bucket{} {}'.format(
+            name, format_labels(**labels, le='+Inf'), hist.count))
+        lines.append('{}_sum{} {}'.format(name, format_labels(**labels),
+                                          hist.sum / 1e6))
+        lines.append('{}_count{} {}'.format(name, format_labels(**labels),
+                                            hist.count))
+
+    return '\n'.join(lines) + '\n'
+
+
+############################################################
+# Plugin and view
+############################################################
+
+class MetricsPlugin(HookPlugin):
+    """
+    Records metrics for every route, labelled by route name (or rule)
+    and negotiated response media type
+
+    Installed by `BottleCap(metrics=...)` directly after the route
+    compiler, so latency includes negotiation and rendering, and status
+    is taken from the rendered response or error.
+    """
+
+    name = 'metrics'
+
+    def __init__(self, registry=None):
+        self.registry = registry if registry is not None else MetricsRegistry()
+
+    def setup(self, app):
+        app.metrics = self.registry
+
+    def prepare(self, route):
+        label = route.name or route.rule
+        registry = self.registry
+
+        def media_type():
+            nctx = getattr(request, 'nctx', None)
+            if nctx is None or nctx.response_content_type is None:
+                return ''
+            return str(nctx.response_content_type)
+
+        def before():
+            request.environ['bottlecap.metrics'] = registry.begin(label)
+
+        def after(resp):
+            status = resp.status_code if isinstance(resp, HTTPResponse) else 200
+            registry.finish(label, media_type(), status,
+                            request.environ['bottlecap.metrics'])
+            return resp
+
+        def error(exc):
+            status = exc.status_code if isinstance(exc, HTTPResponse) else 500
+            registry.finish(label, media_type(), status,
+                            request.environ['bottlecap.metrics'])
+
+        return RouteHooks(before=before, after=after, error=error)
+
+
+class MetricsView(View):
+    """
+    Serves metrics of the app in Prometheus text format
+
+    Skips all plugins, so scrapes are neither negotiated nor counted.
+    Responds with 404 when metrics are not enabled on the app.
+    """
+
+    class Meta:
+        name = 'metrics'
+        path = '/metrics'
+        method = ['GET']
+        skip = True
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def dispatch(self):
+        metrics = getattr(request.app, 'metrics', None)
+        if metrics is None:
+            return HTTPResponse('Metrics are not enabled\n', 404,
+                                headers={'Content-Type': self.content_type})
+        return HTTPResponse(metrics.render(),
+                            headers={'Content-Type': self.content_type})
@@ -1,8 +1,10 @@
+import weakref
 import functools
+import threading
 
-from six import with_metaclass
 from json import JSONDecoder, JSONEncoder
-from bottle import HTTPResponse, HTTPError, request
+from collections import OrderedDict
+from bottle import HTTPResponse, HTTPError, PluginError, request
 from helpful import (ClassDict, NoneType, makelist, 
     iter_ensure_instance, ensure_instance, flatteniter, 
     get_exception)
@@ -13,12 +15,13 @@ from bottlecap.mediatype import *
 
 from functools import wraps
 from bottlecap import exceptions as ex
+from bottlecap.hooks import HookPlugin, RouteHooks, get_meta
 
 
 __all__ = ['BaseRenderer', 'Renderer', 'PlainTextRenderer', 'HTMLRenderer',
            'JSONRenderer', 'BaseParser', 'Parser', 'OctetStreamParser',
            'JSONParser', 'FormParser', 'ContentNegotiationContext', 
-           'ContentNegotiation', 'ContentNegotiationPlugin']
+           'ContentNegotiation', 'ContentNegotiationPlugin', 'RenderedResponse']
 
 ############################################################
 # Renderers
@@ -34,7 +37,7 @@ class BaseRenderer(type):
         return obj
 
 
-class Renderer(with_metaclass(BaseRenderer)):
+class Renderer(metaclass=BaseRenderer):
     media_types = None
     default_media_type = None
     charset = None
@@ -89,7 +92,7 @@ class BaseParser(type):
         return obj
 
 
-class Parser(with_metaclass(BaseParser)):
+class Parser(metaclass=BaseParser):
     media_types = None
 
     @classmethod
@@ -160,6 +163,16 @@ class ContentNegotiationContext:
     negotiator = None
 
 
+class RenderedResponse(HTTPResponse):
+    """
+    Response which has already been rendered, and must not be
+    rendered again
+    """
+
+    exception = None
+    traceback = None
+
+
 class ContentNegotiation:
     """
     Class based decorator for content negotiation
@@ -169,6 +182,10 @@ class ContentNegotiation:
     renderer_classes = None
     mismatch_renderer_class = None
 
+    # number of distinct Accept headers to cache selections for, least
+    # recently used headers are dropped beyond it
+    accept_cache_size = 256
+
     def __init__(self, parser_classes=None, renderer_classes=None,
                  mismatch_renderer_class=None):
         if parser_classes is not None:
@@ -177,6 +194,8 @@ class ContentNegotiation:
             self.renderer_classes = renderer_classes
         if mismatch_renderer_class is not None:
             self.mismatch_renderer_class = mismatch_renderer_class
+        self.accept_cache = OrderedDict()
+        self.accept_lock = threading.Lock()
 
     def guess_content_type(self, body):
         """
@@ -215,13 +234,58 @@ class ContentNegotiation:
                 return renderer, matched[1]
         return None, None
 
+    def negotiate_accept(self, raw_accept):
+        """
+        Parse Accept header and select renderer for it. Results are
+        cached per header value, and must not be modified.
+
+        :returns: (MediaTypeList, renderer, media_type)
+        """
+        cache = self.accept_cache
+        cached = cache.get(raw_accept)
+        if cached is not None:
+            with self.accept_lock:
+                if raw_accept in cache:
+                    cache.move_to_end(raw_accept)
+            return cached
+
+        try:
+            accept = MediaTypeList(raw_accept)
+        except ParseError as e:
+            raise ex.ClientError(
+                status_code='400 Invalid Accept',
+                error_code='bad_request',
+                error_desc="The request header 'Accept' was malformed")
+
+        renderer, media_type = None, None
+        if accept:
+            renderer, media_type = self.select_renderer(accept)
+
+        result = (accept, renderer, media_type)
+        with self.accept_lock:
+            cache[raw_accept] = result
+            while len(cache) > self.accept_cache_size:
+                cache.popitem(last=False)
+        return result
+
+    def warmup(self, accept_headers):
+        """Populate selection cache with common Accept headers"""
+        headers = list(accept_headers)
+        for renderer in self.renderer_classes or []:
+            headers += [ str(m) for m in renderer.media_types ]
+        for raw_accept in headers:
+            try:
+                self.negotiate_accept(raw_accept)
+            except ex.ClientError:
+                pass
+
     def __call__(self, fn):
         @functools.wraps(fn)
         def wrapper(*args, **kwargs):
             try:
                 self.process_request()
                 resp = fn(*args, **kwargs)
-                return self.render_response(resp)
+                return self.process_response(resp)
             except Exception as exc:
                 self.handle_exception(exc)
                 raise
@@ -241,11 +305,21 @@ class ContentNegotiation:
 
         # BaseError should be rendered into new HTTPError
         if isinstance(exc, ex.BaseError):
-            nexc = HTTPError(exc.status_code, exc.to_dict(), exception=exc)
-            nresp = renderer(nexc)
-            raise nresp
+            nexc = HTTPError(exc.status_code, exc.to_dict(), exception=exc,
+                             headers=exc.headers)
+            raise renderer(nexc) if renderer else nexc
+
+    def check_deadline(self):
+        """Reject request if its deadline has passed"""
+        deadline = getattr(request, 'deadline', None)
+        if deadline is not None:
+            deadline.check()
 
     def process_request(self):
+        self.process_headers()
+        self.process_body()
+
+    def process_headers(self):
         # ensure content negotiation has not already been applied
         if hasattr(request, 'nctx'):
             raise RuntimeError('Content negotiation applied twice on same request')
@@ -255,14 +329,9 @@ class ContentNegotiation:
         nctx.negotiator = self
 
         # determine which content types are accepted by the client
-        try:
-            raw_accept = request.headers.get('Accept', '*/*')
-            nctx.request_accept = MediaTypeList(raw_accept)
-        except ParseError as e:
-            raise ex.ClientError(
-                status_code='400 Invalid Accept',
-                error_code='bad_request',
-                error_desc="The request header 'Accept' was malformed")
+        raw_accept = request.headers.get('Accept', '*/*')
+        nctx.request_accept, renderer, media_type = \
+            self.negotiate_accept(raw_accept)
 
         # determine what content type is sent by the request
         try:
@@ -277,7 +346,6 @@ class ContentNegotiation:
 
         # looks like content negotiation is enabled on this view
         request.body_parsed = None
-        body = request._get_body_string()
 
         # assign default renderer class
         if self.mismatch_renderer_class:
@@ -286,8 +354,7 @@ class ContentNegotiation:
 
         # find appropriate renderer
         if nctx.request_accept:
-            nctx.renderer, nctx.response_content_type = \
-                self.select_renderer(nctx.request_accept)
+            nctx.renderer, nctx.response_content_type = renderer, media_type
             
             # could not negotiate an appropriate renderer
             if (not nctx.renderer and self.renderer_classes \
@@ -298,8 +365,15 @@ class ContentNegotiation:
                     error_desc="The server could not negotiate response content based " \
                                "on the 'Accept-*' request headers")
 
+    def process_body(self):
+        nctx = request.nctx
+
+        # avoid reading body if client has already given up
+        self.check_deadline()
+        body = request._get_body_string()
+
         # attempt to guess content type if necessary
-        if body and not raw_content_type:
+        if body and not nctx.request_content_type:
             nctx.request_content_type = self.guess_content_type(body)
 
         # find appropriate content parser
@@ -324,14 +398,27 @@ class ContentNegotiation:
                     error_desc='There was an error parsing the request body',
                     error_detail=str(exc))
 
+    def process_response(self, resp):
+        # drop responses which are no longer wanted by client
+        self.check_deadline()
+        return self.render_response(resp)
+
     def render_response(self, resp):
+        # response may have been rendered already, e.g. when coalesced
+        if isinstance(resp, RenderedResponse):
+            return resp
+
         # always ensure we have a http response instance
         if not isinstance(resp, HTTPResponse):
             resp = HTTPResponse(resp)
 
         # create new response type
-        nresp = HTTPResponse()
+        nresp = RenderedResponse()
         resp.apply(nresp)
+
+        # keep original exception of errors, e.g. for reporting
+        nresp.exception = getattr(resp, 'exception', None)
+        nresp.traceback = getattr(resp, 'traceback', None)
         if not request.nctx.renderer: return nresp
 
         # apply rendering
@@ -347,12 +434,33 @@ class ContentNegotiation:
         return nresp
 
 
-class ContentNegotiationPlugin:
+# Accept headers sent by common browsers and HTTP clients
+COMMON_ACCEPT_HEADERS = [
+    '*/*',
+    'application/json',
+    'application/json, text/plain, */*',
+    'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'text/plain']
+
+
+class ContentNegotiationPlugin(HookPlugin):
     """
     Plugin for Content Negotiation
     """
-    def __init__(self, negotiation_class=ContentNegotiation):
+
+    name = 'negotiation'
+
+    def __init__(self, negotiation_class=ContentNegotiation,
+                 warmup_accept_headers=COMMON_ACCEPT_HEADERS):
         self.negotiation_class = negotiation_class
+        self.warmup_accept_headers = warmup_accept_headers
+        self.negotiators = weakref.WeakSet()
+
+    def warmup(self, app):
+        """Pre-select renderers of every route for common Accept headers"""
+        for cneg in list(self.negotiators):
+            cneg.warmup(self.warmup_accept_headers)
 
     def setup(self, app):
         # ensure this plugin isn't already installed
@@ -361,17 +469,22 @@ class ContentNegotiationPlugin:
             if isinstance(other, ContentNegotiationPlugin):
                 raise PluginError('ContentNegotiationPlugin already installed on app')
 
-    def apply(self, callback, context):
+    def prepare(self, route):
         # should we use view specific negotiation or default?
-        cfg = context['config']
-        cls = cfg.meta.content_negotiation_class
+        cls = get_meta(route, 'content_negotiation_class')
         cls = cls if cls else self.negotiation_class
 
         # create negotiation instance
-        cneg = cls(parser_classes=cfg.meta.parser_classes,
-                   renderer_classes=cfg.meta.renderer_classes,
-                   mismatch_renderer_class=cfg.meta.mismatch_renderer_class)
-
-        # do we have a renderer?
-        return cneg(callback)
-
+        cneg = cls(parser_classes=get_meta(route, 'parser_classes'),
+                   renderer_classes=get_meta(route, 'renderer_classes'),
+                   mismatch_renderer_class=get_meta(route, 'mismatch_renderer_class'))
+        self.negotiators.add(cneg)
+
+        return [RouteHooks(before=cneg.process_headers,
+                           error=cneg.handle_exception,
+                           before_phase='negotiate'),
+                RouteHooks(before=cneg.process_body,
+                           after=cneg.process_response,
+                           before_phase='parse',
+                           after_phase='render',
+                           before_order=1)]
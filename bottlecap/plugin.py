@@ -1,52 +1,140 @@
-import code
-import click
-import json
-import inspect
+import gc
 import bottle
 
-from six.moves.urllib.parse import urljoin
-from bottle import Bottle, request, HTTPError, HTTPResponse
-from decimal import Decimal
-from helpful import ensure_subclass, extend_instance
+from urllib.parse import urlencode, urljoin
+from bottle import (Bottle, LocalRequest, DictProperty, RouteBuildError,
+    request, HTTPError, HTTPResponse)
+from helpful import ensure_subclass
 from bottlecap import exceptions as ex
 from blinker import signal
 
+from bottlecap.hooks import RouteCompilerPlugin
 from bottlecap.negotiation import ContentNegotiationPlugin
+from bottlecap.deadline import DeadlinePlugin
+from bottlecap.tasks import TaskQueue
+from bottlecap.singleflight import CoalescingPlugin
+from bottlecap.reporting import ExceptionReporter, ExceptionReportingPlugin
 from bottlecap.views import View
 
+############################################################
+# URL building
+############################################################
+
+class URLBuilder(object):
+    """
+    Builds URL path for a named route using a precompiled template,
+    equivalent to `Router.build()` with leading slashes removed. Paths
+    are not normalized, see `needs_join()`
+
+    >>> builder = URLBuilder([(None, '/users/'), ('id', str), (None, '/%')])
+    >>> builder(id=10)
+    'users/10/%'
+    >>> builder(id=10, page=2)
+    'users/10/%?page=2'
+    >>> builder()
+    Traceback (most recent call last):
+    bottle.RouteBuildError: Missing URL argument: 'id'
+    """
+
+    def __init__(self, builder):
+        template = []
+        self.wildcards = []
+        for key, value in builder:
+            if key:
+                template.append('%s')
+                self.wildcards.append((key, value))
+            else:
+                template.append(value.replace('%', '%%'))
+
+        # leading slashes can only be removed from a literal at compile time
+        self.lstrip = bool(builder) and builder[0][0] is not None
+        if not self.lstrip and template:
+            template[0] = template[0].lstrip('/')
+            # a literal of only slashes leaves the next value leading
+            self.lstrip = not template[0]
+        self.template = ''.join(template)
+
+    def __call__(self, *anons, **query):
+        for i, value in enumerate(anons): query['anon%d' % i] = value
+        try:
+            url = self.template % tuple([ f(query.pop(key))
+                for key, f in self.wildcards ])
+        except KeyError as exc:
+            raise RouteBuildError('Missing URL argument: %r' % exc.args[0])
+        if self.lstrip:
+            url = url.lstrip('/')
+        return url if not query else url + '?' + urlencode(query)
+
+    @staticmethod
+    def needs_join(url):
+        """
+        True if url has empty or dot segments, or may have a scheme,
+        which `urljoin()` would resolve
+        """
+        return ('//' in url or '/.' in url or url.startswith('.') or
+                ':' in url)
+
+
 ############################################################
 # Bottle Cap mixin
 ############################################################
 
 class RequestMixin(object):
-    @property
+    @DictProperty('environ', 'bottlecap.request.base_url', read_only=True)
     def base_url(self):
         """
-        Return base URL constructed from current request
+        Return base URL constructed from current request,
+        cached for the lifetime of the request
         """
-        url = "{}://{}".format(
-            request.urlparts.scheme,
-            request.urlparts.hostname)
-        port = request.urlparts.port
-        # XXX: needs test
+        urlparts = self.urlparts
+        url = "{}://{}".format(urlparts.scheme, urlparts.hostname)
+        port = urlparts.port
         if port and port not in (80, 443):
             url += ":{}".format(port)
         return url
 
+    @DictProperty('environ', 'bottlecap.request.url_prefix', read_only=True)
+    def url_prefix(self):
+        """
+        Return base URL including script name, e.g. https://example.com/app/
+        cached for the lifetime of the request
+        """
+        script_name = self.environ.get('SCRIPT_NAME', '').strip('/')
+        prefix = self.base_url + '/'
+        return prefix + script_name + '/' if script_name else prefix
+
     def get_full_url(self, routename, **kwargs):
         """
         Construct full URL using components from current
-        bottle request, merged with get_url()
+        bottle request, equivalent to joining base URL with get_url()
 
         For example:
         https://example.com/hello?world=1
-
-        XXX: Needs UT
         """
-        url = self.app.get_url(routename, **kwargs)
-        return urljoin(self.base_url, url)
+        url = self.app.get_url_builder(routename)(**kwargs)
+        if URLBuilder.needs_join(url):
+            return urljoin(self.url_prefix, url)
+        return self.url_prefix + url
+
+
+class BottleCapRequest(RequestMixin, LocalRequest):
+    """
+    Thread local request with BottleCap helpers. The global
+    `bottle.request` instance is switched to this class once, see
+    `install_request_class()`
+    """
 
 
+def install_request_class():
+    """
+    Switch global `bottle.request` to `BottleCapRequest`
+
+    Assigning attributes on `bottle.request` stores them in the
+    environ of the current request, so `__class__` must be set
+    directly on the object
+    """
+    if not isinstance(request, BottleCapRequest):
+        object.__setattr__(request, '__class__', BottleCapRequest)
 
 
 ############################################################
@@ -55,49 +143,144 @@ class RequestMixin(object):
 
 class BottleCap(Bottle):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, request_timeout=None, max_request_timeout=None,
+                 metrics=None, access_log=None, response_cache=None, **kwargs):
+        """
+        :attr request_timeout: Default deadline for views without `Meta.timeout`
+        :attr max_request_timeout: Server cap on deadline of any request
+        :attr metrics: True or `MetricsRegistry` to record request metrics,
+                       available as `app.metrics`, see `MetricsView`
+        :attr access_log: `AccessLogWriter`, or path/stream to write
+                          structured access log records to
+        :attr response_cache: True or `ResponseCache` to cache responses
+                              of views with `Meta.cache_ttl`, available
+                              as `app.response_cache`
+        """
         super().__init__(*args, **kwargs)
         self.signal_exception = signal('exception')
+        self.signal_timing = signal('timing')
+
+        # precompiled builders for named routes
+        self.url_builders = {}
+
+        # post-response background tasks, see `View.defer()`
+        self.tasks = TaskQueue()
+
+        # add helpers such as `request.base_url`
+        install_request_class()
 
         # disable all existing plugins
         self.plugins = []
+
+        # fuse hooks of BottleCap plugins into one handler per route,
+        # must be installed first so it is applied last
+        self.install(RouteCompilerPlugin())
+
+        # server errors are sent to `signal_exception` in batches,
+        # from a background thread
+        self.exception_reporter = ExceptionReporter(self.signal_exception,
+                                                    sender=self)
+        self.install(ExceptionReportingPlugin(self.exception_reporter))
+
+        # record metrics around all other plugins
+        self.metrics = None
+        if metrics:
+            from bottlecap.metrics import MetricsPlugin, MetricsRegistry
+            registry = metrics if isinstance(metrics, MetricsRegistry) else None
+            self.install(MetricsPlugin(registry))
+
+        # structured access log, written from a background thread
+        self.access_log = None
+        if access_log is not None:
+            from bottlecap.accesslog import AccessLogWriter, AccessLogPlugin
+            if not isinstance(access_log, AccessLogWriter):
+                access_log = AccessLogWriter(access_log)
+            self.install(AccessLogPlugin(access_log))
+
+        # install deadline plugin, must be applied before negotiation
+        dp = DeadlinePlugin(default_timeout=request_timeout,
+                            max_timeout=max_request_timeout)
+        self.install(dp)
         
         # install content negotiation plugin
         cnp = ContentNegotiationPlugin()
         self.install(cnp)
 
+        # install request coalescing, enabled by `Meta.coalesce`
+        self.install(CoalescingPlugin())
+
+        # cache rendered responses, enabled by `Meta.cache_ttl`
+        self.response_cache = None
+        if response_cache:
+            from bottlecap.cache import ResponseCachePlugin, ResponseCache
+            cache = response_cache if isinstance(response_cache, ResponseCache) else None
+            self.install(ResponseCachePlugin(cache))
+
         # we must always disable autojson
         #app.config['json.disable'] = True
         #app.config['json.enable'] = False
         #app.config['autojson'] = False
 
-    def apply(self, callback, context):
-        def wrapper(*args, **kwargs):
-            # XXX: for some reason, we cannot use extend_instance on request :X
-            request.base_url = RequestMixin.base_url
-            request.get_full_url = RequestMixin.get_full_url
-
-            # process request
-            return callback(*args, **kwargs)
-        return wrapper
-
-    #def handle_exception(self, exc):
-    #    """
-    #    BottleCap becomes the default handler for all exceptions and
-    #    never passes them upstream, effectively eliminating catchall
-    #    functionality
-    #    """
-    #    # All exceptions are passed to subscribers for processing
-    #    self.signal_exception.send(exc)
-        # All other exceptions should be converted into HTTPError
-        #if request.app.catchall is True:
-        #    nexc = ex.ServerError()
-        #    raise HTTPError(nexc.status_code, nexc.to_dict())
+    def add_route(self, route):
+        # names may be rebound to new rules
+        self.url_builders.clear()
+        return super().add_route(route)
+
+    def get_url_builder(self, routename):
+        """Return precompiled `URLBuilder` for a named route"""
+        try:
+            return self.url_builders[routename]
+        except KeyError:
+            pass
+        builder = self.router.builder.get(routename)
+        if builder is None:
+            raise RouteBuildError("No route with that name.", routename)
+        self.url_builders[routename] = url_builder = URLBuilder(builder)
+        return url_builder
+
+    def _handle(self, environ):
+        out = super()._handle(environ)
+
+        # hand off deferred tasks once the response is ready
+        tasks = environ.pop('bottlecap.tasks', None)
+        if tasks and getattr(out, 'status_code', 200) < 400:
+            for fn, args, kwargs in tasks:
+                self.tasks.submit_nowait(fn, *args, **kwargs)
+        return out
+
+    def warmup(self, freeze:bool=True):
+        """
+        Prepare routes and plugins ahead of the first request
+
+        Should be called before forking workers, so that workers share
+        prepared state copy-on-write. Applies plugins to every route,
+        builds URL builders for named routes, and calls `warmup(app)`
+        on plugins which support it. With `freeze`, surviving objects are
+        moved out of reach of the garbage collector, so that collections
+        in workers do not touch, and copy, their pages.
+        """
+        for route in self.routes:
+            route.prepare()
+            if route.name:
+                self.get_url_builder(route.name)
+        for plugin in self.plugins:
+            warmup = getattr(plugin, 'warmup', None)
+            if warmup is not None:
+                warmup(self)
+        if freeze and hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+
+    def close(self):
+        """Close plugins, drain background tasks and exception reports"""
+        super().close()
+        self.tasks.shutdown()
+        self.exception_reporter.shutdown()
 
     def route(self, *args, **kwargs):
         # treat cbv routing differently
         cls = args[0] if len(args) else None
-        if inspect.isclass(cls) and issubclass(cls, View):
+        if isinstance(cls, type) and issubclass(cls, View):
             return self.routecbv(cls)
         
         # fallback to standard routing
@@ -137,70 +320,10 @@ class BottleCap(Bottle):
     #    raise exc
 
 
-
-############################################################
-# Management CLI
-############################################################
-
-@click.group()
-def cli(): # pragma: no cover
-    pass
-
-@cli.command(name='runserver', help='Start development server')
-@click.option('--host', '-h',
-    default='127.0.0.1', type=str,
-    help='Server hostname/IP')
-@click.option('--port', '-p',
-    default='8080', type=int,
-    help='Server port')
-@click.option('--use-reloader',
-    type=bool, flag_value=True, default=True,
-    help='should the server automatically restart the python '
-         'process if modules were changed?')
-@click.option('--use-debugger',
-    type=bool, flag_value=True, default=True,
-    help='should the werkzeug debugging system be used?')
-@click.option('--use-evalex',
-    type=bool, flag_value=True, default=True,
-    help='should the exception evaluation feature be enabled?')
-@click.option('--extra-files',
-    type=click.Path(), default=None, 
-    help='a list of files the reloader should watch additionally '
-         'to the modules. For example configuration files.')
-@click.option('--static',
-    type=click.Path(), default=None, multiple=True,
-    help='path to serve static files from via SharedDataMiddleware')
-@click.option('--reloader-type',
-    type=click.Choice(['stat', 'watchdog']), default=None, 
-    help='the type of reloader to use. The default is auto detection.')
-@click.option('--reloader-interval',
-    type=Decimal, default=0.5, 
-    help='the interval for the reloader in seconds')
-@click.option('--passthrough-errors',
-    type=bool, flag_value=True, default=True,
-    help='set this to True to disable the error catching. '
-         'This means that the server will die on errors but '
-         'it can be useful to hook debuggers in (pdb etc.)')
-@click.option('--threaded',
-    type=bool, flag_value=True, default=False,
-    help='should the process handle each request in a separate thread?')
-@click.option('--processes',
-    type=int, default=1, 
-    help='if greater than 1 then handle each request in a new process up '
-         'to this maximum number of concurrent processes.')
-def cli_runserver(**kwargs): # pragma: no cover
-    kwargs['application'] = None
-    return run_simple(**kwargs)
-
-
-@cli.command(name='ishell', help='Start IPython shell')
-def cli_ishell(ctx): # pragma: no cover
-    from IPython import start_ipython
-    start_ipython(argv=[])
-
-
-@cli.command(name='shell', help='Start python shell')
-def cli_shell(ctx): # pragma: no cover
-    code.interact(local=locals())
-
-
+def __getattr__(name):
+    # management CLI lives in `bottlecap.cli`, loaded on first use
+    if name == 'cli':
+        from bottlecap.cli import cli
+        return cli
+    raise AttributeError("module {!r} has no attribute {!r}".format(
+        __name__, name))
@@ -0,0 +1,307 @@
+"""
+Sampled request profiling for BottleCap
+"""
+
+import os
+import re
+import sys
+import hmac
+import glob
+import time
+import pstats
+import hashlib
+import cProfile
+import itertools
+import threading
+
+from collections import Counter
+from bottle import request
+
+from bottlecap.hooks import HookPlugin, RouteHooks
+
+__all__ = ['ProfilingPlugin', 'RouteProfile', 'StackSampler',
+           'sign_profile_header', 'load_profiles']
+
+
+def sign_profile_header(secret, ttl:float=300, now:float=None):
+    """
+    Returns header value which forces profiling until it expires
+
+    >>> sign_profile_header('secret', now=0)[:20]
+    '300:c6cfe400d9689a36'
+    """
+    expires = int((time.time() if now is None else now) + ttl)
+    return '{}:{}'.format(expires, profile_signature(secret, expires))
+
+
+def profile_signature(secret, expires):
+    key = secret.encode('utf-8') if isinstance(secret, str) else secret
+    msg = str(expires).encode('utf-8')
+    return hmac.new(key, msg, hashlib.sha256).hexdigest()
+
+
+def safe_name(value):
+    """
+    >>> safe_name('GET /users/<id:int>')
+    'GET_users_id_int_'
+    """
+    return re.sub(r'[^A-Za-z0-9.-]+', '_', value)
+
+
+############################################################
+# Profilers
+############################################################
+
+class StackSampler:
+    """
+    Samples the stacks of threads which are handling profiled requests
+
+    A single daemon thread wakes every `interval` seconds and records
+    the current stack of each registered thread, in collapsed form.
+    """
+
+    def __init__(self, interval:float=0.005):
+        self.interval = interval
+        self.active = {}
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self.run, name='bottlecap-sampler',
+                                      daemon=True)
+            thread.start()
+
+    def start(self):
+        """Start sampling current thread, returns token for `stop()`"""
+        self.ensure_started()
+        stacks = Counter()
+        self.active[threading.get_ident()] = stacks
+        return stacks
+
+    def stop(self, stacks):
+        self.active.pop(threading.get_ident(), None)
+        return stacks
+
+    def run(self):
+        pid = os.getpid()
+        while self.pid == pid:
+            time.sleep(self.interval)
+            if not self.active:
+                continue
+            frames = sys._current_frames()
+            for ident, stacks in list(self.active.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks[self.collapse(frame)] += 1
+
+    @staticmethod
+    def collapse(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('{}:{}'.format(frame.f_globals.get('__name__', '?'),
+                                        code.co_name))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+
+class RouteProfile:
+    """Aggregated profile samples of a single route"""
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = 0
+        self.stats = None
+        self.stacks = Counter()
+        self.lock = threading.Lock()
+
+    def add_profile(self, profile):
+        with self.lock:
+            self.samples += 1
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def add_stacks(self, stacks):
+        with self.lock:
+            self.samples += 1
+            self.stacks.update(stacks)
+
+    def dump(self, directory):
+        """Write pstats and collapsed stack files for this process"""
+        prefix = os.path.join(directory, '{}.{}'.format(self.name, os.getpid()))
+        with self.lock:
+            if self.stats is not None:
+                self.stats.dump_stats(prefix + '.pstats')
+            if self.stacks:
+                with open(prefix + '.collapsed', 'w') as fh:
+                    for stack, count in sorted(self.stacks.items()):
+                        fh.write('{} {}\n'.format(stack, count))
+
+
+############################################################
+# Profiling plugin
+############################################################
+
+class ProfilingPlugin(HookPlugin):
+    """
+    Profiles 1 in `sample_rate` requests, aggregated per route
+
+    :attr sample_rate: Profile every Nth request of each route, zero to
+                       only profile forced requests
+    :attr routes: Only profile these route names or rules
+    :attr secret: Requests with a header signed by this secret are
+                  always profiled, see `sign_profile_header()`
+    :attr sampler: Use `StackSampler` instead of cProfile, which has
+                   much lower overhead but only produces collapsed stacks
+    :attr output_dir: Profiles are written here at most once every
+                      `dump_interval` seconds, by the app task queue.
+                      Dumps are skipped while the queue is full, and
+                      counted in `dumps_skipped`
+
+    Only one request is profiled with cProfile at a time, as Python
+    3.12 refuses to enable a second profiler. Requests sampled while
+    another is profiled are served unprofiled, and counted in `skipped`.
+
+    Profiles only cover hooks and plugins applied inside this one, so
+    install it early for a complete picture. Dumped profiles can be
+    summarised with `bottlecap profile`.
+    """
+
+    name = 'profiling'
+
+    def __init__(self, sample_rate:int=100, routes=None, secret=None,
+                 header:str='X-BottleCap-Profile', sampler:StackSampler=None,
+                 output_dir:str=None, dump_interval:float=60):
+        self.sample_rate = sample_rate
+        self.routes = set(routes) if routes else None
+        self.secret = secret
+        self.header = header
+        self.sampler = sampler
+        self.output_dir = output_dir
+        self.dump_interval = dump_interval
+        self.next_dump = 0
+        self.profiles = {}
+        self.cprofile_lock = threading.Lock()
+        self.skipped = 0
+        self.dumps_skipped = 0
+
+    def is_forced(self):
+        """Check for valid signed profiling header"""
+        value = request.headers.get(self.header)
+        if not value or not self.secret:
+            return False
+        expires, _, signature = value.partition(':')
+        try:
+            if int(expires) < time.time():
+                return False
+        except ValueError:
+            return False
+        expected = profile_signature(self.secret, expires)
+        return hmac.compare_digest(expected, signature)
+
+    def prepare(self, route):
+        name = route.name or route.rule
+        if self.routes is not None and name not in self.routes \
+                and route.rule not in self.routes:
+            return None
+
+        key = safe_name('{} {}'.format(route.method, name))
+        profile = self.profiles.get(key)
+        if profile is None:
+            profile = self.profiles[key] = RouteProfile(key)
+        counter = itertools.count(1)
+        rate = self.sample_rate
+        app = route.app
+
+        def before():
+            if not ((rate and next(counter) % rate == 0) or self.is_forced()):
+                return
+            if self.sampler is not None:
+                request.environ['bottlecap.profile'] = self.sampler.start()
+            elif self.cprofile_lock.acquire(blocking=False):
+                profiler = cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError:
+                    # another profiler is active, e.g. outside this plugin
+                    self.cprofile_lock.release()
+                    self.skipped += 1
+                    return
+                request.environ['bottlecap.profile'] = profiler
+            else:
+                self.skipped += 1
+
+        def finish():
+            token = request.environ.pop('bottlecap.profile', None)
+            if token is None:
+                return
+            if self.sampler is not None:
+                profile.add_stacks(self.sampler.stop(token))
+            else:
+                token.disable()
+                self.cprofile_lock.release()
+                profile.add_profile(token)
+            self.schedule_dump(app)
+
+        def after(resp):
+            finish()
+            return resp
+
+        def error(exc):
+            finish()
+
+        return RouteHooks(before=before, after=after, error=error)
+
+    def schedule_dump(self, app):
+        if not self.output_dir or time.monotonic() < self.next_dump:
+            return
+        self.next_dump = time.monotonic() + self.dump_interval
+        tasks = getattr(app, 'tasks', None)
+        if tasks is None:
+            self.dump()
+        elif not tasks.submit_nowait(self.dump):
+            # never delay the profiled request, profiles are kept and
+            # written by the next dump
+            self.dumps_skipped += 1
+
+    def dump(self, directory:str=None):
+        """Write profiles of all routes"""
+        directory = directory or self.output_dir
+        os.makedirs(directory, exist_ok=True)
+        for profile in list(self.profiles.values()):
+            profile.dump(directory)
+
+
+def load_profiles(directory):
+    """
+    Merge dumped profiles of all workers, per route
+
+    :returns: dict of name -> (pstats.Stats or None, Counter of stacks)
+    """
+    result = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.pstats'))):
+        name = os.path.basename(path).rsplit('.', 2)[0]
+        stats, stacks = result.get(name, (None, Counter()))
+        if stats is None:
+            stats = pstats.Stats(path)
+        else:
+            stats.add(path)
+        result[name] = (stats, stacks)
+
+    for path in sorted(glob.glob(os.path.join(directory, '*.collapsed'))):
+        name = os.path.basename(path).rsplit('.', 2)[0]
+        stats, stacks = result.get(name, (None, Counter()))
+        with open(path) as fh:
+            for line in fh:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                stacks[stack] += int(count)
+        result[name] = (stats, stacks)
+    return result
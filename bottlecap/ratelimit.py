@@ -0,0 +1,247 @@
+"""
+Rate limiting for BottleCap
+"""
+
+import math
+import mmap
+import struct
+import hashlib
+import threading
+import multiprocessing
+
+from time import monotonic
+from bottle import request
+
+from bottlecap import exceptions as ex
+from bottlecap.hooks import HookPlugin, RouteHooks, get_meta
+
+__all__ = ['parse_rate', 'MemoryBucketStore', 'SharedMemoryBucketStore',
+           'RateLimitPlugin']
+
+
+PERIODS = {
+    's': 1, 'sec': 1, 'second': 1,
+    'm': 60, 'min': 60, 'minute': 60,
+    'h': 3600, 'hour': 3600,
+    'd': 86400, 'day': 86400}
+
+
+def parse_rate(value):
+    """
+    Convert rate into (limit, period) tuple
+
+    >>> parse_rate('100/minute')
+    (100, 60)
+    >>> parse_rate('5/s')
+    (5, 1)
+    >>> parse_rate('10/30s')
+    (10, 30)
+    >>> parse_rate((10, 2.5))
+    (10, 2.5)
+    >>> parse_rate('10/fortnight')
+    Traceback (most recent call last):
+    ValueError: Invalid rate period: 'fortnight'
+    """
+    if isinstance(value, (tuple, list)):
+        limit, period = value
+        return int(limit), period
+
+    limit, period = value.split('/', 1)
+    period = period.strip().lower()
+    multiplier = ''
+    while period and period[0].isdigit():
+        multiplier += period[0]
+        period = period[1:]
+    if period not in PERIODS:
+        raise ValueError('Invalid rate period: {!r}'.format(period))
+    return int(limit), PERIODS[period] * int(multiplier or 1)
+
+
+############################################################
+# Token bucket stores
+############################################################
+
+class MemoryBucketStore:
+    """
+    In-process token buckets, stored in lock-sharded dictionaries
+
+    Each key hashes onto one shard, so concurrent requests only contend
+    when they land on the same shard. Idle buckets are expired lazily;
+    a shard is swept at most once per `sweep_interval`, and only by
+    a request which already holds its lock.
+    """
+
+    def __init__(self, shards:int=64, sweep_interval:float=60):
+        self.shards = [ (threading.Lock(), {}) for x in range(shards) ]
+        self.sweep_interval = sweep_interval
+        self.next_sweep = [0] * shards
+
+    def consume(self, key, limit:int, period:float, cost:int=1, now:float=None):
+        """
+        Take tokens from bucket
+
+        :attr key: Bucket key
+        :attr limit: Bucket capacity
+        :attr period: Seconds taken to refill an empty bucket
+        :attr cost: Number of tokens to take
+        :returns: (allowed, retry_after)
+        """
+        now = monotonic() if now is None else now
+        rate = limit / period
+        index = hash(key) % len(self.shards)
+        lock, buckets = self.shards[index]
+
+        with lock:
+            if now >= self.next_sweep[index]:
+                self.next_sweep[index] = now + self.sweep_interval
+                self.sweep(buckets, now)
+
+            state = buckets.get(key)
+            if state is None:
+                tokens = limit
+            else:
+                tokens, last, expires = state
+                tokens = min(limit, tokens + (now - last) * rate)
+
+            if tokens >= cost:
+                tokens -= cost
+                buckets[key] = (tokens, now, now + (limit - tokens) / rate)
+                return True, 0
+
+            return False, (cost - tokens) / rate
+
+    def sweep(self, buckets, now):
+        """Remove buckets which have refilled since last use"""
+        expired = [ key for key, state in buckets.items() if state[2] <= now ]
+        for key in expired:
+            del buckets[key]
+
+    def __len__(self):
+        return sum(len(buckets) for lock, buckets in self.shards)
+
+
+class SharedMemoryBucketStore:
+    """
+    Token buckets held in an anonymous shared memory map
+
+    The store must be created before worker processes are forked,
+    after which all workers on the host share the same buckets. Slots
+    are grouped into shards, each protected by a process shared lock,
+    and keys are placed using open addressing within their shard. When
+    a shard is full, the least recently used bucket is evicted.
+    """
+
+    slot = struct.Struct('Qdd')
+
+    def __init__(self, shards:int=64, slots_per_shard:int=256):
+        self.shard_count = shards
+        self.slots_per_shard = slots_per_shard
+        self.locks = [ multiprocessing.Lock() for x in range(shards) ]
+        self.mmap = mmap.mmap(-1, self.slot.size * shards * slots_per_shard)
+
+    def key_hash(self, key):
+        """Hash which is stable across processes, zero denotes empty slot"""
+        digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') or 1
+
+    def find_slot(self, shard, khash, now, rate, limit):
+        """
+        Return offset of slot for key, or a free/expired/oldest slot
+        """
+        unpack_from = self.slot.unpack_from
+        size = self.slot.size
+        base = shard * self.slots_per_shard * size
+        start = khash % self.slots_per_shard
+        victim = None
+        victim_last = None
+
+        for probe in range(self.slots_per_shard):
+            offset = base + ((start + probe) % self.slots_per_shard) * size
+            slot_hash, tokens, last = unpack_from(self.mmap, offset)
+            if slot_hash == khash:
+                return offset, tokens, last
+            if slot_hash == 0:
+                return offset, None, None
+            # a bucket which has fully refilled can be recycled
+            if last + (limit - tokens) / rate <= now:
+                victim, victim_last = offset, -1
+            elif victim is None or last < victim_last:
+                victim, victim_last = offset, last
+        return victim, None, None
+
+    def consume(self, key, limit:int, period:float, cost:int=1, now:float=None):
+        """Same as `MemoryBucketStore.consume()`"""
+        now = monotonic() if now is None else now
+        rate = limit / period
+        khash = self.key_hash(key)
+        shard = (khash >> 32) % self.shard_count
+
+        with self.locks[shard]:
+            offset, tokens, last = self.find_slot(shard, khash, now, rate, limit)
+            if tokens is None:
+                tokens = limit
+            else:
+                tokens = min(limit, tokens + (now - last) * rate)
+
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self.slot.pack_into(self.mmap, offset, khash, tokens, now)
+
+        return (True, 0) if allowed else (False, (cost - tokens) / rate)
+
+
+############################################################
+# Rate limit plugin
+############################################################
+
+class RateLimitPlugin(HookPlugin):
+    """
+    Applies token bucket rate limits declared on views, e.g.
+
+        class Meta:
+            rate_limit = '100/minute'
+
+    Clients are identified by user guid, then API key id, then IP
+    address. Only keys verified by an auth plugin such as
+    `ApiKeyAuthPlugin` are used, so that clients cannot escape their IP
+    bucket by sending made up keys. Rejected requests raise
+    `TooManyRequestsError`, which is rendered through content
+    negotiation. This plugin must be installed after auth plugins so
+    that `request.user` and `request.api_key` are available.
+    """
+
+    name = 'ratelimit'
+
+    def __init__(self, store=None, key_func=None):
+        self.store = store if store is not None else MemoryBucketStore()
+        if key_func is not None:
+            self.get_client_key = key_func
+
+    def get_client_key(self):
+        """Returns key identifying the client of current request"""
+        user = getattr(request, 'user', None)
+        if user is not None:
+            return 'user:{}'.format(user.guid)
+
+        api_key = getattr(request, 'api_key', None)
+        if api_key is not None:
+            return 'key:{}'.format(api_key)
+
+        return 'ip:{}'.format(request.remote_addr)
+
+    def prepare(self, route):
+        rate = get_meta(route, 'rate_limit')
+        if not rate:
+            return None
+
+        limit, period = parse_rate(rate)
+        scope = route.name or route.rule
+
+        def before():
+            key = '{}|{}'.format(scope, self.get_client_key())
+            allowed, retry_after = self.store.consume(key, limit, period)
+            if not allowed:
+                raise ex.TooManyRequestsError(
+                    headers={'Retry-After': str(math.ceil(retry_after))})
+        return RouteHooks(before=before)
@@ -0,0 +1,262 @@
+"""
+Asynchronous exception reporting for BottleCap
+"""
+
+import os
+import time
+import queue
+import atexit
+import hashlib
+import logging
+import threading
+import traceback
+
+from time import monotonic
+from bottle import HTTPResponse, HTTPError
+
+from bottlecap import exceptions as ex
+from bottlecap.hooks import HookPlugin, RouteHooks
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ExceptionEvent', 'ExceptionReporter', 'ExceptionReportingPlugin',
+           'fingerprint']
+
+
+def exception_origin(exc):
+    """Returns (filename, lineno, function) of frame which raised exc"""
+    tb = exc.__traceback__
+    if tb is None:
+        return ('?', 0, '?')
+    while tb.tb_next is not None:
+        tb = tb.tb_next
+    code = tb.tb_frame.f_code
+    return (code.co_filename, tb.tb_lineno, code.co_name)
+
+
+def fingerprint(exc):
+    """
+    Identifies exceptions of the same type raised from the same frame
+
+    >>> def fail(): raise ValueError('a')
+    >>> try: fail()
+    ... except ValueError as e: a = fingerprint(e)
+    >>> try: fail()
+    ... except ValueError as e: b = fingerprint(e)
+    >>> a == b
+    True
+    """
+    cls = type(exc)
+    key = '{}.{}|{}:{}:{}'.format(cls.__module__, cls.__qualname__,
+                                  *exception_origin(exc))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+class ExceptionEvent:
+    """Occurrences of one exception fingerprint within a batch"""
+
+    def __init__(self, fingerprint, exc, route, when):
+        self.fingerprint = fingerprint
+        self.exception = exc
+        self.route = route
+        self.count = 0
+        self.first_seen = when
+        self.last_seen = when
+
+    def __repr__(self):
+        return '<ExceptionEvent {} {!r} x{}>'.format(
+            self.fingerprint, self.exception, self.count)
+
+    def add(self, when):
+        self.count += 1
+        self.last_seen = when
+
+    def format(self):
+        """Returns formatted traceback of first occurrence"""
+        exc = self.exception
+        return ''.join(traceback.format_exception(
+            type(exc), exc, exc.__traceback__))
+
+
+class ExceptionReporter:
+    """
+    Sends batches of exceptions to `signal` from a background thread
+
+    Request threads only put exceptions onto a bounded queue, and
+    exceptions are dropped (and counted) rather than blocking when it
+    is full. The reporter thread collects up to `batch_size` exceptions
+    over `batch_interval` seconds, de-duplicates them by `fingerprint()`
+    and sends the batch as `signal.send(sender, events=[ExceptionEvent])`.
+    """
+
+    def __init__(self, signal, sender=None, max_size:int=1000,
+                 batch_size:int=100, batch_interval:float=1.0,
+                 name:str='bottlecap-reporter'):
+        self.signal = signal
+        self.sender = sender
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.name = name
+        self.lock = threading.Lock()
+        self.pid = None
+        self.thread = None
+        self.closed = False
+        self.queue = queue.Queue(max_size)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.reported = 0
+        self.dropped = 0
+        self.batches = 0
+        self.failed = 0
+
+    def start(self):
+        """Start reporter thread, if not already running in this process"""
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                # threads and queue state do not survive a fork
+                self.queue = queue.Queue(self.max_size)
+                self.reset_stats()
+            self.pid = os.getpid()
+            self.closed = False
+            self.thread = threading.Thread(target=self.worker, daemon=True,
+                                           name=self.name)
+            self.thread.start()
+            atexit.register(self.shutdown)
+
+    def report(self, exc, route=None):
+        """
+        Queue exception for reporting, never blocks
+
+        :returns: False if exception was dropped
+        """
+        if self.pid != os.getpid():
+            self.start()
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait((exc, route, time.time()))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+        with self.lock:
+            self.reported += 1
+        return True
+
+    def worker(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            items = [item]
+            deadline = monotonic() + self.batch_interval
+
+            # gather a batch, unless shutting down
+            while item is not None and len(items) < self.batch_size:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                items.append(item)
+
+            stopping = items[-1] is None
+            events = {}
+            for item in items:
+                if item is None: continue
+                exc, route, when = item
+                key = fingerprint(exc)
+                event = events.get(key)
+                if event is None:
+                    event = events[key] = ExceptionEvent(key, exc, route, when)
+                event.add(when)
+
+            try:
+                if events:
+                    self.send(list(events.values()))
+            finally:
+                for item in items:
+                    self.queue.task_done()
+
+    def send(self, events):
+        try:
+            if self.signal.receivers:
+                self.signal.send(self.sender, events=events)
+            else:
+                for event in events:
+                    logger.error('Unhandled exception (x%d) on %s\n%s',
+                                 event.count, event.route, event.format())
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            logger.exception('Exception reporter failed')
+        else:
+            with self.lock:
+                self.batches += 1
+
+    def flush(self):
+        """Wait until all queued exceptions have been sent"""
+        if self.pid == os.getpid() and not self.closed:
+            self.queue.join()
+
+    def shutdown(self, timeout:float=None):
+        """
+        Send remaining exceptions and stop reporter thread
+
+        :returns: True if reporter finished within timeout
+        """
+        if self.pid != os.getpid() or self.closed:
+            return True
+        self.closed = True
+        atexit.unregister(self.shutdown)
+        self.queue.put(None)
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def stats(self):
+        with self.lock:
+            return dict(depth=self.queue.qsize(), reported=self.reported,
+                        dropped=self.dropped, batches=self.batches,
+                        failed=self.failed)
+
+
+class ExceptionReportingPlugin(HookPlugin):
+    """
+    Reports server errors raised by routes
+
+    Installed by BottleCap directly after the route compiler, so that
+    its error hook runs last and sees errors after negotiation has
+    rendered them. Client errors, missed deadlines, and HTTP errors
+    raised without an underlying exception, are not reported.
+    """
+
+    name = 'reporting'
+
+    # deliberate error responses rather than failures
+    expected = (ex.ClientError, ex.DeadlineExceededError, HTTPError)
+
+    def __init__(self, reporter):
+        self.reporter = reporter
+
+    def prepare(self, route):
+        label = route.name or route.rule
+        report = self.reporter.report
+        expected = self.expected
+
+        def error(exc):
+            if isinstance(exc, HTTPResponse):
+                # only errors caused by an exception are reported,
+                # rendered errors carry the original exception
+                exc = getattr(exc, 'exception', None) if exc.status_code >= 500 else None
+                if exc is None:
+                    return
+            if isinstance(exc, expected):
+                return
+            report(exc, label)
+
+        return RouteHooks(error=error)
@@ -0,0 +1,230 @@
+"""
+Token revocation for BottleCap
+"""
+
+import os
+import math
+import atexit
+import logging
+import threading
+
+from time import time
+
+from bottlecap.sources import JSONFileSource
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['BloomFilter', 'RevocationList', 'RevocationFile']
+
+
+class BloomFilter:
+    """
+    Set membership with false positives but no false negatives
+
+    Sized for `capacity` items at `error_rate`. Positions are derived
+    from the hash of each item by double hashing.
+
+    >>> bloom = BloomFilter.from_items(['a', 'b'], capacity=100)
+    >>> 'a' in bloom, 'b' in bloom, 'c' in bloom
+    (True, True, False)
+    """
+
+    __slots__ = ('bits', 'size', 'hashes')
+
+    def __init__(self, capacity:int=1000, error_rate:float=0.001):
+        capacity = max(capacity, 1)
+        size = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.size = max(size, 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    @classmethod
+    def from_items(cls, items, capacity:int=None, error_rate:float=0.001):
+        items = list(items)
+        bloom = cls(max(capacity or 0, len(items)), error_rate)
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+    def positions(self, item):
+        # filters never leave the process, and forked workers inherit
+        # its hash seed, so the builtin hash is stable and cheap
+        h1 = hash(item) & 0xFFFFFFFFFFFFFFFF
+        h2 = (h1 >> 32) | 1
+        size = self.size
+        return [ (h1 + i * h2) % size for i in range(self.hashes) ]
+
+    def add(self, item):
+        bits = self.bits
+        for pos in self.positions(item):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        for pos in self.positions(item):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class RevocationFile(JSONFileSource):
+    """
+    Revocation source which reads a local JSON file of the form
+    `{"tokens": [jti, ...], "users": {guid: revoked_before, ...}}`
+
+    Returns None while the file is unchanged. Any callable returning
+    such a dict, or None when unchanged, can be used as a source.
+    """
+
+
+class RevocationSnapshot:
+    """Immutable revocation state, replaced as a whole on refresh"""
+
+    __slots__ = ('bloom', 'tokens', 'users')
+
+    def __init__(self, tokens, users, error_rate:float=0.001):
+        self.tokens = frozenset(tokens)
+        self.users = dict(users)
+        keys = [ 'jti:' + jti for jti in self.tokens ]
+        keys += [ 'user:' + guid for guid in self.users ]
+        self.bloom = BloomFilter.from_items(keys, capacity=1024,
+                                            error_rate=error_rate)
+
+
+class RevocationList:
+    """
+    Revoked token ids, and users whose tokens issued before a given
+    time are revoked
+
+    Checks read an immutable snapshot without locks. Most tokens are
+    not revoked, and are answered by the Bloom filter alone, positives
+    are confirmed against exact sets. The snapshot is rebuilt from
+    `source` by a background thread every `interval` seconds, and
+    whenever tokens are revoked locally, so checks never do I/O. The
+    first check of each process loads `source` before answering, so
+    that revoked tokens are not accepted until the thread catches up.
+
+    :attr source: Callable returning revocations, see `RevocationFile`
+    """
+
+    def __init__(self, source=None, interval:float=30, error_rate:float=0.001,
+                 name:str='bottlecap-revocation'):
+        self.source = source
+        self.interval = interval
+        self.error_rate = error_rate
+        self.name = name
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid = None
+        self.thread = None
+        self.closed = False
+        self.remote = ((), {})
+        self.local_tokens = set()
+        self.local_users = {}
+        self.snapshot = RevocationSnapshot((), {}, error_rate)
+
+    def start(self):
+        """
+        Load revocations and start refresh thread, if not already
+        running in this process. Concurrent checks wait for the load
+        """
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            if self.source is not None:
+                self.refresh()
+                self.closed = False
+                self.wakeup.clear()
+                self.thread = threading.Thread(target=self.worker,
+                                               daemon=True, name=self.name)
+                self.thread.start()
+                atexit.register(self.shutdown)
+            self.pid = os.getpid()
+
+    def worker(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            if self.closed:
+                return
+            self.refresh()
+
+    def shutdown(self, timeout:float=None):
+        if self.pid != os.getpid() or self.closed or self.thread is None:
+            return True
+        self.closed = True
+        atexit.unregister(self.shutdown)
+        self.wakeup.set()
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def rebuild(self):
+        tokens, users = self.remote
+        tokens = set(tokens) | self.local_tokens
+        users = dict(users)
+        for guid, before in self.local_users.items():
+            users[guid] = max(before, users.get(guid, before))
+        self.snapshot = RevocationSnapshot(tokens, users, self.error_rate)
+
+    def refresh(self):
+        """
+        Load revocations from source
+
+        :returns: True if revocations were replaced
+        """
+        if self.source is None:
+            return False
+        try:
+            data = self.source()
+            if data is None:
+                return False
+            tokens = [ str(jti) for jti in data.get('tokens', ()) ]
+            users = { str(guid): float(before)
+                      for guid, before in data.get('users', {}).items() }
+        except Exception:
+            logger.exception('Failed to refresh revocations, keeping current list')
+            return False
+        with self.lock:
+            self.remote = (tokens, users)
+            self.rebuild()
+        logger.info('Loaded %d revoked tokens and %d revoked users',
+                    len(tokens), len(users))
+        return True
+
+    def revoke_token(self, jti):
+        """Revoke a single token by its `jti` claim"""
+        with self.lock:
+            self.local_tokens.add(str(jti))
+            self.rebuild()
+
+    def revoke_user(self, guid, before:float=None):
+        """Revoke all tokens of user issued before `before`, default now"""
+        with self.lock:
+            self.local_users[str(guid)] = time() if before is None else before
+            self.rebuild()
+
+    def is_revoked(self, jti=None, guid=None, issued_at=None):
+        """
+        Check token by its `jti`, or by user guid and `iat`. Tokens of
+        a revoked user without `iat` are treated as revoked
+        """
+        if self.pid != os.getpid():
+            self.start()
+        snapshot = self.snapshot
+        bloom = snapshot.bloom
+        if jti is not None:
+            jti = str(jti)
+            if 'jti:' + jti in bloom and jti in snapshot.tokens:
+                return True
+        if guid is not None:
+            guid = str(guid)
+            if 'user:' + guid in bloom:
+                before = snapshot.users.get(guid)
+                if before is not None and (issued_at is None or issued_at < before):
+                    return True
+        return False
+
+    def stats(self):
+        snapshot = self.snapshot
+        return dict(tokens=len(snapshot.tokens), users=len(snapshot.users),
+                    bloom_bytes=len(snapshot.bloom.bits))
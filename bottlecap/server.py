@@ -0,0 +1,344 @@
+"""
+Prefork production server for BottleCap
+"""
+
+import os
+import sys
+import time
+import random
+import signal
+import importlib
+import socket
+import logging
+import selectors
+import resource
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['PreforkServer', 'Worker', 'get_rss', 'load_app']
+
+
+def get_rss():
+    """Returns resident set size of this process, in bytes"""
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        # peak rather than current usage, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def load_app(target):
+    """
+    Import app from 'module:attribute', attribute defaults to `app`
+    """
+    module, _, attr = target.partition(':')
+    app = importlib.import_module(module)
+    for name in (attr or 'app').split('.'):
+        app = getattr(app, name)
+    return app
+
+
+def create_socket(host, port, reuse_port=False, backlog=2048):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class RequestHandler(WSGIRequestHandler):
+    """Request logging is left to `AccessLogPlugin`"""
+
+    def get_environ(self):
+        environ = super().get_environ()
+        # wsgiref defaults to text/plain, which breaks negotiation
+        if self.headers.get('Content-Type') is None:
+            environ.pop('CONTENT_TYPE', None)
+        return environ
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WorkerServer(WSGIServer):
+    """
+    WSGI server which accepts from an existing listening socket
+
+    With an `executor` of `threads` workers, at most `threads`
+    connections are accepted at once. Further connections wait in the
+    listen backlog, where other workers may accept them, rather than in
+    the unbounded queue of the executor.
+    """
+
+    request_queue_size = 2048
+
+    def __init__(self, sock, app, executor=None, threads:int=0):
+        super().__init__(sock.getsockname()[:2], RequestHandler,
+                         bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name = socket.getfqdn(sock.getsockname()[0])
+        self.server_port = sock.getsockname()[1]
+        self.setup_environ()
+        self.set_app(app)
+        self.executor = executor
+        self.slots = None
+        if executor is not None:
+            self.slots = threading.BoundedSemaphore(threads)
+        self.dispatched = False
+
+    def handle_ready(self, selector, timeout:float):
+        """
+        Handle a connection if one is ready within `timeout`, once a
+        thread is free to serve it
+        """
+        self.dispatched = False
+        if self.slots is not None and not self.slots.acquire(timeout=timeout):
+            return
+        try:
+            if selector.select(timeout):
+                self._handle_request_noblock()
+        finally:
+            # not accepted, or served in this thread
+            if self.slots is not None and not self.dispatched:
+                self.slots.release()
+
+    def process_request(self, request, client_address):
+        if self.executor is None:
+            return super().process_request(request, client_address)
+        self.executor.submit(self.process_request_thread, request, client_address)
+        self.dispatched = True
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+
+class Worker:
+    """
+    Serves requests in a forked process until told to stop, or until
+    it should be recycled
+    """
+
+    def __init__(self, app, sock, threads:int=0, max_requests:int=0,
+                 max_rss:int=None):
+        self.app = app
+        self.sock = sock
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.requests = 0
+        self.stopping = False
+        self.master = os.getppid()
+
+    def wsgi(self, environ, start_response):
+        try:
+            return self.app(environ, start_response)
+        finally:
+            self.requests += 1
+            if self.should_recycle():
+                self.stopping = True
+
+    def should_recycle(self):
+        if self.max_requests and self.requests >= self.max_requests:
+            logger.info('Worker %s recycling after %d requests',
+                        os.getpid(), self.requests)
+            return True
+        if self.max_rss and get_rss() > self.max_rss:
+            logger.info('Worker %s recycling above RSS limit', os.getpid())
+            return True
+        return False
+
+    def handle_term(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_term)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+        executor = None
+        if self.threads:
+            executor = ThreadPoolExecutor(self.threads,
+                                          thread_name_prefix='bottlecap-worker')
+        server = WorkerServer(self.sock, self.wsgi, executor, self.threads)
+        self.sock.setblocking(False)
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.sock, selectors.EVENT_READ)
+            while not self.stopping:
+                server.handle_ready(selector, 0.5)
+                # stop if master has died
+                if os.getppid() != self.master:
+                    self.stopping = True
+
+        # drain requests which have already been accepted
+        self.sock.close()
+        if executor is not None:
+            executor.shutdown(wait=True)
+        close = getattr(self.app, 'close', None)
+        if close is not None:
+            close()
+
+
+class PreforkServer:
+    """
+    Forks `workers` processes which serve `app`
+
+    With `reuse_port`, the master binds one SO_REUSEPORT socket per
+    worker slot and the kernel balances connections between them,
+    otherwise all workers accept from a single socket. The master keeps
+    sockets open, so connections queued while a worker is replaced are
+    served by its successor. Workers serve one request at a time, or
+    use a pool of `threads`.
+
+    Workers are recycled after `max_requests` (plus up to
+    `max_requests_jitter`, so workers do not restart together), or once
+    their RSS exceeds `max_rss` bytes. On SIGTERM or SIGINT, workers stop
+    accepting and finish in-flight requests, and are killed if they
+    have not exited after `graceful_timeout` seconds.
+
+    With `warmup`, `app.warmup()` is called before workers are forked.
+    """
+
+    def __init__(self, app, host:str='127.0.0.1', port:int=8080,
+                 workers:int=None, threads:int=0, reuse_port:bool=None,
+                 max_requests:int=0, max_requests_jitter:int=0,
+                 max_rss:int=None, graceful_timeout:float=30,
+                 backlog:int=2048, warmup:bool=True):
+        if reuse_port is None:
+            reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.reuse_port = reuse_port
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.max_rss = max_rss
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.warmup = warmup
+        self.children = {}
+        self.stopping = False
+        self.sockets = []
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def spawn(self, slot):
+        max_requests = self.max_requests
+        if max_requests and self.max_requests_jitter:
+            max_requests += random.randint(0, self.max_requests_jitter)
+
+        pid = os.fork()
+        if pid:
+            self.children[pid] = slot
+            return pid
+
+        code = 0
+        try:
+            random.seed()
+            sock = self.sockets[slot]
+            for other in set(self.sockets) - {sock}:
+                other.close()
+            Worker(self.app, sock, threads=self.threads,
+                   max_requests=max_requests, max_rss=self.max_rss).run()
+        except Exception:
+            logger.exception('Worker %s failed', os.getpid())
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def reap(self):
+        """Remove exited workers, returns number which failed"""
+        failed = 0
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return failed
+            if not pid:
+                return failed
+            if self.children.pop(pid, None) is None:
+                continue
+            if os.WIFSIGNALED(status) or os.WEXITSTATUS(status):
+                logger.warning('Worker %s exited with status %s', pid, status)
+                failed += 1
+
+    def stop_workers(self):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.05)
+
+        for pid in list(self.children):
+            logger.warning('Worker %s did not exit in time, killing', pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            self.children.pop(pid, None)
+
+    def run(self):
+        """Serve until SIGTERM or SIGINT"""
+        # share prepared app state between workers
+        warmup = getattr(self.app, 'warmup', None)
+        if self.warmup and warmup is not None:
+            warmup()
+
+        if self.reuse_port:
+            self.sockets = [ create_socket(self.host, self.port, reuse_port=True,
+                                           backlog=self.backlog)
+                             for x in range(self.workers) ]
+        else:
+            sock = create_socket(self.host, self.port, backlog=self.backlog)
+            self.sockets = [sock] * self.workers
+
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        logger.info('Serving on %s:%s with %d workers', self.host, self.port,
+                    self.workers)
+
+        failures = 0
+        try:
+            while not self.stopping:
+                running = set(self.children.values())
+                for slot in range(self.workers):
+                    if slot not in running and not self.stopping:
+                        self.spawn(slot)
+                time.sleep(0.1)
+                if self.reap() and not self.stopping:
+                    # avoid spinning when workers fail on startup
+                    failures += 1
+                    time.sleep(min(failures * 0.1, 5))
+                else:
+                    failures = 0
+        finally:
+            self.stop_workers()
+            for sock in set(self.sockets):
+                sock.close()
@@ -0,0 +1,203 @@
+"""
+Single-flight request coalescing for BottleCap
+"""
+
+import hashlib
+import threading
+
+from bottle import request, HTTPResponse, HTTPError
+
+from bottlecap import exceptions as ex
+from bottlecap.deadline import time_remaining
+from bottlecap.hooks import HookPlugin, RouteHooks, get_meta
+
+__all__ = ['SingleFlight', 'CoalescingPlugin', 'auth_scope']
+
+# headers which determine auth scope of a request
+SCOPE_HEADERS = ('Authorization', 'X-API-Key', 'Cookie')
+
+
+def auth_scope(headers=SCOPE_HEADERS):
+    """Returns digest of request credentials"""
+    digest = hashlib.sha1()
+    for name in headers:
+        digest.update(request.headers.get(name, '').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class Call:
+    """In-flight call, shared by leader and waiters"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Ensures only one call for a given key is in flight at a time,
+    concurrent callers with the same key wait for and share its result
+
+    Callers wait for the time left of their request deadline, or else
+    for `timeout` seconds, and wait indefinitely when it is None.
+    """
+
+    def __init__(self, timeout:float=None):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def join(self, key):
+        """
+        Join in-flight call for key, or start a new one
+
+        :returns: (call, leader)
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                return call, False
+            call = self.calls[key] = Call()
+            return call, True
+
+    def wait(self, call, timeout:float=None):
+        """
+        Wait for call to finish, and return its result
+
+        :raises DeadlineExceededError: if call did not finish in time
+        """
+        if timeout is None:
+            timeout = time_remaining(self.timeout)
+        if not call.event.wait(timeout):
+            raise ex.DeadlineExceededError()
+        if call.exc is not None:
+            raise call.exc
+        return call.result
+
+    def finish(self, key, call, result=None, exc=None):
+        """
+        Publish result of call to waiters
+
+        :returns: True if result was shared with waiters
+        """
+        call.result = result
+        call.exc = exc
+        with self.lock:
+            del self.calls[key]
+        call.event.set()
+        return call.waiters > 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Execute callable, or wait for the in-flight call with same key
+
+        :returns: (result, shared)
+        """
+        call, leader = self.join(key)
+        if not leader:
+            return self.wait(call), True
+
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as exc:
+            self.finish(key, call, exc=exc)
+            raise
+        return result, self.finish(key, call, result=result)
+
+
+def copy_response(resp):
+    """
+    Returns copy of rendered response, as bottle mutates the headers
+    of a response while sending it
+    """
+    nresp = resp.copy(cls=type(resp))
+    body = resp.body
+    nresp.body = copy_response(body) if isinstance(body, HTTPResponse) else body
+    if isinstance(resp, HTTPError):
+        nresp.exception = resp.exception
+        nresp.traceback = resp.traceback
+    return nresp
+
+
+class CoalescingPlugin(HookPlugin):
+    """
+    Coalesces concurrent identical GET requests onto one dispatch,
+    for views which enable it with
+
+        class Meta:
+            coalesce = True
+
+    Requests are identical when they share route, url args, query,
+    negotiated media type and credentials. Waiters receive a copy of
+    the response, or error, rendered by the leading request. This
+    plugin must be installed after `ContentNegotiationPlugin`.
+
+    Waiters give up with `DeadlineExceededError` once their request
+    deadline passes, or after `wait_timeout` seconds without one.
+    """
+
+    name = 'coalesce'
+
+    scope_headers = SCOPE_HEADERS
+
+    def __init__(self, wait_timeout:float=30):
+        self.flight = SingleFlight(wait_timeout)
+
+    def get_auth_scope(self):
+        return auth_scope(self.scope_headers)
+
+    def get_key(self, rule):
+        nctx = request.nctx
+        return (rule, tuple(sorted(request.url_args.items())),
+                request.query_string, nctx.renderer,
+                str(nctx.response_content_type), self.get_auth_scope())
+
+    def prepare(self, route):
+        if not get_meta(route, 'coalesce'):
+            return None
+        rule = route.rule
+
+        def before():
+            if request.method not in ('GET', 'HEAD'):
+                return None
+
+            key = self.get_key(rule)
+            call, leader = self.flight.join(key)
+            if leader:
+                request.environ['bottlecap.coalesce'] = (key, call)
+                return None
+
+            try:
+                return copy_response(self.flight.wait(call))
+            except HTTPResponse as exc:
+                raise copy_response(exc)
+
+        def after(resp):
+            state = request.environ.pop('bottlecap.coalesce', None)
+            if state is None:
+                return resp
+
+            # render within leader, so waiters can share the result
+            resp = request.nctx.negotiator.render_response(resp)
+            shared = self.flight.finish(*state, result=resp)
+            return copy_response(resp) if shared else resp
+
+        def error(exc):
+            state = request.environ.pop('bottlecap.coalesce', None)
+            if state is None:
+                return
+
+            try:
+                request.nctx.negotiator.handle_exception(exc)
+            except Exception as nexc:
+                exc = nexc
+            shared = self.flight.finish(*state, exc=exc)
+            if shared and isinstance(exc, HTTPResponse):
+                raise copy_response(exc)
+            raise exc
+
+        return RouteHooks(before=before, after=after, error=error)
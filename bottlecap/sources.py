@@ -0,0 +1,131 @@
+"""
+Reloadable data sources for BottleCap
+
+Key rings, API key indexes and revocation lists poll a source, which
+is any callable returning a document, or None when it is unchanged.
+"""
+
+import os
+import json
+import logging
+import threading
+
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['JSONFileSource', 'SourceIndex']
+
+
+class JSONFileSource:
+    """
+    Source which reads a local JSON file
+
+    Returns None while the file is unchanged, judged by its modification
+    time and size, so that polling costs a `stat()` rather than a parse.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+
+    def __call__(self):
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self.stamp:
+            return None
+        with open(self.path, encoding='utf-8') as fh:
+            data = json.load(fh)
+        self.stamp = stamp
+        return data
+
+
+class SourceIndex:
+    """
+    Entries indexed by id, added directly or loaded from `source`
+
+    The source is polled on lookup at most every `refresh_interval`
+    seconds and, with `miss_interval`, at most every `miss_interval`
+    seconds when an unknown id is looked up. Each refresh replaces all
+    entries from the source at once, entries added directly are kept.
+    Lookups read the current dict without locks, as it is replaced
+    rather than modified.
+
+    Subclasses implement `parse()`, which builds entries of a document.
+    """
+
+    # named in log messages
+    kind = 'entries'
+
+    def __init__(self, source=None, refresh_interval:float=30,
+                 miss_interval:float=None, clock=monotonic):
+        self.source = source
+        self.refresh_interval = refresh_interval
+        self.miss_interval = miss_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.static = {}
+        self.checked = None
+
+    def parse(self, data):
+        """Returns dict of id -> entry from a source document"""
+        raise NotImplementedError()
+
+    def put(self, id, entry):
+        """Add entry which is kept across refreshes"""
+        with self.lock:
+            self.static[id] = entry
+            keys = dict(self.keys)
+            keys[id] = entry
+            self.keys = keys
+
+    def remove(self, id):
+        with self.lock:
+            self.static.pop(id, None)
+            keys = dict(self.keys)
+            keys.pop(id, None)
+            self.keys = keys
+
+    def load(self, data):
+        """Replace entries from source with those of a document"""
+        keys = self.parse(data)
+        keys.update(self.static)
+        self.keys = keys
+
+    def refresh(self, min_interval:float=0):
+        """
+        Load entries from source, unless checked within `min_interval`
+
+        :returns: True if entries were replaced
+        """
+        if self.source is None:
+            return False
+        with self.lock:
+            now = self.clock()
+            if self.checked is not None and now - self.checked < min_interval:
+                return False
+            self.checked = now
+            try:
+                data = self.source()
+                if data is None:
+                    return False
+                self.load(data)
+            except Exception:
+                logger.exception('Failed to refresh %s, keeping current ones',
+                                 self.kind)
+                return False
+        logger.info('Loaded %d %s', len(self.keys), self.kind)
+        return True
+
+    def get(self, id):
+        """Returns entry for id, or None"""
+        if self.source is not None and (self.checked is None or
+                self.clock() - self.checked >= self.refresh_interval):
+            self.refresh(self.refresh_interval)
+
+        entry = self.keys.get(id)
+        if (entry is None and id is not None and self.miss_interval is not None
+                and self.refresh(self.miss_interval)):
+            entry = self.keys.get(id)
+        return entry
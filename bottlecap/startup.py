@@ -0,0 +1,227 @@
+"""
+Startup time report for BottleCap apps
+
+The app is imported in a fresh interpreter started with `-X importtime`,
+so that modules already loaded by the caller do not hide their cost.
+"""
+
+import os
+import sys
+import json
+import tempfile
+import functools
+import subprocess
+
+from time import perf_counter_ns
+
+__all__ = ['StartupRecorder', 'StartupReport', 'parse_importtime',
+           'startup_report']
+
+
+def parse_importtime(output):
+    """
+    Parse `-X importtime` output into (module, self_us, cumulative_us, depth)
+
+    >>> parse_importtime('''import time: self [us] | cumulative | imported package
+    ... import time:       120 |        120 |     six
+    ... import time:       250 |        370 |   bottlecap.plugin''')
+    [('six', 120, 120, 2), ('bottlecap.plugin', 250, 370, 1)]
+    """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        try:
+            own, cumulative, name = line[len('import time:'):].split('|', 2)
+            own, cumulative = int(own), int(cumulative)
+        except ValueError:
+            # header line, or output of the app itself
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), own, cumulative, depth))
+    return modules
+
+
+class StartupRecorder:
+    """
+    Records construction time of BottleCap apps, and registration and
+    preparation time of each route, while an app module is imported
+
+    Registration time of a CBV includes building its callable. Preparing
+    a route applies plugins to it, which otherwise happens on the first
+    request, see `BottleCap.warmup()`.
+    """
+
+    def __init__(self):
+        self.apps = []
+        self.routes = []
+        self.patched = []
+
+    def patch(self, cls, name, make_wrapper):
+        original = cls.__dict__[name]
+        setattr(cls, name, make_wrapper(original))
+        self.patched.append((cls, name, original))
+
+    def install(self):
+        from bottlecap.plugin import BottleCap
+        recorder = self
+        building = []
+
+        def wrap_init(init):
+            @functools.wraps(init)
+            def __init__(app, *args, **kwargs):
+                start = perf_counter_ns()
+                init(app, *args, **kwargs)
+                recorder.apps.append((app, perf_counter_ns() - start))
+            return __init__
+
+        def wrap_routecbv(routecbv):
+            @functools.wraps(routecbv)
+            def routecbv_wrapper(app, view):
+                building.append(len(recorder.routes))
+                start = perf_counter_ns()
+                try:
+                    return routecbv(app, view)
+                finally:
+                    elapsed = perf_counter_ns() - start
+                    added = recorder.routes[building.pop():]
+                    for entry in added:
+                        entry['register_ns'] = elapsed // len(added)
+            return routecbv_wrapper
+
+        def wrap_add_route(add_route):
+            @functools.wraps(add_route)
+            def add_route_wrapper(app, route):
+                start = perf_counter_ns()
+                try:
+                    return add_route(app, route)
+                finally:
+                    recorder.routes.append(dict(
+                        route=route, register_ns=perf_counter_ns() - start,
+                        prepare_ns=None))
+            return add_route_wrapper
+
+        self.patch(BottleCap, '__init__', wrap_init)
+        self.patch(BottleCap, 'routecbv', wrap_routecbv)
+        self.patch(BottleCap, 'add_route', wrap_add_route)
+
+    def uninstall(self):
+        while self.patched:
+            cls, name, original = self.patched.pop()
+            setattr(cls, name, original)
+
+    def prepare_routes(self):
+        for entry in self.routes:
+            start = perf_counter_ns()
+            entry['route'].prepare()
+            entry['prepare_ns'] = perf_counter_ns() - start
+
+    def to_dict(self):
+        apps = [ dict(app='{}.{}'.format(type(app).__module__, type(app).__name__),
+                      construct_ns=elapsed)
+                 for app, elapsed in self.apps ]
+        routes = [ dict(method=e['route'].method, rule=e['route'].rule,
+                        name=e['route'].name, register_ns=e['register_ns'],
+                        prepare_ns=e['prepare_ns'])
+                   for e in self.routes ]
+        return dict(apps=apps, routes=routes)
+
+
+def record_startup(target, output):
+    """Import app from `target`, and write recorded times to `output`"""
+    recorder = StartupRecorder()
+    recorder.install()
+    try:
+        # time the app module itself, then resolve its attribute. Unlike
+        # importlib.import_module(), __import__() is seen by -X importtime
+        start = perf_counter_ns()
+        __import__(target.partition(':')[0])
+        import_ns = perf_counter_ns() - start
+
+        from bottlecap.server import load_app
+        load_app(target)
+    finally:
+        recorder.uninstall()
+    recorder.prepare_routes()
+
+    data = recorder.to_dict()
+    data['import_ns'] = import_ns
+    with open(output, 'w') as fh:
+        json.dump(data, fh)
+
+
+class StartupReport:
+    """Import and app construction times of one fresh interpreter"""
+
+    def __init__(self, modules, apps, routes, import_ns, elapsed_ns):
+        self.modules = modules
+        self.apps = apps
+        self.routes = routes
+        self.import_ns = import_ns
+        self.elapsed_ns = elapsed_ns
+
+    def to_dict(self):
+        modules = [ dict(module=name, self_us=own, cumulative_us=cumulative,
+                         depth=depth)
+                    for name, own, cumulative, depth in self.modules ]
+        return dict(elapsed_ns=self.elapsed_ns, import_ns=self.import_ns,
+                    modules=modules, apps=self.apps, routes=self.routes)
+
+    def format(self, limit:int=25, sort:str='self'):
+        index = 1 if sort == 'self' else 2
+        modules = sorted(self.modules, key=lambda m: m[index], reverse=True)
+        lines = ['{:>10} {:>13}  {}'.format('self ms', 'cumulative ms', 'module')]
+        for name, own, cumulative, depth in modules[:limit]:
+            lines.append('{:>10.2f} {:>13.2f}  {}'.format(
+                own / 1e3, cumulative / 1e3, name))
+
+        lines.append('')
+        for app in self.apps:
+            lines.append('{:>10.2f} ms  construct {}'.format(
+                app['construct_ns'] / 1e6, app['app']))
+
+        lines.append('')
+        lines.append('{:>11} {:>10}  {}'.format('register ms', 'prepare ms', 'route'))
+        for route in self.routes:
+            lines.append('{:>11.3f} {:>10.3f}  {} {}{}'.format(
+                route['register_ns'] / 1e6, (route['prepare_ns'] or 0) / 1e6,
+                route['method'], route['rule'],
+                ' ({})'.format(route['name']) if route['name'] else ''))
+
+        lines.append('')
+        lines.append('{} modules, {:.1f} ms importing app, {:.1f} ms in total '
+                     'including interpreter startup'.format(
+                         len(self.modules), self.import_ns / 1e6,
+                         self.elapsed_ns / 1e6))
+        return '\n'.join(lines)
+
+
+def startup_report(target, python:str=None):
+    """
+    Import app from `target` in a fresh interpreter, returns StartupReport
+
+    :attr target: App as 'module:attribute', see `load_app()`
+    :attr python: Interpreter to use, defaults to the current one
+    """
+    fd, output = tempfile.mkstemp(prefix='bottlecap-startup-', suffix='.json')
+    os.close(fd)
+    try:
+        cmd = [python or sys.executable, '-X', 'importtime',
+               '-m', 'bottlecap.startup', target, output]
+        start = perf_counter_ns()
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+        elapsed_ns = perf_counter_ns() - start
+        if proc.returncode:
+            raise RuntimeError('Failed to import {}:\n{}'.format(
+                target, proc.stderr[-4000:]))
+        with open(output) as fh:
+            data = json.load(fh)
+    finally:
+        os.unlink(output)
+    return StartupReport(parse_importtime(proc.stderr), data['apps'],
+                         data['routes'], data['import_ns'], elapsed_ns)
+
+
+if __name__ == '__main__': # pragma: no cover
+    record_startup(sys.argv[1], sys.argv[2])
@@ -0,0 +1,210 @@
+"""
+Post-response background tasks for BottleCap
+"""
+
+import os
+import queue
+import atexit
+import logging
+import threading
+
+from time import monotonic
+from bottle import request
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['defer', 'TaskQueue']
+
+
+def defer(fn, *args, **kwargs):
+    """
+    Schedule callable to run once the response for current request
+    has been rendered. Tasks are discarded if the request fails.
+    """
+    tasks = request.environ.setdefault('bottlecap.tasks', [])
+    tasks.append((fn, args, kwargs))
+
+
+class LatencyStats:
+    """Running latency aggregate, in seconds"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self):
+        return dict(count=self.count, total=self.total, max=self.max,
+                    avg=self.total / self.count if self.count else 0.0)
+
+
+class TaskQueue:
+    """
+    Bounded queue of callables, executed by a pool of worker threads
+
+    When the queue is full, `submit()` blocks for up to `block_timeout`
+    seconds before the task is rejected, which applies backpressure to
+    producers. `submit_nowait()` rejects at once, and is used on the
+    request path so that a full queue never delays responses. Workers
+    are started lazily, and restarted after a fork, so the queue can be
+    created before workers are forked.
+    """
+
+    def __init__(self, workers:int=4, max_size:int=1000,
+                 block_timeout:float=1.0, name:str='bottlecap-task'):
+        self.workers = workers
+        self.max_size = max_size
+        self.block_timeout = block_timeout
+        self.name = name
+        self.lock = threading.Lock()
+        self.pid = None
+        self.threads = []
+        self.closed = False
+        self.queue = queue.Queue(max_size)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.running = 0
+        self.wait_time = LatencyStats()
+        self.run_time = LatencyStats()
+
+    def start(self):
+        """Start worker threads, if not already running in this process"""
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                # threads and queue state do not survive a fork
+                self.queue = queue.Queue(self.max_size)
+                self.reset_stats()
+            self.pid = os.getpid()
+            self.closed = False
+            self.threads = []
+            for x in range(self.workers):
+                thread = threading.Thread(target=self.worker, daemon=True,
+                    name='{}-{}'.format(self.name, x))
+                thread.start()
+                self.threads.append(thread)
+            atexit.register(self.shutdown)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue callable for execution
+
+        :returns: False if task was rejected
+        """
+        if self.pid != os.getpid():
+            self.start()
+        if self.closed:
+            raise RuntimeError('TaskQueue has been shut down')
+        return self.put(fn, args, kwargs, block=True)
+
+    def submit_nowait(self, fn, *args, **kwargs):
+        """
+        Queue callable for execution without blocking, rejecting it if
+        the queue is full or has been shut down
+
+        :returns: False if task was rejected
+        """
+        if self.pid != os.getpid():
+            self.start()
+        if self.closed:
+            with self.lock:
+                self.rejected += 1
+            logger.warning('Background task rejected, queue is shut down: %r',
+                           fn)
+            return False
+        return self.put(fn, args, kwargs, block=False)
+
+    def put(self, fn, args, kwargs, block):
+        try:
+            item = (fn, args, kwargs, monotonic())
+            self.queue.put(item, block, self.block_timeout)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            logger.warning('Background task rejected, queue is full: %r', fn)
+            return False
+
+        with self.lock:
+            self.submitted += 1
+        return True
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            fn, args, kwargs, queued = item
+            started = monotonic()
+            with self.lock:
+                self.running += 1
+                self.wait_time.add(started - queued)
+
+            failed = False
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                failed = True
+                logger.exception('Background task failed: %r', fn)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.run_time.add(monotonic() - started)
+                    if failed:
+                        self.failed += 1
+                    else:
+                        self.completed += 1
+                self.queue.task_done()
+
+    def shutdown(self, timeout:float=None):
+        """
+        Stop accepting tasks, and wait for queued tasks to complete
+
+        :returns: True if all workers finished within timeout, False if
+                  the queue stayed full or workers are still running
+        """
+        if self.pid != os.getpid() or self.closed:
+            return True
+        self.closed = True
+        atexit.unregister(self.shutdown)
+
+        deadline = None if timeout is None else monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0, deadline - monotonic())
+
+        # workers stop at a sentinel, which waits for room in a full queue
+        for thread in self.threads:
+            try:
+                self.queue.put(None, timeout=remaining())
+            except queue.Full:
+                return False
+        for thread in self.threads:
+            thread.join(remaining())
+        return not any(thread.is_alive() for thread in self.threads)
+
+    def stats(self):
+        """Returns queue depth, counters and latencies"""
+        with self.lock:
+            return dict(
+                depth=self.queue.qsize(),
+                running=self.running,
+                submitted=self.submitted,
+                completed=self.completed,
+                failed=self.failed,
+                rejected=self.rejected,
+                wait_time=self.wait_time.as_dict(),
+                run_time=self.run_time.as_dict())
@@ -0,0 +1,151 @@
+"""
+Per-phase request timing for BottleCap
+"""
+
+import threading
+
+from time import monotonic_ns
+from bottle import request, response, HTTPResponse
+
+from bottlecap.hooks import HookPlugin, get_meta
+
+__all__ = ['PhaseStats', 'RouteTimer', 'TimingPlugin', 'get_timings',
+           'format_server_timing']
+
+
+def get_timings():
+    """Returns phase timings of current request in nanoseconds, if timed"""
+    return request.environ.get('bottlecap.timings')
+
+
+def format_server_timing(timings):
+    """
+    Format nanosecond timings as `Server-Timing` header value
+
+    >>> format_server_timing({'dispatch': 1500000, 'total': 2000000})
+    'dispatch;dur=1.500, total;dur=2.000'
+    """
+    return ', '.join('{};dur={:.3f}'.format(phase, duration / 1e6)
+                     for phase, duration in timings.items())
+
+
+class PhaseStats:
+    """Running aggregate of a single phase, in nanoseconds"""
+
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def to_dict(self):
+        return dict(count=self.count,
+                    total_ms=self.total / 1e6,
+                    mean_ms=self.total / self.count / 1e6 if self.count else 0.0,
+                    max_ms=self.max / 1e6)
+
+
+class RouteTimer:
+    """
+    Collects phase timings for a single route
+
+    The route compiler wraps each named phase with calls to `clock`,
+    and passes the collected timings to `finish()`.
+    """
+
+    clock = staticmethod(monotonic_ns)
+
+    def __init__(self, plugin, route):
+        self.plugin = plugin
+        self.route = route
+        self.key = '{} {}'.format(route.method, route.rule)
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def environ_of():
+        return request.environ
+
+    def record(self, timings):
+        with self.lock:
+            for phase, duration in timings.items():
+                stats = self.phases.get(phase)
+                if stats is None:
+                    stats = self.phases[phase] = PhaseStats()
+                stats.add(duration)
+
+    def finish(self, timings, start, resp):
+        """Record timings of finished request, resp may be an exception"""
+        timings['total'] = monotonic_ns() - start
+        self.record(timings)
+        self.plugin.publish(self.route, timings)
+
+        if self.plugin.server_timing:
+            value = format_server_timing(timings)
+            if isinstance(resp, HTTPResponse):
+                resp.set_header('Server-Timing', value)
+            elif not isinstance(resp, Exception):
+                response.set_header('Server-Timing', value)
+        return resp
+
+    def summary(self):
+        with self.lock:
+            return { phase: stats.to_dict()
+                     for phase, stats in self.phases.items() }
+
+
+class TimingPlugin(HookPlugin):
+    """
+    Measures how long each phase of a request takes
+
+    Phases are `negotiate`, `parse`, `auth`, `dispatch` and `render`,
+    plus `total`; a phase which raises is only counted in `total`.
+    Timings of each request are sent to the app signal `signal_timing`,
+    optionally returned in the `Server-Timing` header, and aggregated
+    per route, see `summary()`.
+
+    Timing code is generated into the compiled route handler, so routes
+    which skip this plugin, or set `Meta.timing = False`, pay nothing.
+    Requires `RouteCompilerPlugin`, which is installed by BottleCap.
+    """
+
+    name = 'timing'
+
+    def __init__(self, server_timing:bool=False):
+        self.server_timing = server_timing
+        self.timers = {}
+
+    def get_route_timer(self, route):
+        """Returns timer for route, or None if route is not timed"""
+        if get_meta(route, 'timing') is False:
+            return None
+        timer = RouteTimer(self, route)
+        # routes are rebuilt on reset, keep their existing stats
+        existing = self.timers.get(timer.key)
+        if existing is not None:
+            timer.phases = existing.phases
+            timer.lock = existing.lock
+        self.timers[timer.key] = timer
+        return timer
+
+    def publish(self, route, timings):
+        sig = getattr(route.app, 'signal_timing', None)
+        if sig is not None and sig.receivers:
+            sig.send(route.app, route=route, timings=timings)
+
+    def summary(self):
+        """Returns aggregate phase timings in milliseconds, per route"""
+        return { key: timer.summary() for key, timer in self.timers.items() }
+
+    def reset(self):
+        """Discard aggregate timings"""
+        for timer in list(self.timers.values()):
+            with timer.lock:
+                timer.phases.clear()
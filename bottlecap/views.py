@@ -1,4 +1,5 @@
 from bottlecap.negotiation import ContentNegotiation
+from bottlecap import tasks
 from helpful import ClassDict
 
 ############################################################
@@ -29,12 +30,38 @@ class BaseView(metaclass=ViewMeta):
         plugins = None
         config = None
 
+        # Deadline in seconds, see `DeadlinePlugin`
+        timeout = None
+
+        # Share dispatch between identical concurrent GETs,
+        # see `CoalescingPlugin`
+        coalesce = False
+
+        # Set False to exclude from `TimingPlugin`
+        timing = True
+
+        # Cache rendered GET responses for seconds, with `cache_vary`
+        # headers, `cache_scope` and `cache_tags`, see `ResponseCachePlugin`
+        cache_ttl = None
+        cache_vary = None
+        cache_scope = None
+        cache_tags = None
+
     def __init__(self, **url_args):
         self.url_args = url_args
 
     def __call__(self):
         return self.dispatch()
 
+    def defer(self, fn, *args, **kwargs):
+        """Run callable in background once response has been rendered"""
+        tasks.defer(fn, *args, **kwargs)
+
+    def invalidate_cache(self, *tags):
+        """Drop cached responses with any of tags, see `ResponseCachePlugin`"""
+        from bottlecap.cache import invalidate
+        invalidate(*tags)
+
     def dispatch(self): # pragma: nocover
         # XXX: should replace with ABCs
         raise NotImplementedError("Subclass must implement dispatch")
@@ -43,6 +70,8 @@ class BaseView(metaclass=ViewMeta):
     def as_callable(cls):
         def inner(**url_args):
             return cls(**url_args)()
+        # allows route compiler to call view directly
+        inner.view_class = cls
         return inner
 
 
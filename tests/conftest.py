@@ -24,3 +24,29 @@ def app(request):
     app.route(HelloView)
    
     return app
+
+
+@pytest.fixture
+def jwt_pub_priv_key():
+    """
+    Generate random pub/priv key for JWT
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.backends import default_backend
+
+    key = rsa.generate_private_key(
+        backend=default_backend(), 
+        public_exponent=65537,
+        key_size=2048)
+
+    public_key = key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo)
+
+    pem = key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption())
+
+    return (public_key, pem)
@@ -0,0 +1,92 @@
+import io
+import os
+import json
+import pytest
+
+from bottlecap import BottleCap
+from bottlecap.views import View
+from bottlecap import exceptions as ex
+from bottlecap.negotiation import JSONRenderer, JSONParser
+from bottlecap.accesslog import AccessLogWriter
+from bottlecap.timing import TimingPlugin
+from webtest import TestApp
+
+
+class LoggedView(View):
+    class Meta:
+        name = 'logged'
+        path = '/logged'
+        method = ['GET', 'POST']
+        parser_classes = [JSONParser]
+        renderer_classes = [JSONRenderer]
+
+    def dispatch(self):
+        if self.fail:
+            raise ex.BadRequestError()
+        return {'ok': True}
+
+
+@pytest.fixture
+def lapp():
+    LoggedView.fail = False
+    stream = io.StringIO()
+    app = BottleCap(catchall=False, access_log=AccessLogWriter(
+        stream, flush_interval=60))
+    app.stream = stream
+    app.webtest = TestApp(app)
+    app.route(LoggedView)
+    yield app
+    app.close()
+
+
+def records(app):
+    app.access_log.flush()
+    return [ json.loads(line) for line in app.stream.getvalue().splitlines() ]
+
+
+def test_record(lapp):
+    lapp.webtest.post_json('/logged', {'a': 1})
+    LoggedView.fail = True
+    lapp.webtest.get('/logged', expect_errors=True)
+
+    ok, failed = records(lapp)
+    assert ok['method'] == 'POST' and ok['path'] == '/logged'
+    assert ok['route'] == 'logged'
+    assert ok['view'] == 'test_accesslog.LoggedView'
+    assert ok['renderer'] == 'JSONRenderer'
+    assert ok['parser'] == 'JSONParser'
+    assert ok['user'] is None
+    assert ok['status'] == 200
+    assert ok['bytes'] == len(b'{"ok": true}')
+    assert ok['duration_ms'] > 0
+    assert ok['timings'] is None
+
+    assert failed['status'] == 400
+    assert failed['parser'] is None
+    assert failed['bytes'] > 0
+
+
+def test_timings(lapp):
+    lapp.install(TimingPlugin())
+    lapp.webtest.get('/logged')
+    assert set(records(lapp)[0]['timings']) == {'negotiate', 'parse', 'dispatch', 'render'}
+
+
+@pytest.mark.parametrize('policy, kept', [('newest', [0, 1]), ('oldest', [3, 4])])
+def test_drop_policy(policy, kept):
+    stream = io.StringIO()
+    writer = AccessLogWriter(stream, capacity=2, drop_policy=policy)
+
+    # fill the buffer without a writer thread running
+    writer.pid = os.getpid()
+
+    results = [ writer.write({'n': x}) for x in range(5) ]
+    assert results.count(False) == (3 if policy == 'newest' else 0)
+    writer.flush()
+    assert [ json.loads(l)['n'] for l in stream.getvalue().splitlines() ] == kept
+    assert writer.stats() == dict(depth=0, written=2, dropped=3)
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        AccessLogWriter(drop_policy='block')
@@ -0,0 +1,181 @@
+import os
+import json
+import pytest
+
+from uuid import uuid4
+from bottle import request
+from bottlecap.apikey import (ApiKeyAuthPlugin, ApiKeyIndex, ApiKeyFile,
+                              generate_key, hash_key)
+from bottlecap.auth import (JWTAuthPlugin, User, AuthenticationViewMixin,
+                            RoleCheckPlugin)
+from bottlecap.views import View
+from bottlecap.negotiation import JSONParser, JSONRenderer
+
+
+def user_data(roles=(), is_active=True):
+    return dict(guid=str(uuid4()), roles=list(roles), is_active=is_active)
+
+
+def test_index_find():
+    index = ApiKeyIndex()
+    key, key_hash = generate_key('k1')
+    assert key.startswith('k1.') and key_hash == hash_key(key)
+
+    user = index.add('k1', key_hash, user_data(['Admin']))
+    assert isinstance(user, User) and user.has_role('admin')
+    assert index.find(key) is user
+    assert index.find(key + 'x') is None
+    assert index.find('k2.' + key.partition('.')[2]) is None
+    assert index.find('k1') is None and index.find('k1.') is None
+
+    index.remove('k1')
+    assert index.find(key) is None
+
+    with pytest.raises(ValueError):
+        index.add('k2', 'md5:abcd', user_data())
+
+
+def test_reload_from_file(tmpdir):
+    path = tmpdir.join('keys.json')
+    key1, hash1 = generate_key('k1')
+    key2, hash2 = generate_key('k2')
+    static, static_hash = generate_key('static')
+
+    def write(*entries):
+        path.write(json.dumps(dict(keys=[
+            dict(id=key_id, hash=key_hash, user=user_data())
+            for key_id, key_hash in entries])))
+        stat = os.stat(str(path))
+        os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    write(('k1', hash1))
+    index = ApiKeyIndex(ApiKeyFile(str(path)), refresh_interval=60)
+    index.add('static', static_hash, user_data())
+    assert index.find(key1) is not None and index.find(key2) is None
+    assert index.refresh() is False
+
+    # replaced by the next version, static keys are kept
+    write(('k2', hash2), ('bad', 'sha256:xyz'))
+    assert index.refresh() is True
+    assert index.find(key1) is None and index.find(key2) is not None
+    assert index.find(static) is not None
+    assert len(index) == 2
+
+    # invalid files keep the current keys
+    path.write('{')
+    assert index.refresh() is False
+    assert index.find(key2) is not None
+
+
+def test_plugin(app):
+    index = ApiKeyIndex()
+    key, key_hash = generate_key('svc')
+    guid = index.add('svc', key_hash, user_data()).guid
+    disabled, disabled_hash = generate_key('off')
+    index.add('off', disabled_hash, user_data(is_active=False))
+    app.install(ApiKeyAuthPlugin(index))
+
+    @app.route('/whoami')
+    def whoami():
+        user = request.user
+        return '{} {}'.format(request.api_key, user.guid if user else None)
+
+    assert app.webtest.get('/whoami').text == 'None None'
+    resp = app.webtest.get('/whoami', headers={'X-API-Key': key})
+    assert resp.text == 'svc {}'.format(guid)
+
+    def status(key):
+        return app.webtest.get('/whoami', headers={'X-API-Key': key},
+                               expect_errors=True).status_code
+    assert status(key[:-1]) == 401
+    assert status(' ') == 400
+    assert status(disabled) == 403
+
+
+class ServiceView(AuthenticationViewMixin, View):
+    roles_required = ['admin']
+    roles_accepted = ['eu', 'us']
+
+    class Meta:
+        path = '/service'
+        method = ['POST']
+        parser_classes = [JSONParser]
+        renderer_classes = [JSONRenderer]
+
+    def dispatch(self):
+        return request.body_parsed
+
+
+def test_view_roles(app):
+    index = ApiKeyIndex()
+    app.install(ApiKeyAuthPlugin(index))
+    app.route(ServiceView)
+
+    def post(roles, body='{"a": 1}'):
+        headers = {'Content-Type': 'application/json'}
+        if roles is not None:
+            key, key_hash = generate_key()
+            index.add(key.partition('.')[0], key_hash, user_data(roles))
+            headers['X-API-Key'] = key
+        return app.webtest.post('/service', body, headers=headers, expect_errors=True)
+
+    # rejected before the body is parsed
+    assert post(None, body='{').status_code == 401
+    assert post(['admin'], body='{').status_code == 403
+    assert post(['admin', 'staff']).status_code == 403
+    resp = post(['admin', 'us'])
+    assert resp.status_code == 200 and resp.json == {'a': 1}
+
+
+def test_with_jwt_plugin(app, jwt_pub_priv_key):
+    index = ApiKeyIndex()
+    pub, priv = jwt_pub_priv_key
+    jwt_plugin = JWTAuthPlugin(public_key=pub, private_key=priv)
+    app.install(ApiKeyAuthPlugin(index))
+    app.install(jwt_plugin)
+    app.route(ServiceView)
+
+    def post(key_roles=None, jwt_roles=None):
+        headers = {'Content-Type': 'application/json'}
+        if key_roles is not None:
+            key, key_hash = generate_key()
+            index.add(key.partition('.')[0], key_hash, user_data(key_roles))
+            headers['X-API-Key'] = key
+        if jwt_roles is not None:
+            token = jwt_plugin.token_encode(dict(user=user_data(jwt_roles)))
+            headers['Authorization'] = 'Bearer: ' + token
+        return app.webtest.post('/service', '{"a": 1}', headers=headers,
+                                expect_errors=True).status_code
+
+    # either scheme authenticates, roles are checked once both have run
+    assert post(key_roles=['admin', 'eu']) == 200
+    assert post(jwt_roles=['admin', 'eu']) == 200
+    assert post(key_roles=['admin'], jwt_roles=['admin', 'us']) == 200
+    assert post(key_roles=['admin']) == 403
+    assert post() == 401
+    assert sum(isinstance(p, RoleCheckPlugin) for p in app.plugins) == 1
+
+
+@pytest.mark.parametrize('scheme', ['apikey', 'jwt', 'jwt-cached'])
+def test_auth_benchmark(jwt_pub_priv_key, benchmark, scheme):
+    """Per-request cost of authentication, by API key and by RS512 JWT"""
+    benchmark.group = 'auth'
+    data = user_data(['admin'])
+    if scheme == 'apikey':
+        index = ApiKeyIndex()
+        key, key_hash = generate_key()
+        index.add(key.partition('.')[0], key_hash, data)
+        plugin = ApiKeyAuthPlugin(index)
+        environ = {'HTTP_X_API_KEY': key}
+    else:
+        pub, priv = jwt_pub_priv_key
+        plugin = JWTAuthPlugin(public_key=pub, private_key=priv,
+                               token_cache=scheme == 'jwt-cached')
+        token = plugin.token_encode(dict(user=data))
+        environ = {'HTTP_AUTHORIZATION': 'Bearer: ' + token}
+
+    def authenticate():
+        request.bind(dict(environ))
+        plugin.authenticate()
+        return request.user
+    assert str(benchmark(authenticate).guid) == data['guid']
@@ -1,35 +1,20 @@
 import pytest
+import os
 import jwt
+import json
+import time
+import threading
 
-from uuid import uuid4
+from uuid import UUID, uuid4
+from box import BoxError
 from bottle import request
-from bottlecap.auth import User, JWTAuthPlugin
-
-
-@pytest.fixture
-def jwt_pub_priv_key():
-    """
-    Generate random pub/priv key for JWT
-    """
-    from cryptography.hazmat.primitives import serialization
-    from cryptography.hazmat.primitives.asymmetric import rsa
-    from cryptography.hazmat.backends import default_backend
-
-    key = rsa.generate_private_key(
-        backend=default_backend(), 
-        public_exponent=65537,
-        key_size=2048)
-
-    public_key = key.public_key().public_bytes(
-        serialization.Encoding.PEM,
-        serialization.PublicFormat.SubjectPublicKeyInfo)
-
-    pem = key.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.TraditionalOpenSSL,
-        encryption_algorithm=serialization.NoEncryption())
-
-    return (public_key, pem)
+from bottlecap import exceptions as ex
+from bottlecap.views import View
+from bottlecap.negotiation import JSONParser, JSONRenderer
+from bottlecap.auth import (User, JWTAuthPlugin, TokenCache, KeyRing, JWKSFile,
+                            RoleRegistry, RoleRequirement, AuthenticationViewMixin,
+                            UserLoader, TokenIssuer, TokenView, role_registry)
+from bottlecap.metrics import MetricsRegistry
 
 
 @pytest.fixture
@@ -52,14 +37,25 @@ class TestUser:
         with pytest.raises(AttributeError):
             dummyuser.options = {}
 
-        dummyuser.options.hello = 'wtf'
+        # options are read-only, and built once
+        with pytest.raises(BoxError):
+            dummyuser.options.hello = 'wtf'
         assert dummyuser.options.hello == 'world'
+        assert dummyuser.options is dummyuser.options
 
     def test_roles(self, dummyuser):
         assert dummyuser.roles == set(['r1', 'r2', 'r3'])
         with pytest.raises(AttributeError):
             dummyuser.roles = []
 
+    def test_roles_normalized(self):
+        user = User(guid=uuid4(), roles=['Admin', 'EDITOR'], is_active=True)
+        assert user.roles == frozenset(['admin', 'editor'])
+        assert user.has_roles() is True
+        assert user.has_any_role() is False
+        with pytest.raises(AttributeError):
+            user.extra = 1
+
     def test_has_role(self, dummyuser):
         assert dummyuser.has_role('r1') is True
         assert dummyuser.has_role('no') is False
@@ -78,12 +74,12 @@ class TestUser:
 
 class TestJWTAuthPlugin:
 
-    def create_plugin(self):
-        pub, priv = jwt_pub_priv_key()
+    def create_plugin(self, jwt_pub_priv_key):
+        pub, priv = jwt_pub_priv_key
         return JWTAuthPlugin(public_key=pub, private_key=priv, valsig=True)
 
-    def test_jwt_encode_decode(self):
-        jap = self.create_plugin()
+    def test_jwt_encode_decode(self, jwt_pub_priv_key):
+        jap = self.create_plugin(jwt_pub_priv_key)
 
         data = dict(hello='world')
         token = jap.token_encode(data)
@@ -91,9 +87,9 @@ class TestJWTAuthPlugin:
         data_decoded = jap.token_decode(token)
         assert data == data_decoded
 
-    def test_request_token(self, app):
+    def test_request_token(self, app, jwt_pub_priv_key):
         # install plugin
-        jap = self.create_plugin()
+        jap = self.create_plugin(jwt_pub_priv_key)
         app.install(jap)
 
         # if no auth header provided, then don't expect a token
@@ -131,3 +127,465 @@ class TestJWTAuthPlugin:
                              'error_detail': 'Failed to decode token',
                              'status_code': 400}
 
+
+
+def test_jwt_warmup(jwt_pub_priv_key):
+    pub, priv = jwt_pub_priv_key
+    jap = JWTAuthPlugin(public_key=pub, private_key=priv, valsig=True)
+    jap.warmup(None)
+    assert not isinstance(jap.jwt_public_key, (str, bytes))
+    assert not isinstance(jap.jwt_private_key, (str, bytes))
+
+    token = jap.token_encode(dict(hello='world'))
+    assert jap.token_decode(token) == dict(hello='world')
+
+
+def encode(jap, claims):
+    token = jap.token_encode(claims)
+    # PyJWT before 2.0 returns bytes
+    return token.decode() if isinstance(token, bytes) else token
+
+
+def user_claims(**kwargs):
+    claims = dict(user=dict(guid=str(uuid4()), roles=['admin'], is_active=True))
+    claims.update(kwargs)
+    return claims
+
+
+def test_token_cache():
+    now = [1000]
+    cache = TokenCache(max_size=2, max_age=60, clock=lambda: now[0])
+    cache.set('a', dict(exp=1010))
+    cache.set('b', dict())
+    assert cache.get('a') == dict(exp=1010)
+
+    # expires at exp, or after max age
+    now[0] = 1010
+    assert cache.get('a') is None
+    assert cache.get('b') == {}
+    now[0] = 1060
+    assert cache.get('b') is None
+
+    # least recently used entry is evicted
+    for name in 'cde':
+        cache.set(name, dict(sub=name))
+    assert cache.get('c') is None
+    assert cache.evict('d') is True and cache.evict('d') is False
+    assert cache.evict_where(lambda claims: claims['sub'] == 'e') == 1
+    assert cache.stats() == dict(size=0, hits=2, misses=3, evictions=1, expired=2)
+
+
+def test_verify_token_cached(jwt_pub_priv_key, monkeypatch):
+    pub, priv = jwt_pub_priv_key
+    jap = JWTAuthPlugin(public_key=pub, private_key=priv)
+    token = encode(jap, user_claims(exp=int(time.time()) + 60))
+
+    calls = []
+    decode = jap.token_decode
+    monkeypatch.setattr(jap, 'token_decode', lambda t: calls.append(t) or decode(t))
+    first = jap.verify_token(token)
+    assert jap.verify_token(token) is first
+    assert len(calls) == 1
+    assert jap.token_cache.stats()['hits'] == 1
+
+    jap.token_cache.evict(token)
+    jap.verify_token(token)
+    assert len(calls) == 2
+
+    with pytest.raises(jwt.exceptions.InvalidTokenError):
+        jap.verify_token(token[:-4] + 'AAAA')
+
+    uncached = JWTAuthPlugin(public_key=pub, token_cache=False)
+    assert uncached.token_cache is None
+    assert uncached.verify_token(token) == first
+
+
+def test_authenticate_user(app, jwt_pub_priv_key):
+    pub, priv = jwt_pub_priv_key
+    jap = JWTAuthPlugin(public_key=pub, private_key=priv)
+    app.install(jap)
+
+    @app.route('/whoami')
+    def whoami():
+        return str(request.user.guid)
+
+    claims = user_claims()
+    headers = {'Authorization': 'Bearer: ' + encode(jap, claims)}
+    for x in range(2):
+        resp = app.webtest.get('/whoami', headers=headers)
+        assert resp.text == claims['user']['guid']
+
+    claims['user']['is_active'] = False
+    resp = app.webtest.get('/whoami', expect_errors=True,
+                           headers={'Authorization': 'Bearer: ' + encode(jap, claims)})
+    assert resp.status_code == 403
+
+    token = encode(jap, dict(user=dict(guid='invalid')))
+    resp = app.webtest.get('/whoami', expect_errors=True,
+                           headers={'Authorization': 'Bearer: ' + token})
+    assert resp.status_code == 400
+
+
+def rsa_key_pair():
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.backends import default_backend
+    key = rsa.generate_private_key(backend=default_backend(),
+                                   public_exponent=65537, key_size=2048)
+    return key.public_key(), key
+
+
+def write_jwks(path, **keys):
+    from jwt.algorithms import RSAAlgorithm
+    jwks = dict(keys=[ dict(json.loads(RSAAlgorithm.to_jwk(key)), kid=kid, alg='RS512')
+                       for kid, key in keys.items() ])
+    path.write(json.dumps(jwks))
+    # ensure the change is seen on filesystems with coarse timestamps
+    stat = os.stat(str(path))
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_keyring_rotation(tmpdir):
+    (pub1, priv1), (pub2, priv2) = rsa_key_pair(), rsa_key_pair()
+    path = tmpdir.join('jwks.json')
+    write_jwks(path, k1=pub1)
+
+    now = [0]
+    calls = []
+    source = JWKSFile(str(path))
+    ring = KeyRing(source=lambda: calls.append(1) or source(),
+                   refresh_interval=60, miss_interval=5, clock=lambda: now[0])
+    verifier = JWTAuthPlugin(keyring=ring, token_cache=False)
+    signer1 = JWTAuthPlugin(private_key=priv1, kid='k1', token_cache=False)
+    signer2 = JWTAuthPlugin(private_key=priv2, kid='k2', token_cache=False)
+    token1, token2 = encode(signer1, dict(n=1)), encode(signer2, dict(n=2))
+
+    assert verifier.token_decode(token1) == dict(n=1)
+    assert len(calls) == 1
+
+    # unknown kid refreshes at most once per miss interval
+    write_jwks(path, k1=pub1, k2=pub2)
+    for x in range(2):
+        with pytest.raises(jwt.exceptions.InvalidTokenError):
+            verifier.token_decode(token2)
+    assert len(calls) == 1
+    now[0] = 10
+    assert verifier.token_decode(token2) == dict(n=2)
+    assert verifier.token_decode(token1) == dict(n=1)
+    assert len(calls) == 2
+
+    # retired keys are dropped on the next periodic refresh
+    write_jwks(path, k2=pub2)
+    now[0] = 100
+    with pytest.raises(jwt.exceptions.InvalidTokenError):
+        verifier.token_decode(token1)
+    assert verifier.token_decode(token2) == dict(n=2)
+
+    # invalid documents keep the current keys
+    path.write('{')
+    now[0] = 200
+    assert verifier.token_decode(token2) == dict(n=2)
+
+
+def test_keyring_static_keys(jwt_pub_priv_key):
+    pub, priv = jwt_pub_priv_key
+    jap = JWTAuthPlugin(public_key=pub, private_key=priv, kid='main')
+    assert jwt.get_unverified_header(encode(jap, {}))['kid'] == 'main'
+    assert jap.keyring.find(None) == jap.keyring.find('main')
+
+    # keys given by the JWK must be allowed by the plugin
+    from jwt.algorithms import RSAAlgorithm
+    jwk = json.loads(RSAAlgorithm.to_jwk(jap.jwt_public_key))
+    jap.keyring.add('rs256', jwk, algorithm='RS256')
+    token = jwt.encode({}, priv, algorithm='RS256', headers={'kid': 'rs256'})
+    with pytest.raises(jwt.exceptions.InvalidAlgorithmError):
+        jap.token_decode(token)
+    jap.keyring.remove('rs256')
+    with pytest.raises(jwt.exceptions.InvalidTokenError):
+        KeyRing().find('rs256')
+
+
+def test_keyring_unknown_kid(jwt_pub_priv_key):
+    pub, priv = jwt_pub_priv_key
+    jap = JWTAuthPlugin(public_key=pub, private_key=priv)
+    assert jap.keyring.find(None)
+
+    # the key without kid is never used for tokens naming another
+    token = jwt.encode({}, priv, algorithm='RS512', headers={'kid': 'gone'})
+    with pytest.raises(jwt.exceptions.InvalidTokenError):
+        jap.keyring.find('gone')
+    with pytest.raises(jwt.exceptions.InvalidTokenError):
+        jap.token_decode(token)
+
+
+def test_role_requirement():
+    registry = RoleRegistry()
+    requirement = RoleRequirement(roles_required=['Admin', 'staff'],
+                                  roles_accepted=['eu', 'us'], registry=registry)
+    assert (requirement.required, requirement.accepted) == (3, 12)
+
+    optional = RoleRequirement(user_required=False, registry=registry)
+    optional.check(None)
+    with pytest.raises(ex.NotAuthenticatedError):
+        requirement.check(None)
+
+    # bits of the requirement's registry are used, not the global ones
+    role_registry.mask(['us', 'eu', 'staff', 'admin'])
+    user = User(guid=uuid4(), roles=['admin', 'staff', 'us'], is_active=True)
+    requirement.check(user)
+    with pytest.raises(ex.NotAuthorizedError):
+        requirement.check(User(guid=uuid4(), roles=['admin', 'eu'], is_active=True))
+    assert user.role_mask_for(registry) == 1 | 2 | 8
+
+
+def test_user_role_mask():
+    user = User(guid=uuid4(), roles=['Mask-A', 'mask-b'], is_active=True)
+    mask_a = role_registry.intern('mask-a')
+    assert user.role_mask == mask_a
+
+    # roles interned after the mask was built are picked up
+    mask_b = role_registry.intern('MASK-B')
+    assert user.role_mask == mask_a | mask_b
+
+
+class AdminView(AuthenticationViewMixin, View):
+    roles_required = ['admin']
+    roles_accepted = ['eu', 'us']
+
+    class Meta:
+        path = '/admin'
+        method = ['POST']
+        parser_classes = [JSONParser]
+        renderer_classes = [JSONRenderer]
+
+    def dispatch(self):
+        AdminView.users.append(request.user)
+        return request.body_parsed
+
+
+def test_view_roles(app, jwt_pub_priv_key):
+    pub, priv = jwt_pub_priv_key
+    jap = JWTAuthPlugin(public_key=pub, private_key=priv)
+    app.install(jap)
+    app.route(AdminView)
+    AdminView.users = []
+
+    def post(roles, body='{"a": 1}'):
+        headers = {'Content-Type': 'application/json'}
+        if roles is not None:
+            claims = dict(user=dict(guid=str(uuid4()), roles=roles, is_active=True))
+            headers['Authorization'] = 'Bearer: ' + encode(jap, claims)
+        return app.webtest.post('/admin', body, headers=headers, expect_errors=True)
+
+    # rejected before the body is parsed
+    assert post(None, body='{').status_code == 401
+    assert post(['admin'], body='{').status_code == 403
+    assert post(['ADMIN', 'EU'], body='{').status_code == 400
+
+    assert post(['admin', 'staff']).status_code == 403
+    resp = post(['admin', 'us'])
+    assert resp.status_code == 200 and resp.json == {'a': 1}
+
+    # user is built once per cached token
+    claims = dict(user=dict(guid=str(uuid4()), roles=['admin', 'eu'], is_active=True))
+    headers = {'Authorization': 'Bearer: ' + encode(jap, claims)}
+    for x in range(2):
+        app.webtest.post_json('/admin', {}, headers=headers)
+    assert AdminView.users[-1] is AdminView.users[-2]
+
+
+def test_user_loader():
+    now = [1000]
+    registry = MetricsRegistry()
+    known = uuid4()
+    store = {known: User(guid=known, roles=['admin'], is_active=True)}
+    loads = []
+    def load(guid):
+        loads.append(guid)
+        return store.get(guid)
+
+    loader = UserLoader(load, ttl=60, negative_ttl=10, metrics=registry,
+                        clock=lambda: now[0])
+    missing = uuid4()
+    for x in range(3):
+        assert loader.get(known) is store[known]
+        assert loader.get(missing) is None
+    assert loads == [known, missing]
+
+    # negative entries expire sooner
+    now[0] += 30
+    assert loader.get(missing) is None and loader.get(known) is store[known]
+    assert loads == [known, missing, missing]
+
+    loader.invalidate(known)
+    loader.get(known)
+    assert loads[-1] == known
+    assert loader.stats() == dict(size=2, hits=5, misses=4, shared=0)
+
+    counters = registry.snapshot()['counters']
+    assert counters[('user_loader', (('result', 'hit'),))] == 3
+    assert counters[('user_loader', (('result', 'negative_hit'),))] == 2
+    assert counters[('user_loader', (('result', 'miss'),))] == 4
+    assert registry.snapshot()['observed'][('user_loader_load', ())][1] == 4
+
+
+def test_user_loader_single_flight():
+    guid = uuid4()
+    started, release = threading.Event(), threading.Event()
+    loads = []
+    def load(guid):
+        loads.append(guid)
+        started.set()
+        release.wait(5)
+        if len(loads) == 1:
+            raise ValueError('store unavailable')
+        return User(guid=guid, roles=[], is_active=True)
+
+    loader = UserLoader(load)
+    results = []
+    def get():
+        try:
+            results.append(loader.get(guid))
+        except ValueError as exc:
+            results.append(exc)
+
+    threads = [ threading.Thread(target=get) for x in range(4) ]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]: thread.start()
+    deadline = time.monotonic() + 5
+    while loader.flight.calls[guid].waiters < 3:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+    release.set()
+    for thread in threads: thread.join()
+
+    # errors are shared with waiters, but not cached
+    assert len(loads) == 1 and loader.stats()['shared'] == 3
+    assert all(isinstance(r, ValueError) for r in results)
+    assert loader.get(guid).guid == guid and len(loads) == 2
+
+
+def test_plugin_user_loader(jwt_pub_priv_key):
+    from bottlecap import BottleCap
+    from webtest import TestApp
+    pub, priv = jwt_pub_priv_key
+    store = {}
+    loader = UserLoader(store.get)
+    jap = JWTAuthPlugin(public_key=pub, private_key=priv, user_loader=loader)
+    app = BottleCap(catchall=False, metrics=True)
+    app.install(jap)
+    assert loader.metrics is app.metrics
+
+    @app.route('/roles')
+    def roles():
+        return ','.join(sorted(request.user.roles))
+
+    claims = user_claims()
+    guid = UUID(claims['user']['guid'])
+    headers = {'Authorization': 'Bearer: ' + encode(jap, claims)}
+    webtest = TestApp(app)
+
+    # roles come from the store, not claims
+    store[guid] = User(guid=guid, roles=['Store'], is_active=True)
+    assert webtest.get('/roles', headers=headers).text == 'store'
+
+    store[guid] = User(guid=guid, roles=[], is_active=False)
+    loader.invalidate(guid)
+    assert webtest.get('/roles', headers=headers, expect_errors=True).status_code == 403
+
+    del store[guid]
+    loader.invalidate(guid)
+    assert webtest.get('/roles', headers=headers, expect_errors=True).status_code == 401
+
+    text = app.metrics.render()
+    assert 'bottlecap_user_loader_total{result="miss"} 3' in text
+    assert 'bottlecap_user_loader_load_seconds_count 3' in text
+
+
+def test_token_issuer(jwt_pub_priv_key):
+    from datetime import datetime, timezone
+    pub, priv = jwt_pub_priv_key
+    issuer = TokenIssuer(priv, kid='k1', access_ttl=60, clock=lambda: 1000)
+    jap = JWTAuthPlugin(public_key=pub, kid='k1', issuer=issuer)
+
+    token = issuer.issue(dict(sub='a'))
+    assert jwt.get_unverified_header(token) == dict(alg='RS512', typ='JWT', kid='k1')
+    claims = jwt.decode(token, options=dict(verify_signature=False))
+    assert claims['exp'] == 1060 and claims['type'] == 'access'
+    assert jap.token_decode(jap.token_encode(dict(
+        sub='b', nbf=datetime(2000, 1, 1, tzinfo=timezone.utc)))) == dict(
+        sub='b', nbf=946684800)
+
+    pair = issuer.issue_pair(dict(sub='a'))
+    tokens = [ jwt.decode(pair[k], options=dict(verify_signature=False))
+               for k in ('access_token', 'refresh_token') ]
+    assert [ t['type'] for t in tokens ] == ['access', 'refresh']
+    assert tokens[1]['exp'] == 1000 + issuer.refresh_ttl
+
+
+def test_token_issuer_pool(jwt_pub_priv_key):
+    pub, priv = jwt_pub_priv_key
+    issuer = TokenIssuer(priv, workers=3, max_pending=1)
+    try:
+        tokens = issuer.issue_many([ dict(n=n) for n in range(10) ])
+        assert [ jwt.decode(t, pub, algorithms=['RS512'])['n'] for t in tokens ] \
+            == list(range(10))
+
+        assert issuer.call(issuer.issue, dict(n=1)).count('.') == 2
+        issuer.pending = issuer.max_pending
+        with pytest.raises(ex.TooManyRequestsError):
+            issuer.call(issuer.issue, dict(n=1))
+    finally:
+        issuer.shutdown()
+
+
+class PasswordTokenView(TokenView):
+    def authenticate_grant(self, body):
+        if body.get('password') != 'secret':
+            raise ex.NotAuthenticatedError()
+        return dict(user=dict(guid=str(uuid4()), roles=[], is_active=True))
+
+
+def test_token_view(app, jwt_pub_priv_key):
+    pub, priv = jwt_pub_priv_key
+    jap = JWTAuthPlugin(public_key=pub, private_key=priv,
+                        issuer=TokenIssuer(priv, workers=2))
+    app.install(jap)
+    app.route(PasswordTokenView)
+
+    def token(body):
+        return app.webtest.post_json('/token', body, expect_errors=True)
+
+    assert token(dict(grant_type='password', password='wrong')).status_code == 401
+    pair = token(dict(grant_type='password', password='secret')).json
+    assert pair['token_type'] == 'Bearer'
+
+    def hello(raw):
+        return app.webtest.get('/hello', expect_errors=True,
+                               headers={'Authorization': 'Bearer: ' + raw})
+    assert hello(pair['access_token']).status_code == 200
+    assert hello(pair['refresh_token']).status_code == 401
+
+    refreshed = token(dict(grant_type='refresh_token',
+                           refresh_token=pair['refresh_token'])).json
+    assert refreshed['access_token'] != pair['access_token']
+    assert jap.token_decode(refreshed['access_token'])['user'] == \
+        jap.token_decode(pair['access_token'])['user']
+
+    resp = token(dict(grant_type='refresh_token', refresh_token=pair['access_token']))
+    assert resp.status_code == 401
+    jap.close()
+
+
+@pytest.mark.parametrize('method', ['jwt.encode', 'issuer'])
+def test_token_encode_benchmark(jwt_pub_priv_key, benchmark, method):
+    """Cost of signing a token with PEM key, against a parsed key"""
+    benchmark.group = 'token-encode'
+    pub, priv = jwt_pub_priv_key
+    claims = user_claims()
+    if method == 'issuer':
+        encode = TokenIssuer(priv).encode
+    else:
+        encode = lambda claims: jwt.encode(claims, priv, algorithm='RS512')
+    token = benchmark(encode, claims)
+    assert jwt.decode(token, pub, algorithms=['RS512']) == claims
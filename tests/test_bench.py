@@ -0,0 +1,108 @@
+import os
+import json
+import pytest
+
+from bottle import request
+from bottlecap import BottleCap
+from bottlecap.views import View
+from bottlecap.negotiation import JSONRenderer, JSONParser
+from bottlecap.bench import (Benchmark, BenchResult, BenchRequest,
+                             load_requests, generate_requests)
+
+
+class EchoView(View):
+    class Meta:
+        name = 'echo'
+        path = '/echo'
+        method = ['GET', 'POST']
+        parser_classes = [JSONParser]
+        renderer_classes = [JSONRenderer]
+
+    def dispatch(self):
+        return {'q': request.query.get('q')}
+
+
+@pytest.fixture
+def bapp():
+    app = BottleCap()
+    app.route(EchoView)
+
+    @app.route('/items/<id>')
+    def item(id):
+        return id
+
+    @app.route('/fail')
+    def fail():
+        raise ValueError()
+
+    yield app
+    app.close()
+
+
+def test_request_environ():
+    req = BenchRequest.from_dict({
+        'path': '/echo?q=1', 'json': {'a': 1}, 'headers': {'X-Test': 'yes'}})
+    environ = req.environ()
+    assert environ['REQUEST_METHOD'] == 'POST'
+    assert environ['CONTENT_TYPE'] == 'application/json'
+    assert environ['HTTP_X_TEST'] == 'yes'
+    assert environ['wsgi.input'].read() == b'{"a": 1}'
+    # each request gets its own body stream
+    assert req.environ()['wsgi.input'].read() == b'{"a": 1}'
+
+
+def test_load_requests(tmpdir):
+    path = tmpdir.join('mix.jsonl')
+    path.write('# comment\n\n{"path": "/echo", "weight": 3}\n{"path": "/x", "name": "x"}\n')
+    requests = load_requests(str(path))
+    assert [ (r.name, r.weight) for r in requests ] == [('GET /echo', 3), ('x', 1)]
+
+    path.write('{"weight": 1}\n')
+    with pytest.raises(ValueError, match='mix.jsonl:1'):
+        load_requests(str(path))
+
+
+def test_generate_requests(bapp):
+    names = [ r.name for r in generate_requests(bapp) ]
+    assert names == ['GET echo', 'GET /fail']
+
+
+def test_run(bapp):
+    requests = [
+        BenchRequest.from_dict({'path': '/echo?q=1', 'weight': 3}),
+        BenchRequest.from_dict({'path': '/echo', 'json': [1]}),
+        BenchRequest('GET', '/fail')]
+    result = Benchmark(bapp, requests, threads=2, warmup=1).run(
+        requests=50, rounds=2)
+
+    assert result.total == 50
+    assert result.throughput > 0
+    get, post, fail = (result.routes[n] for n in ('GET /echo', 'POST /echo', 'GET /fail'))
+    assert get.statuses == {200: get.count}
+    assert post.statuses == {200: post.count}
+    assert get.count > post.count
+    assert fail.errors == fail.count
+    assert get.latency.quantile(0.99) > 0
+    assert get.peak_bytes > 0
+
+    data = result.to_dict()
+    assert json.loads(json.dumps(data))['routes']['GET /fail']['statuses'] == {'500': fail.count}
+    assert 'requests/s' in result.format()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+def test_run_processes(bapp):
+    requests = [ BenchRequest('GET', '/echo') ]
+    result = Benchmark(bapp, requests, threads=2, processes=3, warmup=0).run(
+        requests=31, allocations=False)
+    assert result.total == 31
+    assert result.routes['GET /echo'].statuses == {200: 31}
+    assert result.routes['GET /echo'].peak_bytes is None
+
+
+def test_result_roundtrip():
+    result = BenchResult(start=1, end=2)
+    result.stats('a').latency.record(10)
+    result.stats('a').statuses[200] += 1
+    copy = BenchResult.loads(result.dumps())
+    assert copy.total == 1 and copy.routes['a'].statuses == {200: 1}
@@ -0,0 +1,222 @@
+import os
+import pytest
+
+from bottle import HTTPResponse, request
+from webtest import TestApp
+from bottlecap import BottleCap
+from bottlecap.views import View
+from bottlecap.auth import AuthenticationViewMixin
+from bottlecap.apikey import ApiKeyAuthPlugin, ApiKeyIndex, generate_key
+from bottlecap.negotiation import JSONRenderer, PlainTextRenderer, JSONParser
+from bottlecap.cache import MemoryBackend, SharedMemoryBackend
+
+
+class ItemView(View):
+    class Meta:
+        name = 'item'
+        path = '/items/<id>'
+        method = ['GET']
+        renderer_classes = [JSONRenderer, PlainTextRenderer]
+        cache_ttl = 60
+        cache_vary = ['Accept-Language']
+        cache_tags = ['items', 'item:{id}']
+
+    def dispatch(self):
+        ItemView.calls += 1
+        if self.url_args['id'] == 'missing':
+            return HTTPResponse({'error': 'missing'}, 404)
+        if request.nctx.renderer is PlainTextRenderer:
+            return 'item {}'.format(self.url_args['id'])
+        return {'id': self.url_args['id'], 'calls': ItemView.calls}
+
+
+class UpdateItemView(View):
+    class Meta:
+        path = '/items/<id>'
+        method = ['POST']
+        parser_classes = [JSONParser]
+        renderer_classes = [JSONRenderer]
+
+    def dispatch(self):
+        self.invalidate_cache('item:' + self.url_args['id'])
+        return {}
+
+
+class ReportView(AuthenticationViewMixin, View):
+    roles_required = ['reports']
+
+    class Meta:
+        path = '/report'
+        method = ['GET']
+        renderer_classes = [JSONRenderer]
+        cache_ttl = 60
+        cache_scope = 'public'
+
+    def dispatch(self):
+        ReportView.calls += 1
+        return {'calls': ReportView.calls}
+
+
+@pytest.fixture
+def capp():
+    ItemView.calls = ReportView.calls = 0
+    app = BottleCap(catchall=False, response_cache=True, metrics=True)
+    app.webtest = TestApp(app)
+    app.route(ItemView)
+    app.route(UpdateItemView)
+    return app
+
+
+class TestMemoryBackend:
+    def entry(self, body='x', tags=()):
+        return (200, (('Content-Type', 'text/plain'),), body, tags, (0,) * len(tags))
+
+    def test_lru_bytes(self):
+        backend = MemoryBackend(max_bytes=1000)
+        size = backend.entry_size(self.entry('x' * 200))
+        assert backend.set(b'a', self.entry('x' * 200), 60)
+        assert backend.set(b'b', self.entry('x' * 200), 60)
+        assert backend.get(b'a') is not None
+        assert backend.set(b'c', self.entry('x' * 200), 60)
+        assert backend.get(b'b') is None and backend.get(b'a') is not None
+        assert backend.stats() == dict(entries=2, bytes=2 * size, evictions=1)
+        assert not backend.set(b'd', self.entry('x' * 2000), 60)
+
+    def test_expiry_and_tags(self):
+        now = [1000]
+        backend = MemoryBackend(clock=lambda: now[0])
+        backend.set(b'a', self.entry(), 10)
+        now[0] += 10
+        assert backend.get(b'a') is None
+
+        assert backend.tag_versions(('t1', 't2')) == (0, 0)
+        backend.invalidate(('t1',))
+        assert backend.tag_versions(('t1', 't2')) == (1, 0)
+
+        # versions are bounded by the number of counters
+        backend = MemoryBackend(tag_slots=8)
+        backend.invalidate([ 'item:{}'.format(x) for x in range(1000) ])
+        assert len(backend.versions) == 8 and sum(backend.versions) == 1000
+
+
+class TestSharedMemoryBackend:
+    def test_get_set(self):
+        backend = SharedMemoryBackend(slots=8, slot_size=256)
+        entry = (200, (('Content-Type', 'text/plain'),), b'body', ('t',), (0,))
+        assert backend.set(b'k' * 20, entry, 60)
+        assert backend.get(b'k' * 20) == entry
+        assert backend.get(b'j' * 20) is None
+        backend.delete(b'j' * 20)
+        assert backend.get(b'k' * 20) == entry
+        backend.delete(b'k' * 20)
+        assert backend.get(b'k' * 20) is None
+        assert backend.set(b'k' * 20, entry, 60)
+        assert not backend.set(b'l' * 20, entry[:2] + (b'x' * 300,) + entry[3:], 60)
+
+        backend.clear()
+        assert backend.get(b'k' * 20) is None
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+    def test_shared_between_workers(self):
+        backend = SharedMemoryBackend(slots=8, slot_size=256)
+        entry = (200, (), 'from child', ('t',), (0,))
+        pid = os.fork()
+        if pid == 0:
+            try:
+                backend.set(b'k' * 20, entry, 60)
+                backend.invalidate(('other',))
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        assert backend.get(b'k' * 20) == entry
+        assert backend.tag_versions(('t', 'other')) == (0, 1)
+
+
+class TestResponseCachePlugin:
+    def test_hit_skips_dispatch(self, capp):
+        first = capp.webtest.get('/items/1')
+        assert first.json == {'id': '1', 'calls': 1}
+        second = capp.webtest.get('/items/1')
+        assert second.json == first.json
+        assert second.content_type == 'application/json'
+
+        # keyed by url args, query, media type and vary headers
+        assert capp.webtest.get('/items/2').json['calls'] == 2
+        assert capp.webtest.get('/items/1?x=1').json['calls'] == 3
+        assert capp.webtest.get('/items/1', headers={'Accept': 'text/plain'}) \
+            .content_type == 'text/plain'
+        capp.webtest.get('/items/1', headers={'Accept-Language': 'de'})
+        assert ItemView.calls == 5
+
+        # credentials scope by default
+        capp.webtest.get('/items/1', headers={'Authorization': 'Bearer: x'})
+        assert ItemView.calls == 6
+
+        text = capp.metrics.render()
+        assert 'bottlecap_response_cache_total{result="hit"} 1' in text
+        assert capp.response_cache.stats()['stores'] == 6
+
+    def test_errors_not_cached(self, capp):
+        for x in range(2):
+            capp.webtest.get('/items/missing', expect_errors=True)
+        assert ItemView.calls == 2
+
+    def test_invalidate(self, capp):
+        capp.webtest.get('/items/1')
+        capp.webtest.get('/items/2')
+        capp.webtest.post_json('/items/1', {})
+        assert capp.webtest.get('/items/1').json['calls'] == 3
+        assert capp.webtest.get('/items/2').json['calls'] == 2
+
+        capp.response_cache.invalidate('items')
+        assert capp.webtest.get('/items/2').json['calls'] == 4
+
+    def test_stale_deleted(self, capp):
+        capp.webtest.get('/items/1')
+        backend = capp.response_cache.backend
+        assert backend.stats()['entries'] == 1
+        capp.response_cache.invalidate('items')
+        assert capp.response_cache.get(list(backend.entries)[0]) is None
+        assert backend.stats() == dict(entries=0, bytes=0, evictions=0)
+
+    def test_roles_checked_on_hit(self, capp):
+        index = ApiKeyIndex()
+        capp.install(ApiKeyAuthPlugin(index))
+        capp.route(ReportView)
+
+        def get(roles):
+            key, key_hash = generate_key()
+            index.add(key.partition('.')[0], key_hash,
+                      dict(guid='00000000-0000-0000-0000-000000000001',
+                           roles=roles, is_active=True))
+            return capp.webtest.get('/report', headers={'X-API-Key': key},
+                                    expect_errors=True)
+
+        assert get(['reports']).json == {'calls': 1}
+        assert get(['reports']).json == {'calls': 1}
+        assert get([]).status_code == 403
+
+    def test_unknown_scope(self, capp):
+        class BadView(View):
+            class Meta:
+                path = '/bad'
+                method = ['GET']
+                cache_ttl = 1
+                cache_scope = 'everyone'
+
+            def dispatch(self):
+                return 'bad'
+
+        capp.route(BadView)
+        with pytest.raises(ValueError):
+            capp.routes[-1].prepare()
+
+    def test_disabled(self, app):
+        assert app.response_cache is None
+
+
+def test_cached_route_benchmark(capp, benchmark):
+    """Per-request cost of a cache hit, through the full app"""
+    capp.webtest.get('/items/1')
+    resp = benchmark(capp.webtest.get, '/items/1')
+    assert resp.json['calls'] == 1
@@ -0,0 +1,105 @@
+import time
+import pytest
+
+from webtest import TestApp
+from bottle import request
+from bottlecap import BottleCap
+from bottlecap.views import View
+from bottlecap.deadline import Deadline
+from bottlecap.negotiation import JSONRenderer, JSONParser
+from bottlecap import exceptions as ex
+
+
+class DeadlineView(View):
+    class Meta:
+        path = '/deadline'
+        method = ['GET', 'POST']
+        parser_classes = [JSONParser]
+        renderer_classes = [JSONRenderer]
+        timeout = 5
+
+    calls = 0
+
+    def dispatch(self):
+        DeadlineView.calls += 1
+        return request.deadline.remaining > 0
+
+
+class SlowView(DeadlineView):
+    class Meta:
+        path = '/slow'
+        timeout = 0.01
+
+    def dispatch(self):
+        time.sleep(0.02)
+        return 'too late'
+
+
+@pytest.fixture
+def dapp(app):
+    DeadlineView.calls = 0
+    app.route(DeadlineView)
+    app.route(SlowView)
+    return app
+
+
+class TestDeadline:
+    def test_remaining(self):
+        deadline = Deadline(10, start=time.monotonic() - 4)
+        assert 5.9 < deadline.remaining <= 6
+        assert deadline.expired is False
+        deadline.check()
+
+    def test_expired(self):
+        deadline = Deadline(1, start=time.monotonic() - 2)
+        assert deadline.remaining == 0
+        assert deadline.expired is True
+        with pytest.raises(ex.DeadlineExceededError):
+            deadline.check()
+
+
+class TestDeadlinePlugin:
+    def test_meta_timeout(self, dapp):
+        resp = dapp.webtest.get('/deadline')
+        assert resp.json is True
+        assert request.deadline.timeout == 5
+
+    def test_client_timeout(self, dapp):
+        dapp.webtest.get('/deadline', headers={'X-Request-Timeout': '2.5'})
+        assert request.deadline.timeout == 2.5
+
+        # client cannot extend beyond view timeout
+        dapp.webtest.get('/deadline', headers={'X-Request-Timeout': '60'})
+        assert request.deadline.timeout == 5
+
+        # malformed values are ignored
+        dapp.webtest.get('/deadline', headers={'X-Request-Timeout': 'wtf'})
+        assert request.deadline.timeout == 5
+
+    def test_no_timeout(self, app):
+        app.webtest.get('/hello')
+        assert request.deadline is None
+
+    def test_server_cap(self):
+        app = BottleCap(catchall=False, request_timeout=30, max_request_timeout=1)
+        app.route(DeadlineView)
+        TestApp(app).get('/deadline')
+        assert request.deadline.timeout == 1
+
+    def test_expired_before_dispatch(self, dapp):
+        resp = dapp.webtest.post_json('/deadline', params={'a': 'b'},
+            headers={'X-Request-Timeout': '0'}, expect_errors=True)
+        assert resp.status_code == 504
+        assert resp.json['error_code'] == 'deadline_exceeded'
+        assert DeadlineView.calls == 0
+        assert request.body_parsed is None
+
+    def test_expired_after_dispatch(self, dapp):
+        resp = dapp.webtest.get('/slow', expect_errors=True)
+        assert resp.status_code == 504
+        assert resp.headers['Content-Type'] == 'application/json; charset=UTF-8'
+        assert resp.json == {
+            'error_code': 'deadline_exceeded',
+            'error_desc': 'Request could not be completed within its deadline',
+            'error_detail': None,
+            'status_code': 504}
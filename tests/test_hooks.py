@@ -0,0 +1,133 @@
+import pytest
+
+from bottle import Bottle, request
+from webtest import TestApp
+from bottlecap.views import View
+from bottlecap.hooks import *
+
+
+class Recorder(HookPlugin):
+    """Records hook calls into `request.calls`"""
+
+    def __init__(self, name, short_circuit=False, fail=False):
+        self.name = name
+        self.short_circuit = short_circuit
+        self.fail = fail
+
+    def prepare(self, route):
+        def before():
+            request.environ.setdefault('calls', []).append(self.name + '.before')
+            if self.fail: raise ValueError(self.name)
+            if self.short_circuit: return self.name
+
+        def after(resp):
+            request.environ['calls'].append(self.name + '.after')
+            return resp
+
+        def error(exc):
+            request.environ['calls'].append(self.name + '.error')
+            raise KeyError(self.name)
+
+        return RouteHooks(before=before, after=after, error=error)
+
+
+class CountingView(View):
+    class Meta:
+        path = '/count'
+        method = ['GET']
+        name = 'count'
+
+    def dispatch(self):
+        request.environ.setdefault('calls', []).append('dispatch')
+        return 'hello'
+
+
+def legacy_plugin(callback):
+    def wrapper(*args, **kwargs):
+        request.environ.setdefault('calls', []).append('legacy')
+        return callback(*args, **kwargs)
+    return wrapper
+
+
+class TestCompileHandler:
+    def test_no_hooks(self):
+        callback = lambda: 'hello'
+        assert compile_handler(callback, []) is callback
+        assert compile_handler(callback, [None, RouteHooks()]) is callback
+
+    def test_order(self, app):
+        app.install(Recorder('a'))
+        app.install(Recorder('b'))
+        app.route(CountingView)
+        assert app.webtest.get('/count').body == b'hello'
+        assert request.environ['calls'] == [
+            'a.before', 'b.before', 'dispatch', 'b.after', 'a.after']
+
+    def test_before_order(self):
+        calls = []
+        hooks = [RouteHooks(before=lambda: calls.append('parse'), before_order=1,
+                            after=lambda resp: calls.append('render') or resp),
+                 RouteHooks(before=lambda: calls.append('auth'))]
+        assert compile_handler(lambda: 'hello', hooks)() == 'hello'
+        assert calls == ['auth', 'parse', 'render']
+
+    def test_short_circuit(self, app):
+        app.install(Recorder('a', short_circuit=True))
+        app.install(Recorder('b'))
+        app.route(CountingView)
+        assert app.webtest.get('/count').body == b'a'
+        assert request.environ['calls'] == ['a.before', 'b.after', 'a.after']
+
+    def test_error_replacement(self):
+        hooks = [RouteHooks(error=lambda exc: seen.append(exc)),
+                 RouteHooks(error=lambda exc: 1 / 0)]
+        seen = []
+        handler = compile_handler(lambda: {}['missing'], hooks)
+        with pytest.raises(ZeroDivisionError):
+            handler()
+        assert isinstance(seen[0], ZeroDivisionError)
+
+    def test_error(self, app):
+        app.install(Recorder('a'))
+        app.install(Recorder('b', fail=True))
+        app.route(CountingView)
+        app.catchall = True
+        app.webtest.get('/count', expect_errors=True)
+        assert request.environ['calls'] == [
+            'a.before', 'b.before', 'b.error', 'a.error']
+
+    def test_legacy_plugin(self, app):
+        app.install(legacy_plugin)
+        app.install(Recorder('a'))
+        app.route(CountingView)
+        app.webtest.get('/count')
+        assert request.environ['calls'] == [
+            'a.before', 'legacy', 'dispatch', 'a.after']
+
+
+class TestHookPlugin:
+    def test_without_compiler(self):
+        app = Bottle()
+        app.install(Recorder('a'))
+        app.route('/', callback=lambda: 'hello')
+        assert TestApp(app).get('/').body == b'hello'
+        assert request.environ['calls'] == ['a.before', 'a.after']
+
+    def test_get_meta(self, app):
+        app.route(CountingView)
+        assert get_meta(app.routes[-1], 'name') == 'count'
+        assert get_meta(app.routes[-1], 'missing', 1) == 1
+
+
+def test_route_overhead_benchmark(app, benchmark):
+    """Per-request overhead of compiled route on a trivial view"""
+    app.route(CountingView)
+    app.webtest.get('/count')
+    route = app.routes[-1]
+    environ = request.environ
+
+    def call():
+        environ.pop('bottle.request.ext.nctx', None)
+        environ.pop('calls', None)
+        return route.call()
+    assert benchmark(call).body == 'hello'
@@ -0,0 +1,146 @@
+import os
+import threading
+import pytest
+
+from bottlecap import BottleCap
+from bottlecap.views import View
+from bottlecap import exceptions as ex
+from bottlecap.negotiation import JSONRenderer
+from bottlecap.metrics import (Histogram, MetricsRegistry, SharedMetrics,
+    MetricsView, render_prometheus)
+from webtest import TestApp
+
+
+class CountedView(View):
+    class Meta:
+        name = 'counted'
+        path = '/counted'
+        method = ['GET']
+        renderer_classes = [JSONRenderer]
+
+    def dispatch(self):
+        if 'fail' in self.url_args or self.fail:
+            raise ex.BadRequestError()
+        return {'ok': True}
+
+
+@pytest.fixture
+def mapp():
+    CountedView.fail = False
+    app = BottleCap(catchall=False, metrics=True)
+    app.webtest = TestApp(app)
+    app.route(CountedView)
+    app.route(MetricsView)
+    return app
+
+
+def series(text, name):
+    return dict(line.rsplit(' ', 1) for line in text.splitlines()
+                if line.startswith(name))
+
+
+class TestHistogram:
+    def test_bounds(self):
+        for value in (0, 1, 5, 99, 1000, 123456, Histogram.MAX_VALUE - 1):
+            index = Histogram.bucket_index(value)
+            assert value < Histogram.bucket_upper(index)
+            assert value < Histogram.bucket_upper(index) * 1.25 + 1
+        assert Histogram.bucket_index(10**12) == Histogram.BUCKETS - 1
+
+    def test_quantile(self):
+        hist = Histogram()
+        for value in range(1, 1001):
+            hist.record(value)
+        assert 500 <= hist.quantile(0.5) <= 640
+        assert hist.quantile(1.0) >= 1000
+        assert hist.count == 1000 and hist.sum == 500500
+
+
+class TestRegistry:
+    def test_threads_merged(self):
+        registry = MetricsRegistry()
+
+        def worker():
+            for x in range(100):
+                registry.finish('r', 'text/plain', 200, registry.begin('r'))
+
+        threads = [ threading.Thread(target=worker) for x in range(4) ]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+
+        snapshot = registry.collect()
+        assert snapshot['requests'] == {('r', 'text/plain', '2xx'): 400}
+        assert snapshot['in_flight'] == {'r': 0}
+        assert snapshot['latency'][('r', 'text/plain')].count == 400
+
+        # finished threads are folded into the baseline
+        assert registry.threads == []
+        snapshot = registry.collect()
+        assert snapshot['requests'] == {('r', 'text/plain', '2xx'): 400}
+        assert snapshot['latency'][('r', 'text/plain')].count == 400
+
+    def test_counters(self):
+        registry = MetricsRegistry()
+        thread = threading.Thread(target=registry.count, args=('cache',),
+                                  kwargs=dict(result='hit'))
+        thread.start(); thread.join()
+        registry.count('cache', 2, result='hit')
+        registry.observe('load', 1500)
+
+        snapshot = registry.collect()
+        assert snapshot['counters'] == {('cache', (('result', 'hit'),)): 3}
+        text = render_prometheus(snapshot)
+        assert 'bottlecap_cache_total{result="hit"} 3' in text
+        assert 'bottlecap_load_seconds_sum 0.0015' in text
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+    def test_shared(self):
+        registry = MetricsRegistry(shared=SharedMetrics(workers=4))
+        registry.finish('r', '', 200, registry.begin('r'))
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                registry.finish('r', '', 500, registry.begin('r'))
+                registry.shared.publish(registry.snapshot())
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        snapshot = registry.collect()
+        assert snapshot['requests'] == {('r', '', '2xx'): 1, ('r', '', '5xx'): 1}
+
+        # a replacement worker inherits counters of the dead one
+        other = MetricsRegistry(shared=registry.shared)
+        registry.shared.pid = None
+        assert other.shared.claim(other) == 1
+        assert other.snapshot()['requests'] == {('r', '', '5xx'): 1}
+
+
+class TestMetricsView:
+    def test_prometheus(self, mapp):
+        mapp.webtest.get('/counted')
+        CountedView.fail = True
+        mapp.webtest.get('/counted', expect_errors=True)
+
+        resp = mapp.webtest.get('/metrics')
+        assert resp.content_type == 'text/plain'
+        counts = series(resp.text, 'bottlecap_requests_total')
+        assert counts['bottlecap_requests_total{route="counted",'
+                      'media_type="application/json",status="2xx"}'] == '1'
+        assert counts['bottlecap_requests_total{route="counted",'
+                      'media_type="application/json",status="4xx"}'] == '1'
+
+        buckets = series(resp.text, 'bottlecap_request_duration_seconds_bucket')
+        assert buckets['bottlecap_request_duration_seconds_bucket{route="counted",'
+                       'media_type="application/json",le="+Inf"}'] == '2'
+
+        # scrapes are not counted
+        assert 'route="metrics"' not in resp.text
+
+    def test_disabled(self, app):
+        assert app.metrics is None
+        assert 'metrics' not in [ p.name for p in app.plugins ]
+
+        app.route(MetricsView)
+        assert app.webtest.get('/metrics', expect_errors=True).status_code == 404
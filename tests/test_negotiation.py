@@ -4,6 +4,7 @@ from bottle import request
 from bottlecap.negotiation import *
 from bottlecap.mediatype import *
 from bottlecap.views import View
+from bottlecap import exceptions as ex
 
 class ExampleRenderer(Renderer):
     media_types = 'vnd/example'
@@ -78,6 +79,29 @@ class TestContentNegotiation:
         parser = cneg.select_parser('application/json')
         assert parser == None
 
+    def test_negotiate_accept_cache(self):
+        cneg = ContentNegotiation(renderer_classes=[JSONRenderer])
+        cneg.warmup(['*/*'])
+        assert set(cneg.accept_cache) == {'*/*', 'application/json'}
+
+        first = cneg.negotiate_accept('text/html, application/json')
+        assert cneg.negotiate_accept('text/html, application/json') is first
+        assert first[1:] == (JSONRenderer, 'application/json')
+
+        for x in range(2):
+            with pytest.raises(ex.ClientError):
+                cneg.negotiate_accept('invalid')
+        assert 'invalid' not in cneg.accept_cache
+
+        # least recently used headers are dropped
+        cneg.accept_cache_size = 3
+        cneg.negotiate_accept('*/*')
+        for x in range(5):
+            cneg.negotiate_accept('application/json; q=0.{}'.format(x + 1))
+            cneg.negotiate_accept('*/*')
+        assert len(cneg.accept_cache) == 3 and '*/*' in cneg.accept_cache
+        assert 'application/json; q=0.5' in cneg.accept_cache
+
 
 ###########################################################
 # Test cases for content negotiation parsers
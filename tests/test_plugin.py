@@ -4,9 +4,10 @@ from bottle import request
 from bottlecap import View
 
 class ExampleView(View):
-    name = 'test'
-    path = '/test'
-    method = 'GET'
+    class Meta:
+        name = 'test'
+        path = '/test'
+        method = 'GET'
 
     def dispatch(self):
         return 'yay'
@@ -18,3 +19,108 @@ def test_base_url(app):
     assert request.base_url == 'http://localhost'
     assert request.get_full_url('test') == 'http://localhost/test'
 
+
+
+@pytest.mark.parametrize("environ,expected", [
+    ({'HTTP_X_FORWARDED_PROTO': 'https', 'HTTP_HOST': 'example.com:443'},
+     'https://example.com'),
+    ({'HTTP_X_FORWARDED_PROTO': 'https', 'HTTP_HOST': 'example.com:8081'},
+     'https://example.com:8081'),
+    ({'HTTP_HOST': 'example.com:8080'}, 'http://example.com:8080'),
+])
+def test_base_url_port(app, environ, expected):
+    app.webtest.get('/hello', extra_environ=environ)
+    assert request.base_url == expected
+    assert request.environ['bottlecap.request.base_url'] == expected
+
+
+def test_request_class(app):
+    from bottlecap.plugin import BottleCapRequest
+    assert isinstance(request, BottleCapRequest)
+
+    # helpers are not assigned per request
+    app.webtest.get('/hello')
+    assert 'bottle.request.ext.base_url' not in request.environ
+    assert 'bottle.request.ext.get_full_url' not in request.environ
+
+
+class ItemListView(View):
+    class Meta:
+        name = 'items'
+        path = '/items'
+        method = 'GET'
+
+    def dispatch(self):
+        return ' '.join([ request.get_full_url('item', id=x, format='json')
+                          for x in range(1000) ])
+
+
+class ItemView(View):
+    class Meta:
+        name = 'item'
+        path = '/items/<id:int>'
+        method = 'GET'
+
+    def dispatch(self):
+        return 'item'
+
+
+@pytest.mark.parametrize("rule,kwargs", [
+    ('/a', {}),
+    ('/a/<id>', {'id': 'x y'}),
+    ('/a/<id:int>/b/<name>', {'id': 1, 'name': 'n', 'q': 'z'}),
+    ('/<name>/%', {'name': 'n'}),
+    ('/<:re:[a-z]+>', {'anon0': 'abc'}),
+    ('/a/<path:path>', {'path': 'b//c/./d'}),
+    ('/a/<path:path>', {'path': 'b/../../c'}),
+    ('/<path:path>', {'path': '.'}),
+    ('/<name>', {'name': 'mailto:x'}),
+    ('/<path:path>', {'path': '/foo'}),
+    ('/<path:path>', {'path': '//foo/bar'}),
+    ('/a/<path:path>', {'path': '/foo'}),
+])
+@pytest.mark.parametrize("script_name", ['', '/app', '/app/'])
+def test_get_full_url(app, rule, kwargs, script_name):
+    app.route(rule, name='test', callback=lambda **kw: 'ok')
+    app.webtest.get('/hello', extra_environ={'SCRIPT_NAME': script_name})
+
+    from six.moves.urllib.parse import urljoin
+    expected = urljoin(request.base_url, app.get_url('test', **kwargs))
+    assert request.get_full_url('test', **kwargs) == expected
+
+
+def test_get_full_url_rebound(app):
+    app.route('/a', name='test', callback=lambda: 'ok')
+    app.webtest.get('/hello')
+    assert request.get_full_url('test') == 'http://localhost/a'
+
+    app.route('/b', name='test', callback=lambda: 'ok')
+    assert request.get_full_url('test') == 'http://localhost/b'
+
+
+def test_get_full_url_benchmark(app, benchmark):
+    """Render response containing 1,000 links"""
+    app.route(ItemListView)
+    app.route(ItemView)
+    resp = benchmark(app.webtest.get, '/items')
+    links = resp.body.split(b' ')
+    assert len(links) == 1000
+    assert links[1] == b'http://localhost/items/1?format=json'
+
+
+def test_warmup(app):
+    import gc
+    from bottlecap.negotiation import ContentNegotiationPlugin
+    app.routecbv(ExampleView)
+    app.warmup()
+    try:
+        route = app.routes[-1]
+        assert 'call' in route.__dict__
+        assert 'test' in app.url_builders
+
+        cnp = [ p for p in app.plugins if isinstance(p, ContentNegotiationPlugin) ][0]
+        assert all('*/*' in cneg.accept_cache for cneg in cnp.negotiators)
+        assert gc.get_freeze_count() > 0
+    finally:
+        gc.unfreeze()
+    assert app.webtest.get('/test').body == b'yay'
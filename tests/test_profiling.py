@@ -0,0 +1,120 @@
+import time
+import pytest
+import threading
+
+from bottlecap.views import View
+from bottlecap.tasks import TaskQueue
+from bottlecap.profiling import (ProfilingPlugin, StackSampler,
+    sign_profile_header, load_profiles)
+
+
+class ProfiledView(View):
+    class Meta:
+        name = 'profiled'
+        path = '/profiled'
+        method = ['GET']
+
+    def dispatch(self):
+        time.sleep(self.delay)
+        return 'ok'
+
+
+@pytest.fixture
+def papp(app):
+    ProfiledView.delay = 0
+    app.route(ProfiledView)
+    return app
+
+
+def install(app, **kwargs):
+    return app.install(ProfilingPlugin(**kwargs))
+
+
+def test_sample_rate(papp):
+    plugin = install(papp, sample_rate=3)
+    for x in range(7):
+        papp.webtest.get('/profiled')
+    profile = plugin.profiles['GET_profiled']
+    assert profile.samples == 2
+    assert any(func[2] == 'dispatch' for func in profile.stats.stats)
+
+
+def test_routes(papp):
+    plugin = install(papp, sample_rate=1, routes=['profiled'])
+    papp.webtest.get('/profiled')
+    papp.webtest.get('/hello')
+    assert list(plugin.profiles) == ['GET_profiled']
+
+
+def test_signed_header(papp):
+    plugin = install(papp, sample_rate=0, secret='s3cret')
+    papp.webtest.get('/profiled')
+    papp.webtest.get('/profiled', headers={
+        'X-BottleCap-Profile': sign_profile_header('wrong')})
+    papp.webtest.get('/profiled', headers={
+        'X-BottleCap-Profile': sign_profile_header('s3cret', ttl=-1)})
+    assert plugin.profiles['GET_profiled'].samples == 0
+
+    papp.webtest.get('/profiled', headers={
+        'X-BottleCap-Profile': sign_profile_header('s3cret')})
+    assert plugin.profiles['GET_profiled'].samples == 1
+
+
+def test_sampler_dump(papp, tmpdir):
+    ProfiledView.delay = 0.05
+    plugin = install(papp, sample_rate=1, sampler=StackSampler(interval=0.001))
+    papp.webtest.get('/profiled')
+    plugin.dump(str(tmpdir))
+
+    stats, stacks = load_profiles(str(tmpdir))['GET_profiled']
+    assert stats is None
+    assert any('test_profiling:dispatch' in stack for stack in stacks)
+
+
+def test_concurrent_cprofile(papp):
+    ProfiledView.delay = 0.2
+    plugin = install(papp, sample_rate=1)
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(papp.webtest.get('/profiled').status_code))
+    thread.start()
+    deadline = time.monotonic() + 5
+    while not plugin.cprofile_lock.locked():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+    # sampled while the other request is profiled
+    assert papp.webtest.get('/profiled').status_code == 200
+    thread.join()
+    assert results == [200]
+    assert plugin.profiles['GET_profiled'].samples == 1
+    assert plugin.skipped == 1
+    assert not plugin.cprofile_lock.locked()
+
+
+def test_dump_queue_full(papp, tmpdir):
+    plugin = install(papp, sample_rate=1, output_dir=str(tmpdir))
+    tasks = papp.tasks = TaskQueue(workers=1, max_size=1, block_timeout=60)
+    release = threading.Event()
+    tasks.submit(release.wait)
+    while tasks.stats()['running'] == 0: pass
+    tasks.submit(list)
+
+    start = time.monotonic()
+    papp.webtest.get('/profiled')
+    assert time.monotonic() - start < 30
+    assert plugin.dumps_skipped == 1 and not tmpdir.listdir()
+    release.set()
+    tasks.shutdown(timeout=5)
+
+
+def test_cprofile_dump(papp, tmpdir):
+    plugin = install(papp, sample_rate=1)
+    papp.webtest.get('/profiled')
+    plugin.dump(str(tmpdir))
+    papp.webtest.get('/profiled')
+    plugin.dump(str(tmpdir.join('other')))
+
+    stats, stacks = load_profiles(str(tmpdir))['GET_profiled']
+    assert stats.total_calls > 0
+    assert not stacks
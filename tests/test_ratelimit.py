@@ -0,0 +1,138 @@
+import os
+import pytest
+
+from uuid import uuid4
+from bottle import request
+from bottlecap.views import View
+from bottlecap.apikey import ApiKeyAuthPlugin, ApiKeyIndex, generate_key
+from bottlecap.negotiation import JSONRenderer
+from bottlecap.ratelimit import *
+
+
+class LimitedView(View):
+    class Meta:
+        path = '/limited'
+        method = ['GET']
+        name = 'limited'
+        renderer_classes = [JSONRenderer]
+        rate_limit = '2/minute'
+
+    def dispatch(self):
+        return 'ok'
+
+
+@pytest.fixture(params=[MemoryBucketStore, SharedMemoryBucketStore])
+def store(request):
+    return request.param()
+
+
+class TestBucketStore:
+    def test_consume(self, store):
+        assert store.consume('a', 2, 10, now=0) == (True, 0)
+        assert store.consume('a', 2, 10, now=0) == (True, 0)
+        assert store.consume('a', 2, 10, now=0) == (False, 5)
+        assert store.consume('b', 2, 10, now=0) == (True, 0)
+
+    def test_refill(self, store):
+        store.consume('a', 2, 10, now=0)
+        store.consume('a', 2, 10, now=0)
+        assert store.consume('a', 2, 10, now=4)[0] is False
+        assert store.consume('a', 2, 10, now=5)[0] is True
+        assert store.consume('a', 2, 10, now=5)[0] is False
+        assert store.consume('a', 2, 10, now=100) == (True, 0)
+
+
+class TestMemoryBucketStore:
+    def test_lazy_expiry(self):
+        store = MemoryBucketStore(shards=1, sweep_interval=10)
+        store.consume('a', 2, 10, now=0)
+        store.consume('b', 2, 10, now=1)
+        assert len(store) == 2
+
+        # shard is not swept again until interval has passed
+        store.consume('c', 2, 10, now=3)
+        assert len(store) == 3
+
+        # only refilled buckets are removed
+        store.consume('d', 2, 10, now=10)
+        store.consume('d', 2, 10, now=10)
+        assert len(store) == 1
+
+
+class TestSharedMemoryBucketStore:
+    def test_eviction(self):
+        store = SharedMemoryBucketStore(shards=1, slots_per_shard=2)
+        store.consume('a', 1, 10, now=0)
+        store.consume('b', 1, 10, now=1)
+        store.consume('c', 1, 10, now=2)
+
+        # oldest bucket was evicted
+        assert store.consume('a', 1, 10, now=2)[0] is True
+        assert store.consume('c', 1, 10, now=2)[0] is False
+
+    def test_shared_across_fork(self):
+        store = SharedMemoryBucketStore()
+        pid = os.fork()
+        if pid == 0: # pragma: no cover
+            store.consume('a', 1, 60)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        assert store.consume('a', 1, 60)[0] is False
+
+
+class TestRateLimitPlugin:
+    def test_rate_limit(self, app):
+        app.install(RateLimitPlugin())
+        app.route(LimitedView)
+
+        assert app.webtest.get('/limited').status_code == 200
+        assert app.webtest.get('/limited').status_code == 200
+
+        resp = app.webtest.get('/limited', expect_errors=True)
+        assert resp.status_code == 429
+        assert resp.headers['Retry-After'] == '30'
+        assert resp.headers['Content-Type'] == 'application/json; charset=UTF-8'
+        assert resp.json == {
+            'error_code': 'rate_limited',
+            'error_desc': 'Too many requests, please try again later',
+            'error_detail': None,
+            'status_code': 429}
+
+        # other clients have their own bucket
+        resp = app.webtest.get('/limited',
+            extra_environ={'REMOTE_ADDR': '10.0.0.1'})
+        assert resp.status_code == 200
+
+    def test_unverified_api_keys(self, app):
+        app.install(RateLimitPlugin())
+        app.route(LimitedView)
+
+        # made up keys share the bucket of their IP address
+        for x in range(2):
+            headers = {'X-API-Key': uuid4().hex}
+            assert app.webtest.get('/limited', headers=headers).status_code == 200
+        resp = app.webtest.get('/limited', headers={'X-API-Key': uuid4().hex},
+                               expect_errors=True)
+        assert resp.status_code == 429
+
+    def test_verified_api_key(self, app):
+        index = ApiKeyIndex()
+        key, key_hash = generate_key('svc')
+        index.add('svc', key_hash, dict(guid=str(uuid4()), roles=[], is_active=True))
+        app.install(ApiKeyAuthPlugin(index))
+        plugin = RateLimitPlugin()
+        app.install(plugin)
+        app.route(LimitedView)
+
+        for x in range(2):
+            app.webtest.get('/limited')
+        assert app.webtest.get('/limited', headers={'X-API-Key': key}).status_code == 200
+
+        request.bind({'REMOTE_ADDR': '10.0.0.1'})
+        request.user, request.api_key = None, 'svc'
+        assert plugin.get_client_key() == 'key:svc'
+
+    def test_unlimited_view(self, app):
+        app.install(RateLimitPlugin())
+        for x in range(5):
+            assert app.webtest.get('/hello').status_code == 200
@@ -0,0 +1,99 @@
+import os
+import time
+import pytest
+
+from bottlecap import BottleCap
+from bottlecap.views import View
+from bottlecap import exceptions as ex
+from bottlecap.negotiation import JSONRenderer
+from bottlecap.reporting import ExceptionReporter, fingerprint
+from blinker import Signal
+from webtest import TestApp
+
+
+class FailingView(View):
+    class Meta:
+        path = '/fail/<kind>'
+        method = ['GET']
+        renderer_classes = [JSONRenderer]
+
+    def dispatch(self):
+        kind = self.url_args['kind']
+        if kind == 'client':
+            raise ex.BadRequestError()
+        if kind == 'server':
+            raise ex.ServerError()
+        raise ValueError(kind)
+
+
+class SlowView(View):
+    class Meta:
+        path = '/slow'
+        method = ['GET']
+        renderer_classes = [JSONRenderer]
+        timeout = 0.01
+
+    def dispatch(self):
+        time.sleep(0.02)
+        return {}
+
+
+@pytest.fixture
+def rapp():
+    app = BottleCap()
+    app.webtest = TestApp(app)
+    app.route(FailingView)
+    app.route(SlowView)
+    app.events = []
+    receiver = lambda sender, events: app.events.extend(events)
+    app.signal_exception.connect(receiver, sender=app, weak=False)
+    yield app
+    app.signal_exception.disconnect(receiver, sender=app)
+    app.close()
+
+
+def raise_from(line):
+    try:
+        if line == 1: raise KeyError('a')
+        if line == 2: raise KeyError('b')
+    except KeyError as exc:
+        return exc
+
+
+def test_fingerprint():
+    assert fingerprint(raise_from(1)) == fingerprint(raise_from(1))
+    assert fingerprint(raise_from(1)) != fingerprint(raise_from(2))
+
+
+def test_reports_server_errors(rapp):
+    for x in range(3):
+        rapp.webtest.get('/fail/boom', expect_errors=True)
+    rapp.webtest.get('/fail/server', expect_errors=True)
+    rapp.webtest.get('/fail/client', expect_errors=True)
+    assert rapp.webtest.get('/slow', expect_errors=True).status_code == 504
+    rapp.exception_reporter.flush()
+
+    events = { type(e.exception): e for e in rapp.events }
+    assert set(events) == {ValueError, ex.ServerError}
+    assert events[ValueError].count == 3
+    assert events[ValueError].route == '/fail/<kind>'
+    assert 'raise ValueError(kind)' in events[ValueError].format()
+
+
+def test_queue_full():
+    signal = Signal()
+    batches = []
+    signal.connect(lambda sender, events: batches.append(events), weak=False)
+    reporter = ExceptionReporter(signal, max_size=2, batch_interval=0.05)
+
+    # fill the queue before the reporter thread is running
+    reporter.pid = os.getpid()
+    results = [ reporter.report(raise_from(1)) for x in range(5) ]
+    assert results == [True, True, False, False, False]
+
+    reporter.pid = None
+    reporter.start()
+    assert reporter.shutdown(timeout=5)
+    assert reporter.stats()['dropped'] == 3
+    assert [ [e.count for e in batch] for batch in batches ] == [[2]]
+    assert reporter.report(raise_from(1)) is False
@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import pytest
+
+from uuid import uuid4
+from bottlecap.auth import JWTAuthPlugin
+from bottlecap.revocation import BloomFilter, RevocationList, RevocationFile
+
+
+def test_bloom_filter():
+    items = [ str(x) for x in range(1000) ]
+    bloom = BloomFilter.from_items(items, error_rate=0.01)
+    assert all(item in bloom for item in items)
+    false_positives = sum(str(x) in bloom for x in range(1000, 11000))
+    assert false_positives < 300
+
+
+def test_revoke_local():
+    revocations = RevocationList()
+    guid = str(uuid4())
+    assert not revocations.is_revoked(jti='a', guid=guid, issued_at=time.time())
+
+    revocations.revoke_token('a')
+    revocations.revoke_user(guid, before=1000)
+    assert revocations.is_revoked(jti='a')
+    assert not revocations.is_revoked(jti='b')
+    assert revocations.is_revoked(guid=guid, issued_at=999)
+    assert revocations.is_revoked(guid=guid)
+    assert not revocations.is_revoked(guid=guid, issued_at=1000)
+    assert revocations.stats()['tokens'] == 1
+
+
+def test_refresh_from_file(tmpdir):
+    path = tmpdir.join('revoked.json')
+    path.write(json.dumps(dict(tokens=['a'], users={'u1': 1000})))
+    revocations = RevocationList(RevocationFile(str(path)), interval=60)
+    revocations.revoke_token('local')
+    assert revocations.refresh() is True
+    assert revocations.refresh() is False
+    assert revocations.is_revoked(jti='a') and revocations.is_revoked(jti='local')
+    assert revocations.is_revoked(guid='u1', issued_at=10)
+
+    # replaced by the next version, local revocations are kept
+    path.write(json.dumps(dict(tokens=['b'])))
+    stat = os.stat(str(path))
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert revocations.refresh() is True
+    assert not revocations.is_revoked(jti='a')
+    assert revocations.is_revoked(jti='b') and revocations.is_revoked(jti='local')
+    assert not revocations.is_revoked(guid='u1', issued_at=10)
+
+    # invalid files keep the current list
+    path.write('{')
+    assert revocations.refresh() is False
+    assert revocations.is_revoked(jti='b')
+
+
+def test_background_refresh(tmpdir):
+    path = tmpdir.join('revoked.json')
+    path.write(json.dumps(dict(tokens=['a'])))
+    revocations = RevocationList(RevocationFile(str(path)), interval=0.01)
+    try:
+        # loaded before the first check is answered
+        assert revocations.is_revoked(jti='a')
+
+        path.write(json.dumps(dict(tokens=['b'])))
+        stat = os.stat(str(path))
+        os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        deadline = time.monotonic() + 5
+        while not revocations.is_revoked(jti='b'):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    finally:
+        assert revocations.shutdown(timeout=5)
+
+
+def test_plugin_revocation(app, jwt_pub_priv_key):
+    pub, priv = jwt_pub_priv_key
+    revocations = RevocationList()
+    jap = JWTAuthPlugin(public_key=pub, private_key=priv, revocations=revocations)
+    app.install(jap)
+
+    guid = str(uuid4())
+    def bearer(**claims):
+        claims['user'] = dict(guid=guid, roles=[], is_active=True)
+        return {'Authorization': 'Bearer: ' + jap.token_encode(claims)}
+
+    old = bearer(jti='t1', iat=int(time.time()) - 60)
+    other = bearer(jti='t2', iat=int(time.time()) - 60)
+    assert app.webtest.get('/hello', headers=old).status_code == 200
+
+    # cached tokens are checked too
+    revocations.revoke_token('t1')
+    resp = app.webtest.get('/hello', headers=old, expect_errors=True)
+    assert resp.status_code == 401
+    assert app.webtest.get('/hello', headers=other).status_code == 200
+
+    revocations.revoke_user(guid, before=time.time() - 30)
+    assert app.webtest.get('/hello', headers=other, expect_errors=True).status_code == 401
+    fresh = bearer(iat=int(time.time()))
+    assert app.webtest.get('/hello', headers=fresh).status_code == 200
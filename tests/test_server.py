@@ -0,0 +1,147 @@
+import os
+import time
+import signal
+import threading
+import socket
+import pytest
+import selectors
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+from bottle import request
+from bottlecap import BottleCap
+from bottlecap.server import PreforkServer, WorkerServer, get_rss, load_app
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_app():
+    app = BottleCap()
+
+    @app.route('/pid')
+    def pid():
+        if request.query.get('sleep'):
+            time.sleep(float(request.query.sleep))
+        return str(os.getpid())
+    return app
+
+
+def get(port, path='/pid', timeout=5):
+    url = 'http://127.0.0.1:{}{}'.format(port, path)
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+        return resp.read().decode()
+
+
+@pytest.fixture
+def serve():
+    masters = []
+
+    def start(**kwargs):
+        port = free_port()
+        app = make_app()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                PreforkServer(app, port=port, graceful_timeout=5, **kwargs).run()
+            finally:
+                os._exit(0)
+        masters.append(pid)
+
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                get(port)
+                return pid, port
+            except OSError:
+                if time.monotonic() > deadline: raise
+                time.sleep(0.05)
+
+    yield start
+    for pid in masters:
+        try:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+
+@pytest.mark.parametrize('reuse_port', [True, False])
+def test_recycle(serve, reuse_port):
+    master, port = serve(workers=1, max_requests=3, reuse_port=reuse_port)
+    pids = [ get(port) for x in range(8) ]
+    # first worker already served the readiness check
+    assert len(set(pids[:2])) == 1
+    assert len(set(pids)) >= 3
+    assert str(master) not in pids
+
+
+def test_threaded_drain(serve):
+    master, port = serve(workers=2, threads=4)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(get(port, '/pid?sleep=0.5')))
+    thread.start()
+    time.sleep(0.2)
+
+    # in-flight request completes after SIGTERM
+    os.kill(master, signal.SIGTERM)
+    thread.join()
+    assert results and results[0].isdigit()
+    _, status = os.waitpid(master, 0)
+    assert os.WIFEXITED(status)
+    with pytest.raises(OSError):
+        get(port, timeout=1)
+
+
+def test_threads_bound_accepts():
+    release = threading.Event()
+
+    def app(environ, start_response):
+        release.wait(5)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'ok']
+
+    port = free_port()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', port))
+    sock.listen(8)
+    sock.setblocking(False)
+    executor = ThreadPoolExecutor(1)
+    server = WorkerServer(sock, app, executor, threads=1)
+    results = []
+    clients = [ threading.Thread(target=lambda: results.append(get(port)))
+                for x in range(2) ]
+
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        for client in clients:
+            client.start()
+        server.handle_ready(selector, 5)
+        assert server.dispatched
+
+        # second connection stays in the backlog, not the executor queue
+        server.handle_ready(selector, 0.1)
+        assert not server.dispatched
+        assert executor._work_queue.qsize() == 0
+
+        release.set()
+        server.handle_ready(selector, 5)
+        assert server.dispatched
+        for client in clients:
+            client.join()
+    executor.shutdown()
+    sock.close()
+    assert results == ['ok', 'ok']
+
+
+def test_get_rss():
+    assert get_rss() > 1024 * 1024
+
+
+def test_load_app():
+    assert load_app('os:path.join') is os.path.join
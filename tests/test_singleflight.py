@@ -0,0 +1,112 @@
+import time
+import threading
+import pytest
+
+from bottle import request
+from bottlecap.views import View
+from bottlecap import exceptions as ex
+from bottlecap.deadline import Deadline
+from bottlecap.negotiation import JSONRenderer
+from bottlecap.singleflight import SingleFlight, CoalescingPlugin
+
+
+class CoalescedView(View):
+    class Meta:
+        path = '/coalesced'
+        method = ['GET']
+        renderer_classes = [JSONRenderer]
+        coalesce = True
+
+    def dispatch(self):
+        self.calls.append(1)
+        self.release.wait(5)
+        if self.error:
+            raise ex.BadRequestError()
+        return {'calls': len(self.calls)}
+
+
+def get_concurrently(app, count, **kwargs):
+    """Issue identical requests from threads, release once all are waiting"""
+    flight = [ p for p in app.plugins if isinstance(p, CoalescingPlugin) ][0].flight
+    results = [None] * count
+
+    def worker(index):
+        results[index] = app.webtest.get('/coalesced', expect_errors=True, **kwargs)
+
+    threads = [ threading.Thread(target=worker, args=(x,)) for x in range(count) ]
+    for thread in threads: thread.start()
+    while sum(call.waiters for call in list(flight.calls.values())) < count - 1:
+        time.sleep(0.001)
+    CoalescedView.release.set()
+    for thread in threads: thread.join()
+    return results
+
+
+@pytest.fixture
+def capp(app):
+    CoalescedView.calls = []
+    CoalescedView.release = threading.Event()
+    CoalescedView.error = False
+    app.route(CoalescedView)
+    return app
+
+
+class TestSingleFlight:
+    def test_do(self):
+        sf = SingleFlight()
+        assert sf.do('a', lambda: 1) == (1, False)
+        assert sf.calls == {}
+
+    def test_exception(self):
+        sf = SingleFlight()
+        with pytest.raises(ZeroDivisionError):
+            sf.do('a', lambda: 1 / 0)
+        assert sf.calls == {}
+
+    def test_wait_timeout(self):
+        sf = SingleFlight(timeout=0.01)
+        call, leader = sf.join('a')
+        with pytest.raises(ex.DeadlineExceededError):
+            sf.wait(sf.join('a')[0])
+
+        # bounded by request deadline rather than timeout
+        sf.timeout = 60
+        request.bind({})
+        request.deadline = Deadline(0.01)
+        start = time.monotonic()
+        with pytest.raises(ex.DeadlineExceededError):
+            sf.wait(call)
+        assert time.monotonic() - start < 5
+
+        sf.finish('a', call, result=1)
+        assert sf.wait(call) == 1
+
+
+class TestCoalescingPlugin:
+    def test_coalesce(self, capp):
+        results = get_concurrently(capp, 5)
+        assert len(CoalescedView.calls) == 1
+        for resp in results:
+            assert resp.status_code == 200
+            assert resp.headers['Content-Type'] == 'application/json; charset=UTF-8'
+            assert resp.json == {'calls': 1}
+
+    def test_coalesce_error(self, capp):
+        CoalescedView.error = True
+        results = get_concurrently(capp, 3)
+        assert len(CoalescedView.calls) == 1
+        for resp in results:
+            assert resp.status_code == 400
+            assert resp.headers['Content-Type'] == 'application/json; charset=UTF-8'
+            assert resp.json['error_code'] == 'bad_request'
+
+    def test_auth_scope(self, capp):
+        CoalescedView.release.set()
+        capp.webtest.get('/coalesced')
+        capp.webtest.get('/coalesced', headers={'Authorization': 'Bearer: a'})
+        assert len(CoalescedView.calls) == 2
+
+    def test_disabled(self, app):
+        plugin = [ p for p in app.plugins if isinstance(p, CoalescingPlugin) ][0]
+        assert app.webtest.get('/hello').body == b'world'
+        assert plugin.flight.calls == {}
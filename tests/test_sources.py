@@ -0,0 +1,59 @@
+import os
+import json
+
+from bottlecap.sources import JSONFileSource, SourceIndex
+from bottlecap.apikey import ApiKeyFile
+from bottlecap.auth import JWKSFile
+from bottlecap.revocation import RevocationFile
+
+
+def test_json_file_source(tmpdir):
+    path = tmpdir.join('data.json')
+    path.write(json.dumps({'a': 1}))
+    source = JSONFileSource(str(path))
+    assert source() == {'a': 1}
+    assert source() is None
+
+    path.write(json.dumps({'a': 22}))
+    stat = os.stat(str(path))
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert source() == {'a': 22}
+
+
+def test_file_sources():
+    for cls in (ApiKeyFile, JWKSFile, RevocationFile):
+        assert issubclass(cls, JSONFileSource)
+
+
+class NameIndex(SourceIndex):
+    def parse(self, data):
+        return { name: name.upper() for name in data }
+
+
+def test_source_index():
+    now = [0]
+    loads = []
+    data = [['a']]
+
+    def source():
+        loads.append(1)
+        return data[0]
+
+    index = NameIndex(source, refresh_interval=60, miss_interval=5,
+                      clock=lambda: now[0])
+    index.put('static', 'S')
+    assert index.get('a') == 'A' and len(loads) == 1
+
+    # misses refresh at most once per miss interval
+    data[0] = ['a', 'b']
+    assert index.get('b') is None and index.get('b') is None
+    assert len(loads) == 1
+    now[0] = 10
+    assert index.get('b') == 'B' and len(loads) == 2
+
+    # periodic refresh replaces loaded entries, keeping added ones
+    data[0] = ['c']
+    now[0] = 100
+    assert index.get('a') is None and index.get('static') == 'S'
+    index.remove('static')
+    assert index.get('static') is None and index.get('c') == 'C'
@@ -0,0 +1,92 @@
+import os
+import sys
+import subprocess
+import pytest
+
+from bottlecap import BottleCap, View
+from bottlecap.startup import StartupRecorder, startup_report
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+APP_MODULE = '''
+from bottlecap import BottleCap, View
+
+app = BottleCap()
+
+@app.route('/hello', name='hello')
+def hello():
+    return 'hello'
+
+class ItemView(View):
+    class Meta:
+        path = '/items'
+        method = ['GET', 'POST']
+
+    def dispatch(self):
+        return 'item'
+
+app.route(ItemView)
+'''
+
+
+class ItemView(View):
+    class Meta:
+        path = '/items'
+        method = ['GET', 'POST']
+
+    def dispatch(self):
+        return 'item'
+
+
+def test_lazy_imports():
+    code = ('import sys, bottlecap.plugin; '
+            'print(sorted(m for m in ("click", "code", "jwt", "box", '
+            '"bottlecap.auth", "bottlecap.cli", "bottlecap.metrics", '
+            '"bottlecap.accesslog") if m in sys.modules))')
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    assert output.strip() == b'[]'
+
+
+def test_cli_attribute():
+    from bottlecap import plugin
+    from bottlecap.cli import cli
+    assert plugin.cli is cli
+    with pytest.raises(AttributeError):
+        plugin.missing
+
+
+def test_recorder():
+    recorder = StartupRecorder()
+    recorder.install()
+    try:
+        app = BottleCap()
+        app.route('/hello')(lambda: 'hello')
+        app.route(ItemView)
+    finally:
+        recorder.uninstall()
+    assert not hasattr(BottleCap.routecbv, '__wrapped__')
+    recorder.prepare_routes()
+
+    data = recorder.to_dict()
+    assert [ a['app'] for a in data['apps'] ] == ['bottlecap.plugin.BottleCap']
+    assert [ (r['method'], r['rule']) for r in data['routes'] ] == [
+        ('GET', '/hello'), ('GET', '/items'), ('POST', '/items')]
+    assert all(r['register_ns'] > 0 and r['prepare_ns'] > 0 for r in data['routes'])
+    app.close()
+
+
+def test_startup_report(tmpdir, monkeypatch):
+    tmpdir.join('startapp.py').write(APP_MODULE)
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setenv('PYTHONPATH', ROOT)
+
+    report = startup_report('startapp:app')
+    names = [ m[0] for m in report.modules ]
+    assert 'startapp' in names and 'bottle' in names
+    assert len(report.apps) == 1
+    assert [ r['rule'] for r in report.routes ] == ['/hello', '/items', '/items']
+    assert report.import_ns > 0
+    assert 'construct bottlecap.plugin.BottleCap' in report.format()
+
+    with pytest.raises(RuntimeError, match='missing_module'):
+        startup_report('missing_module:app')
@@ -0,0 +1,114 @@
+import time
+import threading
+import pytest
+
+from bottle import HTTPError
+from bottlecap.views import View
+from bottlecap.tasks import TaskQueue
+
+
+class DeferView(View):
+    class Meta:
+        path = '/defer'
+        method = ['GET']
+
+    def dispatch(self):
+        self.defer(self.results.append, 'done')
+        return 'ok'
+
+
+class DeferErrorView(DeferView):
+    class Meta:
+        path = '/defer-error'
+
+    def dispatch(self):
+        self.defer(self.results.append, 'done')
+        raise HTTPError(500, 'failed')
+
+
+class TestTaskQueue:
+    def test_submit(self):
+        tq = TaskQueue(workers=2)
+        results = []
+        for x in range(10):
+            assert tq.submit(results.append, x) is True
+        assert tq.shutdown(timeout=5) is True
+        assert sorted(results) == list(range(10))
+
+        stats = tq.stats()
+        assert stats['submitted'] == 10
+        assert stats['completed'] == 10
+        assert stats['depth'] == 0
+        assert stats['run_time']['count'] == 10
+        assert stats['wait_time']['count'] == 10
+
+    def test_failed_task(self):
+        tq = TaskQueue(workers=1)
+        tq.submit(lambda: 1 / 0)
+        tq.shutdown(timeout=5)
+        assert tq.stats()['failed'] == 1
+
+    def test_backpressure(self):
+        tq = TaskQueue(workers=1, max_size=1, block_timeout=0.01)
+        release = threading.Event()
+        tq.submit(release.wait)   # occupies worker
+        while tq.stats()['running'] == 0: pass
+        assert tq.submit(list) is True   # fills queue
+        assert tq.submit(list) is False
+        assert tq.stats()['rejected'] == 1
+
+        # rejected without waiting for block_timeout
+        tq.block_timeout = 60
+        assert tq.submit_nowait(list) is False
+        assert tq.stats()['rejected'] == 2
+
+        release.set()
+        assert tq.shutdown(timeout=5) is True
+        assert tq.stats()['completed'] == 2
+
+    def test_shutdown_full_queue(self):
+        tq = TaskQueue(workers=1, max_size=1)
+        release = threading.Event()
+        tq.submit(release.wait)
+        while tq.stats()['running'] == 0: pass
+        tq.submit(list)
+
+        start = time.monotonic()
+        assert tq.shutdown(timeout=0.05) is False
+        assert time.monotonic() - start < 5
+        release.set()
+
+    def test_closed(self):
+        tq = TaskQueue()
+        tq.submit(list)
+        tq.shutdown()
+        with pytest.raises(RuntimeError):
+            tq.submit(list)
+        assert tq.submit_nowait(list) is False
+        assert tq.stats()['rejected'] == 1
+
+
+class TestDeferredTasks:
+    def test_defer(self, app):
+        DeferView.results = []
+        app.route(DeferView)
+        assert app.webtest.get('/defer').body == b'ok'
+        app.close()
+        assert DeferView.results == ['done']
+
+    def test_defer_discarded_on_error(self, app):
+        DeferView.results = []
+        app.route(DeferErrorView)
+        app.webtest.get('/defer-error', expect_errors=True)
+        app.close()
+        assert DeferView.results == []
+        assert app.tasks.stats()['submitted'] == 0
+
+    def test_defer_after_close(self, app):
+        DeferView.results = []
+        app.route(DeferView)
+        app.webtest.get('/defer')
+        app.close()
+        assert app.webtest.get('/defer').body == b'ok'
+        assert DeferView.results == ['done']
+        assert app.tasks.stats()['rejected'] == 1
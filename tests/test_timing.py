@@ -0,0 +1,88 @@
+import pytest
+
+from bottlecap.views import View
+from bottlecap import exceptions as ex
+from bottlecap.negotiation import JSONRenderer, JSONParser
+from bottlecap.timing import TimingPlugin, get_timings
+
+
+class TimedView(View):
+    class Meta:
+        path = '/timed'
+        method = ['GET', 'POST']
+        parser_classes = [JSONParser]
+        renderer_classes = [JSONRenderer]
+
+    def dispatch(self):
+        if self.error:
+            raise ex.BadRequestError()
+        return sorted(get_timings() or [])
+
+
+class UntimedView(TimedView):
+    class Meta:
+        path = '/untimed'
+        timing = False
+
+
+@pytest.fixture
+def tapp(app):
+    TimedView.error = False
+    app.timing = app.install(TimingPlugin(server_timing=True))
+    app.route(TimedView)
+    app.route(UntimedView)
+    return app
+
+
+def test_phases(tapp):
+    resp = tapp.webtest.post_json('/timed', {'a': 1})
+    assert resp.json == ['negotiate', 'parse']
+
+    header = resp.headers['Server-Timing']
+    phases = [ item.split(';')[0] for item in header.split(', ') ]
+    assert phases == ['negotiate', 'parse', 'dispatch', 'render', 'total']
+
+
+def test_error(tapp):
+    TimedView.error = True
+    resp = tapp.webtest.get('/timed', expect_errors=True)
+    assert resp.status_code == 400
+    header = resp.headers['Server-Timing']
+    assert header.startswith('negotiate;dur=')
+    assert 'total;dur=' in header and 'dispatch' not in header
+
+
+def test_summary(tapp):
+    tapp.webtest.get('/timed')
+    tapp.webtest.get('/timed')
+    summary = tapp.timing.summary()['GET /timed']
+    assert summary['total']['count'] == 2
+    assert summary['total']['max_ms'] >= summary['dispatch']['mean_ms']
+
+    tapp.timing.reset()
+    assert tapp.timing.summary()['GET /timed'] == {}
+
+
+def test_signal(tapp):
+    received = []
+    def receiver(app, route, timings):
+        received.append((route.rule, timings))
+    tapp.signal_timing.connect(receiver)
+    try:
+        tapp.webtest.get('/timed')
+    finally:
+        tapp.signal_timing.disconnect(receiver)
+    assert received[0][0] == '/timed'
+    assert received[0][1]['total'] >= received[0][1]['dispatch']
+
+
+def test_disabled(tapp):
+    resp = tapp.webtest.get('/untimed')
+    assert resp.json == []
+    assert 'Server-Timing' not in resp.headers
+    assert 'clock' not in tapp.routes[-1].call.source
+
+
+def test_not_installed(app):
+    app.route(TimedView)
+    assert 'clock' not in app.routes[-1].call.source